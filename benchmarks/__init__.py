@@ -0,0 +1,9 @@
+"""Benchmarks of the `%async_run` magic and the `AsyncRunServer`.
+
+Run them from the root folder of the repository, e.g.:
+
+    python -m benchmarks.bench_shell_startup
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
@@ -0,0 +1,114 @@
+"""Benchmark of a batch of async cells run by the server alone vs along
+with worker agents (see `run_async.agents`) started on localhost.
+
+Each cell reads a `bytes` object of `-m` MB (sent to agents along with the
+namespace, as an out-of-band buffer) and waits on I/O for `-s` seconds, so
+that the time of the batch shows both the extra capacity of the agents and
+the cost of moving namespaces to them. The time is measured from the
+execution of the first cell up to the results of all the cells being set
+in the namespace.
+
+    python -m benchmarks.bench_agents [-n 12] [-w 2] [-a 2] [-m 8] [-s 0.5]
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+from time import perf_counter, sleep
+from urllib.request import urlopen
+
+from tornado.ioloop import IOLoop
+from IPython.core.interactiveshell import InteractiveShell
+
+from run_async.async_run_magic import AsyncRunMagic
+from run_async.utils import connection_string
+
+from .bench_channel_latency import start_server
+from .bench_thread_mode import POLL_INTERVAL
+
+CELL = '''%%async_run
+import time
+time.sleep({sleep})
+size_{run} = len(data)
+'''
+
+
+def agents_joined():
+    status = urlopen(connection_string(web_socket=False, extra='status')).read()
+    return len(json.loads(status.decode())['agents'])
+
+
+def start_agents(count, workers):
+    """Start the agents, and wait for them to join the server"""
+    agents = [subprocess.Popen([sys.executable, '-m', 'run_async.agents', '-w', str(workers)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+              for _ in range(count)]
+    for _ in range(300):
+        if agents_joined() == count:
+            return agents
+        sleep(.1)
+    stop_agents(agents)
+    raise RuntimeError('Agents not joined')
+
+
+def stop_agents(agents):
+    for agent in agents:
+        agent.terminate()
+    for agent in agents:
+        agent.wait()
+
+
+async def run_batch(shell, runs, sleep_time):
+    """Run the cells (back to back), and return the seconds
+    until all of them are completed"""
+    names = ['size_{}'.format(run) for run in range(runs)]
+    for name in names:
+        _ = shell.user_ns.pop(name, None)
+    start = perf_counter()
+    for run in range(runs):
+        shell.run_cell(CELL.format(sleep=sleep_time, run=run), silent=True)
+    while not all(name in shell.user_ns for name in names):
+        await asyncio.sleep(POLL_INTERVAL)
+    return perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=12,
+                        help='Number of cells of the batch')
+    parser.add_argument('-w', '--workers', type=int, default=2,
+                        help='Number of worker processes of the server, and of each agent')
+    parser.add_argument('-a', '--agents', type=int, default=2,
+                        help='Number of agents')
+    parser.add_argument('-m', '--megabytes', type=int, default=8,
+                        help='Size (MB) of the data read by each cell')
+    parser.add_argument('-s', '--sleep', type=float, default=.5,
+                        help='Seconds each cell waits on I/O')
+    args = parser.parse_args()
+
+    shell = InteractiveShell.instance()
+    shell.register_magics(AsyncRunMagic)
+    shell.display_pub.publish = lambda *args, **kwargs: None  # placeholders
+    shell.user_ns['data'] = bytes(args.megabytes << 20)
+    server = start_server(args.workers)
+    agents = list()
+    try:
+        io_loop = IOLoop.current()
+        print('{} cells, {} MB each, {} workers (server)'.format(args.runs, args.megabytes,
+                                                                 args.workers))
+        _ = io_loop.run_sync(lambda: run_batch(shell, args.workers, 0))  # warm-up
+        elapsed = io_loop.run_sync(lambda: run_batch(shell, args.runs, args.sleep))
+        print('{:<24} {:8.3f} s'.format('server', elapsed))
+        agents = start_agents(args.agents, args.workers)
+        _ = io_loop.run_sync(lambda: run_batch(shell, args.workers * (args.agents + 1), 0))
+        elapsed = io_loop.run_sync(lambda: run_batch(shell, args.runs, args.sleep))
+        print('{:<24} {:8.3f} s'.format('server + {} agents'.format(args.agents), elapsed))
+    finally:
+        stop_agents(agents)
+        server.terminate()
+        server.join()
@@ -0,0 +1,76 @@
+"""Benchmark of a CPU-bound sweep (like `main_heavy` of
+`examples/script2run.py`), run by one async cell (`%%async_run`, i.e. one
+worker) vs mapped over the parameters of the sweep (`%%async_map`, i.e.
+the chunks run in parallel on all the workers of the server).
+
+Cells are run by the magic in an `InteractiveShell`, and the time is
+measured from the execution of the cell up to its result being set in
+the namespace.
+
+    python -m benchmarks.bench_async_map [-p 64] [-n 200000] [-w 4] [-r 3]
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import argparse
+import asyncio
+import os
+from statistics import median
+from time import perf_counter
+
+from tornado.ioloop import IOLoop
+from IPython.core.interactiveshell import InteractiveShell
+
+from run_async.async_run_magic import AsyncRunMagic
+
+from .bench_channel_latency import start_server
+from .bench_thread_mode import POLL_INTERVAL
+
+SWEEP = 'results = [sum(i ** 3 for i in range(n)) for n in params]'
+
+CELLS = {'async_run': '%%async_run\n' + SWEEP,
+         'async_map': '%%async_map params --into results\n' + SWEEP}
+
+
+async def run_cell(shell, cell):
+    """Run the cell, and return the seconds until its results are set"""
+    _ = shell.user_ns.pop('results', None)
+    start = perf_counter()
+    shell.run_cell(cell, silent=True)
+    while 'results' not in shell.user_ns:
+        await asyncio.sleep(POLL_INTERVAL)
+    return perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-p', '--params', type=int, default=64,
+                        help='Number of parameters of the sweep')
+    parser.add_argument('-n', '--size', type=int, default=200000,
+                        help='Number of terms of the sum computed for each parameter')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes of the server')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of runs of each cell (median is reported)')
+    args = parser.parse_args()
+
+    shell = InteractiveShell.instance()
+    shell.register_magics(AsyncRunMagic)
+    shell.display_pub.publish = lambda *args, **kwargs: None  # placeholders
+    shell.user_ns['params'] = [args.size] * args.params
+    server = start_server(args.workers)
+    try:
+        io_loop = IOLoop.current()
+        print('{} parameters, {} workers'.format(args.params, args.workers))
+        expected = None
+        for label, cell in CELLS.items():
+            timings = [io_loop.run_sync(lambda: run_cell(shell, cell))
+                       for _ in range(args.repeat)]
+            if expected is None:
+                expected = shell.user_ns['results']
+            assert shell.user_ns['results'] == expected
+            print('{:<10} {:8.3f} s'.format(label, median(timings)))
+    finally:
+        server.terminate()
+        server.join()
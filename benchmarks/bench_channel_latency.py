@@ -0,0 +1,127 @@
+"""Latency benchmark of the submission of async cells to the server:
+per-cell connection (ping, then a brand-new websocket per cell) vs
+one persistent channel per kernel (see `run_async.channel`).
+
+The latency is measured from the submission of the cell, up to the
+acknowledgement of the request by the server.
+
+    python -m benchmarks.bench_channel_latency [-n 200] [-w 2]
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import argparse
+import json
+import os
+import sys
+from statistics import mean, median
+from time import perf_counter, sleep
+from urllib.request import URLError, urlopen
+from uuid import uuid4
+
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
+
+from run_async.namespace import pack_namespace
+from run_async.run_server import AsyncRunServer
+from run_async.settings import PY_ROLE, REQUEST_ID
+from run_async.transport import write_chunked
+from run_async.utils import connection_string, format_ws_connection_id
+
+CELL = 'pass'
+
+
+def _silent_server(pool_size):
+    sys.stdout = open(os.devnull, 'w')
+    AsyncRunServer(pool_size=pool_size).run()
+
+
+def start_server(pool_size, start_method=None):
+    from multiprocessing import get_context
+    server = get_context(start_method).Process(target=_silent_server, args=(pool_size,))
+    server.start()
+    for _ in range(100):
+        try:
+            _ = urlopen(connection_string(web_socket=False, extra='ping'))
+            return server
+        except URLError:
+            sleep(.1)
+    server.terminate()
+    raise RuntimeError('Server not started')
+
+
+async def submit(ws_conn, channel_id):
+    """Send a cell (with a tiny namespace), and wait for the acknowledgement"""
+    request_id = str(uuid4())
+    packed_ns = pack_namespace({'x': 1}, meta={'connection_id': channel_id,
+                                               REQUEST_ID: request_id})
+    await ws_conn.write_message(json.dumps({'connection_id': channel_id,
+                                            REQUEST_ID: request_id,
+                                            'nb_code_to_run_async': CELL,
+                                            'session': None}))
+    await write_chunked(ws_conn, packed_ns.to_parts())
+    while True:
+        message = await ws_conn.read_message()
+        if message is None:
+            raise RuntimeError('Connection closed by the server')
+        if isinstance(message, str):
+            data = json.loads(message)
+            if data.get(REQUEST_ID) == request_id and data.get('ack', False):
+                return
+
+
+async def per_cell(runs):
+    """One ping and one websocket connection per cell, as the magic used to do"""
+    timings = list()
+    for _ in range(runs):
+        start = perf_counter()
+        _ = urlopen(connection_string(web_socket=False, extra='ping'))
+        channel_id = format_ws_connection_id(PY_ROLE, str(uuid4()))
+        ws_conn = await websocket_connect(
+            connection_string(web_socket=True, extra='ws/{}'.format(channel_id)))
+        await submit(ws_conn, channel_id)
+        timings.append((perf_counter() - start) * 1000)
+        ws_conn.close()
+    return timings
+
+
+async def channel(runs):
+    """All the cells submitted on the same (persistent) connection"""
+    channel_id = format_ws_connection_id(PY_ROLE, str(uuid4()))
+    ws_conn = await websocket_connect(
+        connection_string(web_socket=True, extra='ws/{}'.format(channel_id)))
+    timings = list()
+    for _ in range(runs):
+        start = perf_counter()
+        await submit(ws_conn, channel_id)
+        timings.append((perf_counter() - start) * 1000)
+    ws_conn.close()
+    return timings
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * .95))]
+    print('{:<10} mean: {:8.3f} ms  median: {:8.3f} ms  p95: {:8.3f} ms'.format(
+        label, mean(timings), median(timings), p95))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=200,
+                        help='Number of cells to submit for each mode')
+    parser.add_argument('-w', '--workers', type=int, default=2,
+                        help='Number of worker processes of the server')
+    args = parser.parse_args()
+
+    server = start_server(args.workers)
+    try:
+        io_loop = IOLoop.current()
+        # Warm-up (e.g. workers)
+        io_loop.run_sync(lambda: channel(10))
+        report('per-cell', io_loop.run_sync(lambda: per_cell(args.runs)))
+        report('channel', io_loop.run_sync(lambda: channel(args.runs)))
+    finally:
+        server.terminate()
+        server.join()
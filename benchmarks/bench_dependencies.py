@@ -0,0 +1,86 @@
+"""Benchmark of async cells submitted back to back, forming independent
+chains of dependent cells: cell `i` of chain `j` reads the name written by
+cell `i - 1` of the chain, so the server holds it until the previous cell
+is completed (see `handlers.DependencyGraph`), while chains run in parallel.
+
+Each cell waits on I/O for `-s` seconds, hence the (ideal) time is the
+length of the chains times `-s` seconds (as long as there are as many
+workers as chains), rather than the number of cells times `-s` seconds
+(i.e. cells run one at a time).
+
+    python -m benchmarks.bench_dependencies [-c 3] [-l 4] [-s 0.2] [-r 3]
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import argparse
+import asyncio
+from statistics import median
+from time import perf_counter
+
+from tornado.ioloop import IOLoop
+from IPython.core.interactiveshell import InteractiveShell
+
+from run_async.async_run_magic import AsyncRunMagic
+
+from .bench_channel_latency import start_server
+from .bench_thread_mode import POLL_INTERVAL
+
+CELL = '''%%async_run
+import time
+time.sleep({sleep})
+chain_{chain}_{step} = chain_{chain}_{previous} + 1
+'''
+
+
+async def run_chains(shell, chains, length, sleep):
+    """Submit the cells of the chains (step by step), and return the
+    seconds until the last cell of each chain is completed"""
+    for chain in range(chains):
+        for step in range(1, length + 1):
+            _ = shell.user_ns.pop('chain_{}_{}'.format(chain, step), None)
+        shell.user_ns['chain_{}_0'.format(chain)] = chain * 100
+    last = ['chain_{}_{}'.format(chain, length) for chain in range(chains)]
+    start = perf_counter()
+    for step in range(1, length + 1):
+        for chain in range(chains):
+            shell.run_cell(CELL.format(sleep=sleep, chain=chain, step=step,
+                                       previous=step - 1), silent=True)
+    while not all(name in shell.user_ns for name in last):
+        await asyncio.sleep(POLL_INTERVAL)
+    return perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-c', '--chains', type=int, default=3,
+                        help='Number of independent chains of cells')
+    parser.add_argument('-l', '--length', type=int, default=4,
+                        help='Number of (dependent) cells of each chain')
+    parser.add_argument('-s', '--sleep', type=float, default=.2,
+                        help='Seconds each cell waits on I/O')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of runs (median is reported)')
+    args = parser.parse_args()
+
+    shell = InteractiveShell.instance()
+    shell.register_magics(AsyncRunMagic)
+    shell.display_pub.publish = lambda *args, **kwargs: None  # placeholders
+    server = start_server(args.chains)
+    try:
+        io_loop = IOLoop.current()
+        timings = [io_loop.run_sync(lambda: run_chains(shell, args.chains, args.length,
+                                                       args.sleep))
+                   for _ in range(args.repeat)]
+        for chain in range(args.chains):
+            assert shell.user_ns['chain_{}_{}'.format(chain, args.length)] == \
+                chain * 100 + args.length
+        print('{} chains of {} cells, {} workers'.format(args.chains, args.length,
+                                                         args.chains))
+        print('{:<10} {:8.3f} s'.format('measured', median(timings)))
+        print('{:<10} {:8.3f} s'.format('ideal', args.length * args.sleep))
+        print('{:<10} {:8.3f} s'.format('serial', args.chains * args.length * args.sleep))
+    finally:
+        server.terminate()
+        server.join()
@@ -0,0 +1,278 @@
+"""End-to-end load test of the server: concurrent kernels submitting async
+cells on their own channel (see `run_async.channel`), as the magic does.
+
+Each (simulated) kernel has its own shell and session, and runs `-c` cells
+one after the other (i.e. the number of kernels is the number of cells
+submitted at once). Before each cell, the namespace of the kernel (`-v`
+variables, `-m` MB in total) is marked as changed, so that it is sent again
+along with the cell; each cell reads all the variables, prints `-k` KB of
+output and waits on I/O for `-d` seconds.
+
+The first value of each of those options is its base value: each option is
+swept over its values while the others are at their base values. Each
+configuration runs on a brand-new server (spawned, i.e. not sharing the
+memory of this process), and the latency from the submission of a cell up
+to its result being merged into the namespace (p50 and p99), the throughput
+(cells per second) and the peak RSS of the server (and of its workers) are
+reported.
+Results are written in JSON (`-o`), along with the revision of the
+repository, and compared with the results of a former run (`--compare`).
+
+    python -m benchmarks.bench_load [-n 1 4 16] [-v 10 1 1000] [-m 1 0.1 16]
+                                    [-k 1 64 512] [-d 0.05 0 0.5] [-c 10] [-w 2]
+                                    [-o bench_load.json] [--compare OLD.json]
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+from datetime import datetime, timezone
+from statistics import median, quantiles
+from time import perf_counter
+from uuid import uuid4
+
+import psutil
+from tornado.concurrent import Future
+from tornado.gen import multi
+from tornado.ioloop import IOLoop, PeriodicCallback
+from traitlets.config import Config
+from IPython.core.interactiveshell import InteractiveShell
+
+from run_async.async_run_magic import CellRequest, SessionSync
+from run_async.channel import KernelChannel
+
+from .bench_channel_latency import start_server
+
+DIMENSIONS = ('kernels', 'variables', 'megabytes', 'output_kb', 'duration')
+RSS_SAMPLE_INTERVAL = 100  # milliseconds
+
+CELL = '''import time
+time.sleep({duration})
+print('x' * {output})
+result = sum(len(value) for value in ({names},))
+'''
+
+
+class TimedRequest(CellRequest):
+    """Request of a cell, resolving `future` once its result is merged
+    into the namespace (or with the error, if failed)"""
+
+    def __init__(self, *args, future=None, **kwargs):
+        super(TimedRequest, self).__init__(*args, **kwargs)
+        self.future = future
+
+    def on_result(self, packed_ns):
+        done = super(TimedRequest, self).on_result(packed_ns)
+        if done:
+            self.future.set_result(None)
+        return done
+
+    def on_error(self, message):
+        if not self.future.done():
+            self.future.set_result(message)
+
+
+class Kernel:
+    """Simulated kernel: a shell, its session and its channel"""
+
+    def __init__(self, variables, megabytes):
+        config = Config()
+        config.HistoryManager.enabled = False
+        self.shell = InteractiveShell(config=config)
+        self.shell.display_pub.publish = lambda *args, **kwargs: None
+        size = int(megabytes * (1 << 20) / variables)
+        self.names = ['var_{}'.format(i) for i in range(variables)]
+        for name in self.names:
+            self.shell.user_ns[name] = bytes(size)
+        self.session = SessionSync()
+        self.channel = KernelChannel()
+
+    async def run_cell(self, source):
+        """Run the cell (with all the variables sent along), and
+        return its latency (None if failed)"""
+        self.session.forget(self.names)
+        future = Future()
+        request = TimedRequest(str(uuid4()), source, self.shell, session=self.session,
+                               future=future)
+        start = perf_counter()
+        self.channel.submit(request)
+        error = await future
+        if error is not None or self.shell.user_ns.get('result', None) is None:
+            return None
+        _ = self.shell.user_ns.pop('result')
+        return perf_counter() - start
+
+    async def run_cells(self, source, cells):
+        return [await self.run_cell(source) for _ in range(cells)]
+
+    def close(self):
+        self.channel.close()
+
+
+class RSSMonitor:
+    """Peak RSS of the server process, and of its workers"""
+
+    def __init__(self, pid):
+        self.server = psutil.Process(pid)
+        self.server_rss = self.workers_rss = 0
+        self._callback = PeriodicCallback(self.sample, RSS_SAMPLE_INTERVAL)
+
+    def sample(self):
+        try:
+            self.server_rss = max(self.server_rss, self.server.memory_info().rss)
+            workers = 0
+            for child in self.server.children(recursive=True):
+                try:
+                    workers += child.memory_info().rss
+                except psutil.Error:  # e.g. worker replaced
+                    pass
+            self.workers_rss = max(self.workers_rss, workers)
+        except psutil.Error:
+            pass
+
+    def __enter__(self):
+        self.sample()
+        self._callback.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._callback.stop()
+        self.sample()
+
+
+async def run_load(server_pid, config, cells):
+    """Run `cells` cells on each kernel of the configuration,
+    and return the measures"""
+    kernels = [Kernel(config['variables'], config['megabytes'])
+               for _ in range(config['kernels'])]
+    source = CELL.format(duration=config['duration'], output=config['output_kb'] << 10,
+                         names=', '.join(kernels[0].names))
+    try:
+        # Warm-up: the first cell of each kernel sends its whole namespace
+        _ = await multi([kernel.run_cell(source) for kernel in kernels])
+        with RSSMonitor(server_pid) as rss:
+            start = perf_counter()
+            results = await multi([kernel.run_cells(source, cells) for kernel in kernels])
+            elapsed = perf_counter() - start
+    finally:
+        for kernel in kernels:
+            kernel.close()
+    latencies = [latency for result in results for latency in result if latency is not None]
+    p50 = p99 = None
+    if len(latencies) > 1:
+        percentiles = quantiles(latencies, n=100, method='inclusive')
+        p50, p99 = median(latencies), percentiles[98]
+    return dict(config, cells=len(kernels) * cells,
+                errors=len(kernels) * cells - len(latencies),
+                p50=p50, p99=p99, throughput=len(latencies) / elapsed,
+                server_rss_mb=rss.server_rss / (1 << 20),
+                workers_rss_mb=rss.workers_rss / (1 << 20))
+
+
+def sweep(args):
+    """Configurations of the load test: the base configuration, then
+    each dimension swept over its other values"""
+    base = {dimension: getattr(args, dimension)[0] for dimension in DIMENSIONS}
+    configurations = [dict(base, sweep='base')]
+    for dimension in DIMENSIONS:
+        for value in getattr(args, dimension)[1:]:
+            configurations.append(dict(base, sweep=dimension, **{dimension: value}))
+    return configurations
+
+
+def revision():
+    """Revision of the repository (None if unknown)"""
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _key(result):
+    return tuple(result[dimension] for dimension in DIMENSIONS)
+
+
+def _format(value, spec):
+    return '-' if value is None else format(value, spec)
+
+
+def compare(results, former):
+    """Print the ratios of the measures to the ones of a former run"""
+    former_results = {_key(result): result for result in former['results']}
+    print('Compared with {} ({}): new / old'.format(former.get('revision', None),
+                                                   former.get('date', None)))
+    print('{:<10} {:>8} {:>8} {:>8} {:>10} {:>10}'.format(
+        'sweep', 'value', 'p50', 'p99', 'jobs/s', 'server RSS'))
+    for result in results:
+        old = former_results.get(_key(result), None)
+        if old is None:
+            continue
+        ratios = [new / old if new and old else None for new, old in (
+            (result[measure], old[measure])
+            for measure in ('p50', 'p99', 'throughput', 'server_rss_mb'))]
+        dimension = 'kernels' if result['sweep'] == 'base' else result['sweep']
+        print('{:<10} {:>8} {:>8} {:>8} {:>10} {:>10}'.format(
+            result['sweep'], result[dimension], *(_format(ratio, '.2f') for ratio in ratios)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--kernels', type=int, nargs='+', default=[4, 1, 16],
+                        help='Numbers of concurrent kernels')
+    parser.add_argument('-v', '--variables', type=int, nargs='+', default=[10, 1, 1000],
+                        help='Numbers of variables of the namespace')
+    parser.add_argument('-m', '--megabytes', type=float, nargs='+', default=[1, .1, 16],
+                        help='Sizes (MB) of the namespace')
+    parser.add_argument('-k', '--output-kb', type=int, nargs='+', default=[1, 64, 512],
+                        help='Sizes (KB) of the output of each cell')
+    parser.add_argument('-d', '--duration', type=float, nargs='+', default=[.05, 0, .5],
+                        help='Seconds each cell waits on I/O')
+    parser.add_argument('-c', '--cells', type=int, default=10,
+                        help='Number of cells run by each kernel')
+    parser.add_argument('-w', '--workers', type=int, default=2,
+                        help='Number of worker processes of the server')
+    parser.add_argument('-o', '--output', default='bench_load.json',
+                        help='File the results (JSON) are written to')
+    parser.add_argument('--compare', default=None, metavar='FILE',
+                        help='Results (JSON) of a former run to compare with')
+    args = parser.parse_args()
+
+    results = list()
+    io_loop = IOLoop.current()
+    print('{} workers, {} cells per kernel'.format(args.workers, args.cells))
+    print('{:<10} {:>7} {:>9} {:>6} {:>9} {:>8} {:>8} {:>8} {:>8} {:>10} {:>11}'.format(
+        'sweep', 'kernels', 'variables', 'MB', 'output KB', 'duration', 'p50 s',
+        'p99 s', 'jobs/s', 'server MB', 'workers MB'))
+    for config in sweep(args):
+        server = start_server(args.workers, start_method='spawn')
+        try:
+            result = io_loop.run_sync(lambda: run_load(server.pid, config, args.cells))
+        finally:
+            server.terminate()
+            server.join()
+        results.append(result)
+        print('{:<10} {:>7} {:>9} {:>6} {:>9} {:>8} {:>8} {:>8} {:>8.1f} {:>10.1f} '
+              '{:>11.1f}'.format(result['sweep'], result['kernels'], result['variables'],
+                                 result['megabytes'], result['output_kb'],
+                                 result['duration'], _format(result['p50'], '.3f'),
+                                 _format(result['p99'], '.3f'), result['throughput'],
+                                 result['server_rss_mb'], result['workers_rss_mb']))
+
+    report = {'revision': revision(),
+              'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'cpus': os.cpu_count(), 'workers': args.workers,
+              'cells_per_kernel': args.cells, 'results': results}
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print('Results written to', args.output)
+    if args.compare is not None:
+        with open(args.compare) as former:
+            compare(results, json.load(former))
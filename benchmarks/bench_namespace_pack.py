@@ -0,0 +1,107 @@
+"""Benchmark of namespace packing: legacy (trial pickle of each value,
+then pickle of the whole namespace) vs single-pass `pack_namespace`.
+
+    python -m benchmarks.bench_namespace_pack [--sizes 1000 10000 100000]
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import argparse
+import pickle
+from time import perf_counter
+
+from run_async.namespace import pack_namespace, PackedNamespace
+
+
+def make_namespace(size, large=False):
+    """Namespace of `size` objects of mixed (common) types,
+    including a few unpicklable ones. If `large`, values
+    are containers of (about) 10k items."""
+    namespace = dict()
+    if large:
+        for i in range(size):
+            if i % 2:
+                value = [float(j) for j in range(10000)]
+            else:
+                value = {j: 'item {}'.format(j) for j in range(10000)}
+            namespace['var_{}'.format(i)] = value
+        namespace['fn'] = lambda: None
+        return namespace
+    for i in range(size):
+        kind = i % 6
+        if kind == 0:
+            value = i
+        elif kind == 1:
+            value = float(i) / 3
+        elif kind == 2:
+            value = 'string value {}'.format(i)
+        elif kind == 3:
+            value = list(range(i % 50))
+        elif kind == 4:
+            value = {'key': i, 'values': [i] * 10}
+        else:
+            value = bytes(i % 1024)
+        namespace['var_{}'.format(i)] = value
+    for i in range(max(1, size // 1000)):
+        namespace['fn_{}'.format(i)] = lambda: None
+    return namespace
+
+
+def legacy_pack(namespace):
+    white_ns = dict()
+    for k, v in namespace.items():
+        try:
+            _ = pickle.dumps({k: v})
+            white_ns[k] = v
+        except Exception:
+            continue
+    return pickle.dumps(white_ns)
+
+
+def legacy_unpack(message):
+    return pickle.loads(message)
+
+
+def single_pass_pack(namespace):
+    return pack_namespace(namespace).to_bytes()
+
+
+def single_pass_unpack(message):
+    return PackedNamespace.from_buffer(message).unpack()
+
+
+def best_of(fn, arg, repeat):
+    best, result = None, None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = fn(arg)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Number of objects in the namespace')
+    parser.add_argument('--large-sizes', type=int, nargs='+', default=[10, 100],
+                        help='Number of large objects (10k items each) in the namespace')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Number of repetitions (best timing is reported)')
+    args = parser.parse_args()
+
+    print('{:>8} {:>12} {:>10} {:>12} {:>12} {:>12}'.format(
+        'objects', 'method', 'size (KB)', 'pack (ms)', 'unpack (ms)', 'total (ms)'))
+    workloads = [(size, make_namespace, size) for size in args.sizes]
+    workloads += [('{} L'.format(size), lambda size: make_namespace(size, large=True), size)
+                  for size in args.large_sizes]
+    for label, make, size in workloads:
+        namespace = make(size)
+        for method, pack, unpack in (('legacy', legacy_pack, legacy_unpack),
+                                     ('single-pass', single_pass_pack, single_pass_unpack)):
+            pack_time, message = best_of(pack, namespace, args.repeat)
+            unpack_time, _ = best_of(unpack, message, args.repeat)
+            print('{:>8} {:>12} {:>10.1f} {:>12.2f} {:>12.2f} {:>12.2f}'.format(
+                label, method, len(message) / 1024, pack_time, unpack_time,
+                pack_time + unpack_time))
@@ -0,0 +1,76 @@
+"""Benchmark of the overhead of profiling async cells: time of a CPU-bound
+cell (calling a small function `-c` times) run as it is, under the profiler
+(`--profile`), and with line-level timings of the function
+(`--profile-lines`).
+
+The time is measured from the execution of the cell up to its result being
+set in the namespace, hence the first row is the time of an unprofiled cell
+(whose execution does not involve the profiler at all).
+
+    python -m benchmarks.bench_profile [-c 200000] [-r 5]
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import argparse
+import asyncio
+from statistics import median
+from time import perf_counter
+
+from tornado.ioloop import IOLoop
+from IPython.core.interactiveshell import InteractiveShell
+
+from run_async.async_run_magic import AsyncRunMagic
+
+from .bench_channel_latency import start_server
+from .bench_thread_mode import POLL_INTERVAL
+
+CELL = '''%%async_run {options}
+def step(i):
+    return i * i % 7
+total = 0
+for i in range({calls}):
+    total += step(i)
+'''
+
+MODES = (('off', ''),
+         ('--profile', '--profile'),
+         ('--profile-lines', '--profile-lines step'))
+
+
+async def run_cell(shell, options, calls):
+    """Run the cell, and return the seconds until its result is set"""
+    _ = shell.user_ns.pop('total', None)
+    start = perf_counter()
+    shell.run_cell(CELL.format(options=options, calls=calls), silent=True)
+    while 'total' not in shell.user_ns:
+        await asyncio.sleep(POLL_INTERVAL)
+    return perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-c', '--calls', type=int, default=200000,
+                        help='Number of calls of the function of the cell')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Number of runs (median is reported)')
+    args = parser.parse_args()
+
+    shell = InteractiveShell.instance()
+    shell.register_magics(AsyncRunMagic)
+    shell.display_pub.publish = lambda *args, **kwargs: None  # placeholders
+    server = start_server(1)
+    try:
+        io_loop = IOLoop.current()
+        _ = io_loop.run_sync(lambda: run_cell(shell, '', 1))  # warm-up
+        print('{} calls per cell, median of {} runs'.format(args.calls, args.repeat))
+        baseline = None
+        for label, options in MODES:
+            elapsed = median(io_loop.run_sync(lambda: run_cell(shell, options, args.calls))
+                             for _ in range(args.repeat))
+            baseline = baseline or elapsed
+            print('{:<16} {:8.3f} s  x{:.2f}'.format(label, elapsed, elapsed / baseline))
+    finally:
+        server.terminate()
+        server.join()
@@ -0,0 +1,86 @@
+"""Benchmark of the serializers of the values of namespaces (see
+`run_async.serializers`): encode and decode time, and size, of common
+data (NumPy arrays and pandas DataFrames, if installed) with each of
+the serializers available, so to select the fastest one for each type.
+
+    python -m benchmarks.bench_serializers [-s 1000000] [-r 5]
+
+Values are encoded in-band (i.e. as if shared memory was not available).
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import argparse
+
+from run_async import serializers
+from run_async.serializers import PICKLE, CLOUDPICKLE
+
+from .bench_namespace_pack import best_of
+
+
+def make_samples(size):
+    """Samples of (about) `size` items, along with the serializers
+    which can encode them"""
+    generic = [PICKLE, CLOUDPICKLE]
+    samples = [('dict', {i: 'item {}'.format(i) for i in range(size)}, generic),
+               ('list of floats', [float(i) for i in range(size)], generic),
+               ('lambda', lambda x: x * size, generic)]
+    try:
+        import numpy
+    except ImportError:
+        print('NumPy not installed: arrays skipped')
+    else:
+        samples += [('float64 array', numpy.random.rand(size), generic + ['numpy']),
+                    ('int8 matrix (F)', numpy.asfortranarray(
+                        numpy.ones((size // 100, 100), dtype='i1')), generic + ['numpy'])]
+        try:
+            import pandas
+        except ImportError:
+            print('pandas not installed: DataFrames skipped')
+        else:
+            frame = pandas.DataFrame({'a': numpy.random.rand(size),
+                                      'b': numpy.arange(size),
+                                      'c': ['item {}'.format(i % 100) for i in range(size)]})
+            samples.append(('DataFrame', frame, generic + ['arrow']))
+    return samples
+
+
+def measure(serializer, value, repeat):
+    """Best encode and decode times (ms), and size (bytes)"""
+    encode_time, data = best_of(serializer.dumps, value, repeat)
+    decode_time, _ = best_of(serializer.loads, data, repeat)
+    return encode_time, decode_time, len(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-s', '--size', type=int, default=1000000,
+                        help='Number of items of each sample')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Number of repetitions (best timing is reported)')
+    args = parser.parse_args()
+
+    available = serializers.available_formats()
+    samples = make_samples(args.size)
+    print('{:<16} {:>12} {:>12} {:>12} {:>12} {:>12}'.format(
+        'sample', 'serializer', 'size (MB)', 'encode (ms)', 'decode (ms)', 'total (ms)'))
+    for label, value, names in samples:
+        best = None
+        for name in names:
+            if name not in available:
+                print('{:<16} {:>12} {:>12}'.format(label, name, 'n/a'))
+                continue
+            try:
+                encode_time, decode_time, size = measure(serializers.get(name), value,
+                                                         args.repeat)
+            except Exception as e:  # e.g. lambdas cannot be pickled
+                print('{:<16} {:>12} {:>12}'.format(label, name, type(e).__name__))
+                continue
+            total = encode_time + decode_time
+            print('{:<16} {:>12} {:>12.2f} {:>12.2f} {:>12.2f} {:>12.2f}'.format(
+                label, name, size / 2**20, encode_time, decode_time, total))
+            if best is None or total < best[1]:
+                best = name, total
+        if best is not None:
+            print('{:<16} {:>12} ({})'.format('', 'fastest', best[0]))
@@ -0,0 +1,72 @@
+"""Benchmark of the transfer of large buffers: in-band (pickled in the
+message) vs out-of-band (memory-mapped segments, see `shared_buffers`).
+
+    python -m benchmarks.bench_shared_buffers [--sizes 1 16 128]
+
+Values are bytearrays, and NumPy arrays (if NumPy is installed).
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import argparse
+import tempfile
+from time import perf_counter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from run_async import shared_buffers
+from run_async.namespace import pack_namespace, PackedNamespace
+
+
+def make_values(size):
+    """Values of `size` MiB"""
+    nbytes = size << 20
+    values = {'bytearray': bytearray(nbytes)}
+    if np is not None:
+        values['ndarray'] = np.ones(nbytes // 8, dtype=np.float64)
+    return values
+
+
+def transfer(value, out_of_band):
+    """Pack, write, read, and unpack the value, and return the
+    size of the message along with the timings (in ms)"""
+    start = perf_counter()
+    message = pack_namespace({'value': value}, out_of_band=out_of_band).to_bytes()
+    packed = perf_counter()
+    # The message is copied on the (websocket) transport
+    message = bytearray(message)
+    sent = perf_counter()
+    packed_ns = PackedNamespace.from_buffer(message)
+    _ = packed_ns.unpack(release=True)
+    end = perf_counter()
+    return len(message), (packed - start) * 1000, (sent - packed) * 1000, (end - sent) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 16, 128],
+                        help='Size of the values (MiB)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Number of repetitions (best timing is reported)')
+    args = parser.parse_args()
+
+    # Segments of the benchmark never clash with those of a running server
+    shared_buffers.set_segment_dir(tempfile.mkdtemp(prefix='run_async-bench-', dir='/dev/shm'))
+    try:
+        print('{:>10} {:>10} {:>12} {:>12} {:>10} {:>10} {:>12} {:>10}'.format(
+            'type', 'size (MB)', 'method', 'msg (KB)', 'pack (ms)', 'send (ms)',
+            'unpack (ms)', 'total (ms)'))
+        for size in args.sizes:
+            for kind, value in make_values(size).items():
+                for method, out_of_band in (('in-band', False), ('out-of-band', True)):
+                    results = [transfer(value, out_of_band) for _ in range(args.repeat)]
+                    nbytes, pack, send, unpack = min(results, key=lambda r: sum(r[1:]))
+                    print('{:>10} {:>10} {:>12} {:>12.1f} {:>10.2f} {:>10.2f} {:>12.2f} {:>10.2f}'.format(
+                        kind, size, method, nbytes / 1024, pack, send, unpack,
+                        pack + send + unpack))
+    finally:
+        shared_buffers.remove_segment_dir()
@@ -0,0 +1,76 @@
+"""Startup/latency benchmark of the shell running the async cells:
+cold path (a brand-new `InteractiveShell` per cell) vs warm path
+(the worker shell, reset between cells).
+
+    python -m benchmarks.bench_shell_startup [-n 200]
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import argparse
+from statistics import mean, median
+from time import perf_counter
+
+from IPython.core.interactiveshell import InteractiveShell
+from IPython.utils.io import capture_output
+
+from run_async.run_server import (execute_cell, get_worker_shell,
+                                  reset_worker_shell)
+
+CELL = 'y = x * 2\nprint(y)'
+
+
+def cold_cell():
+    """Per-cell shell creation, as `execute_cell` used to do"""
+    shell = InteractiveShell()
+    shell.call_pdb = False
+    shell.pdb = False
+    shell.user_ns.update({'x': 21})
+    with capture_output():
+        shell.run_cell(CELL, silent=True, shell_futures=False)
+
+
+def warm_cell():
+    shell = get_worker_shell()
+    shell.user_ns.update({'x': 21})
+    with capture_output():
+        shell.run_cell(CELL, silent=True, shell_futures=False)
+    reset_worker_shell()
+
+
+def warm_execute_cell():
+    """The whole `execute_cell`, i.e. including namespace processing"""
+    execute_cell(CELL, {'x': 21, 'import_modules': []})
+
+
+def timeit(fn, runs):
+    timings = list()
+    for _ in range(runs):
+        start = perf_counter()
+        fn()
+        timings.append((perf_counter() - start) * 1000)
+    return timings
+
+
+def report(label, timings):
+    timings = sorted(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * .99))]
+    print('{:<20} mean: {:8.3f} ms  median: {:8.3f} ms  p99: {:8.3f} ms'.format(
+        label, mean(timings), median(timings), p99))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=200,
+                        help='Number of cells to run for each path')
+    args = parser.parse_args()
+
+    # First shell ever created in the process (i.e. a brand new worker)
+    start = perf_counter()
+    get_worker_shell()
+    print('First shell (worker warm-up): {:.3f} ms'.format((perf_counter() - start) * 1000))
+
+    report('cold', timeit(cold_cell, args.runs))
+    report('warm', timeit(warm_cell, args.runs))
+    report('warm execute_cell', timeit(warm_execute_cell, args.runs))
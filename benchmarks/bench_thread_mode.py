@@ -0,0 +1,78 @@
+"""Latency benchmark of async cells run in a worker process of the server
+(`%%async_run`) vs in a thread of the kernel (`%%async_run --mode thread`).
+
+Cells are run by the magic in an `InteractiveShell`, one at a time, and
+the latency is measured from the execution of the cell in the shell up to
+the names it writes being merged back into the namespace. Each cell reads
+a namespace of `-k` objects (pickled, and sent to the server, in process
+mode only), and waits on I/O for `-s` seconds, which is not part of the
+reported latency.
+
+    python -m benchmarks.bench_thread_mode [-n 50] [-k 1000] [-s 0.01]
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import argparse
+import asyncio
+from time import perf_counter
+
+from tornado.ioloop import IOLoop
+from IPython.core.interactiveshell import InteractiveShell
+
+from run_async.async_run_magic import AsyncRunMagic
+
+from .bench_channel_latency import report, start_server
+
+POLL_INTERVAL = .0002
+
+CELL = '''%%async_run {options}
+import time
+time.sleep({sleep})
+done_{run} = len(data)
+'''
+
+
+async def run_cells(shell, options, runs, sleep):
+    """Run the cells, and return the latency (ms) of each one"""
+    timings = list()
+    for run in range(runs):
+        name = 'done_{}'.format(run)
+        start = perf_counter()
+        shell.run_cell(CELL.format(options=options, sleep=sleep, run=run), silent=True)
+        while name not in shell.user_ns:
+            # Not a busy loop, which would starve the threads of the GIL
+            await asyncio.sleep(POLL_INTERVAL)
+        timings.append((perf_counter() - start - sleep) * 1000)
+        del shell.user_ns[name]
+    return timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=50,
+                        help='Number of cells to run for each mode')
+    parser.add_argument('-k', '--objects', type=int, default=1000,
+                        help='Number of objects in the namespace read by the cells')
+    parser.add_argument('-s', '--sleep', type=float, default=.01,
+                        help='Seconds each cell waits on I/O')
+    parser.add_argument('-w', '--workers', type=int, default=2,
+                        help='Number of worker processes of the server')
+    args = parser.parse_args()
+
+    shell = InteractiveShell.instance()
+    shell.register_magics(AsyncRunMagic)
+    shell.display_pub.publish = lambda *args, **kwargs: None  # placeholders
+    shell.user_ns['data'] = {i: 'item {}'.format(i) for i in range(args.objects)}
+    server = start_server(args.workers)
+    try:
+        io_loop = IOLoop.current()
+        for label, options in (('process', ''), ('thread', '--mode thread')):
+            # Warm-up (e.g. workers, the kernel channel, and threads)
+            _ = io_loop.run_sync(lambda: run_cells(shell, options, 5, args.sleep))
+            report(label, io_loop.run_sync(lambda: run_cells(shell, options,
+                                                             args.runs, args.sleep)))
+    finally:
+        server.terminate()
+        server.join()
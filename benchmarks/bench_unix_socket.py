@@ -0,0 +1,131 @@
+"""Latency and throughput benchmark of the transport of the kernel channel:
+TCP (the HTTP port of the server) vs Unix domain socket.
+
+The latency is measured from the submission of a cell (with a tiny
+namespace), up to the acknowledgement of the request by the server; the
+throughput by submitting cells along with a large namespace (pickled
+in-band, i.e. written on the websocket). The result of each cell is
+received (untimed) before submitting the next one, so that cells never
+pile up in the queue of the server.
+
+    python -m benchmarks.bench_unix_socket [-n 500] [-s 64] [-r 10]
+
+The path of the socket is taken from RUN_ASYNC_SERVER_SOCKET (if set).
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import argparse
+import json
+import os
+import tempfile
+from time import perf_counter
+from uuid import uuid4
+
+# The server listens on a Unix domain socket (see `settings.SERVER_SOCKET`)
+os.environ.setdefault('RUN_ASYNC_SERVER_SOCKET',
+                      os.path.join(tempfile.gettempdir(), 'run_async-bench.sock'))
+
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
+
+from run_async.channel import UnixSocketResolver
+from run_async.namespace import PackedNamespace, pack_namespace
+from run_async.settings import PY_ROLE, REQUEST_ID, SERVER_SOCKET
+from run_async.transport import MessageReader, write_chunked
+from run_async.utils import connection_string, format_ws_connection_id, server_socket
+
+from .bench_channel_latency import CELL, report, start_server
+
+
+async def connect(resolver=None):
+    channel_id = format_ws_connection_id(PY_ROLE, str(uuid4()))
+    ws_conn = await websocket_connect(
+        connection_string(web_socket=True, extra='ws/{}'.format(channel_id)),
+        resolver=resolver)
+    ws_conn.stream.set_nodelay(True)  # as the kernel channel
+    return ws_conn, channel_id
+
+
+async def submit(ws_conn, channel_id, namespace):
+    """Send a cell along with the namespace, and wait for the acknowledgement.
+    Return the seconds elapsed up to the acknowledgement, once the result
+    of the cell is received."""
+    request_id = str(uuid4())
+    start = perf_counter()
+    packed_ns = pack_namespace(namespace, meta={'connection_id': channel_id,
+                                                REQUEST_ID: request_id})
+    await ws_conn.write_message(json.dumps({'connection_id': channel_id,
+                                            REQUEST_ID: request_id,
+                                            'nb_code_to_run_async': CELL,
+                                            'session': None}))
+    await write_chunked(ws_conn, packed_ns.to_parts())
+    reader = MessageReader()
+    elapsed = None
+    while True:
+        message = await ws_conn.read_message()
+        if message is None:
+            raise RuntimeError('Connection closed by the server')
+        if isinstance(message, str):
+            data = json.loads(message)
+            if data.get(REQUEST_ID) == request_id and data.get('ack', False):
+                elapsed = perf_counter() - start
+            continue
+        message = reader.feed(message)
+        if message is not None and \
+                PackedNamespace.from_buffer(message).meta.get(REQUEST_ID) == request_id:
+            if elapsed is None:  # e.g. rejected
+                raise RuntimeError('Cell not acknowledged by the server')
+            return elapsed
+
+
+async def latency(resolver, runs):
+    ws_conn, channel_id = await connect(resolver)
+    timings = list()
+    for _ in range(runs):
+        timings.append(await submit(ws_conn, channel_id, {'x': 1}) * 1000)
+    ws_conn.close()
+    return timings
+
+
+async def throughput(resolver, size, runs):
+    """Throughput (MB/s) of the submission of cells with `size` MB of namespace"""
+    ws_conn, channel_id = await connect(resolver)
+    namespace = {'payload': bytes(size << 20)}
+    elapsed = 0
+    for _ in range(runs):
+        elapsed += await submit(ws_conn, channel_id, namespace)
+    ws_conn.close()
+    return size * runs / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=500,
+                        help='Number of cells to submit to measure the latency')
+    parser.add_argument('-s', '--size', type=int, default=64,
+                        help='Size (MB) of the namespace to measure the throughput')
+    parser.add_argument('-r', '--repeat', type=int, default=10,
+                        help='Number of cells to submit to measure the throughput')
+    args = parser.parse_args()
+    if SERVER_SOCKET is None:
+        parser.error('Unix domain sockets are not available')
+
+    server = start_server(1)
+    try:
+        if server_socket() is None:
+            raise RuntimeError('The server does not listen on {}'.format(SERVER_SOCKET))
+        transports = [('tcp', None), ('unix', UnixSocketResolver(path=SERVER_SOCKET))]
+        io_loop = IOLoop.current()
+        # Warm-up (e.g. workers)
+        io_loop.run_sync(lambda: latency(None, 10))
+        for label, resolver in transports:
+            report(label, io_loop.run_sync(lambda: latency(resolver, args.runs)))
+        for label, resolver in transports:
+            rate = io_loop.run_sync(lambda: throughput(resolver, args.size, args.repeat))
+            print('{:<10} throughput: {:8.1f} MB/s ({} x {} MB)'.format(
+                label, rate, args.repeat, args.size))
+    finally:
+        server.terminate()
+        server.join()
@@ -0,0 +1,159 @@
+"""Startup benchmark of the server, with workers forked from the server
+process (modules imported by the first cell of each worker) vs workers
+forked from a template process which preloads the modules (see
+`settings.PRELOAD_MODULES`).
+
+For each mode, a brand-new server is started, and `-w` cells importing
+the modules are submitted at once: the time to the first result (and to
+all the results) is measured since the start of the server. Then, all
+the workers are replaced (i.e. their running cells are cancelled), and
+the time to the results of `-w` further cells is measured.
+
+    python -m benchmarks.bench_worker_startup [-m numpy pandas] [-w 2] [-r 3]
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+from importlib.util import find_spec
+from multiprocessing import Process
+from statistics import median
+from time import perf_counter, sleep
+from uuid import uuid4
+
+from tornado.websocket import websocket_connect
+
+from run_async.namespace import PackedNamespace, pack_namespace
+from run_async.run_server import AsyncRunServer
+from run_async.settings import PY_ROLE, REQUEST_ID
+from run_async.transport import MessageReader, write_chunked
+from run_async.utils import connection_string, format_ws_connection_id, server_request
+
+DEFAULT_MODULES = ['numpy', 'pandas', 'sklearn', 'torch']
+
+
+def _silent_server(pool_size, preload):
+    sys.stdout = open(os.devnull, 'w')
+    AsyncRunServer(pool_size=pool_size, preload=preload).run()
+
+
+def start_server(pool_size, preload):
+    """Start the server, and return it along with the seconds
+    elapsed until it answers"""
+    start = perf_counter()
+    server = Process(target=_silent_server, args=(pool_size, preload))
+    server.start()
+    while perf_counter() - start < 60:
+        try:
+            _ = server_request('ping', timeout=1)
+            return server, start
+        except OSError:
+            sleep(.01)
+    server.terminate()
+    raise RuntimeError('Server not started')
+
+
+async def connect():
+    channel_id = format_ws_connection_id(PY_ROLE, str(uuid4()))
+    ws_conn = await websocket_connect(
+        connection_string(web_socket=True, extra='ws/{}'.format(channel_id)))
+    ws_conn.stream.set_nodelay(True)
+    return ws_conn, channel_id
+
+
+async def submit(ws_conn, channel_id, cell):
+    request_id = str(uuid4())
+    packed_ns = pack_namespace({}, meta={'connection_id': channel_id,
+                                         REQUEST_ID: request_id})
+    await ws_conn.write_message(json.dumps({'connection_id': channel_id,
+                                            REQUEST_ID: request_id,
+                                            'nb_code_to_run_async': cell,
+                                            'session': None}))
+    await write_chunked(ws_conn, packed_ns.to_parts())
+    return request_id
+
+
+async def results(ws_conn, request_ids, start):
+    """Wait for the results of the requests, and return the seconds
+    elapsed (since `start`) until each result"""
+    reader = MessageReader()
+    waiting = set(request_ids)
+    timings = list()
+    while waiting:
+        message = await ws_conn.read_message()
+        if message is None:
+            raise RuntimeError('Connection closed by the server')
+        if isinstance(message, str):  # acknowledgements
+            continue
+        message = reader.feed(message)
+        if message is None:
+            continue
+        request_id = PackedNamespace.from_buffer(message).meta.get(REQUEST_ID)
+        if request_id in waiting:
+            waiting.discard(request_id)
+            timings.append(perf_counter() - start)
+    return timings
+
+
+async def measure(server_start, modules, workers):
+    cell = 'import {}'.format(', '.join(modules))
+    ws_conn, channel_id = await connect()
+    request_ids = [await submit(ws_conn, channel_id, cell) for _ in range(workers)]
+    timings = await results(ws_conn, request_ids, server_start)
+    first, last = timings[0], timings[-1]
+
+    # Replace all the workers, cancelling their (running) cells
+    request_ids = [await submit(ws_conn, channel_id, 'import time; time.sleep(60)')
+                   for _ in range(workers)]
+    await asyncio.sleep(1)
+    for request_id in request_ids:
+        await ws_conn.write_message(json.dumps({'connection_id': channel_id,
+                                                'cancel': request_id}))
+    _ = await results(ws_conn, request_ids, perf_counter())
+    start = perf_counter()
+    request_ids = [await submit(ws_conn, channel_id, cell) for _ in range(workers)]
+    replaced = (await results(ws_conn, request_ids, start))[-1]
+    ws_conn.close()
+    return first, last, replaced
+
+
+def run(modules, workers, preload):
+    server, start = start_server(workers, modules if preload else [])
+    try:
+        ready = perf_counter() - start
+        # A brand-new event loop (and connection) for each server
+        first, last, replaced = asyncio.run(measure(start, modules, workers))
+    finally:
+        server.terminate()
+        server.join()
+    return ready, first, last, replaced
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-m', '--modules', nargs='+', default=None,
+                        help='Modules imported by the cells (default: those installed '
+                             'among {})'.format(', '.join(DEFAULT_MODULES)))
+    parser.add_argument('-w', '--workers', type=int, default=2,
+                        help='Number of worker processes of the server')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Number of servers started for each mode')
+    args = parser.parse_args()
+    modules = args.modules
+    if modules is None:
+        modules = [module for module in DEFAULT_MODULES if find_spec(module) is not None]
+        if not modules:
+            parser.error('None of {} is installed: use -m'.format(', '.join(DEFAULT_MODULES)))
+
+    print('Modules: {}, {} workers'.format(', '.join(modules), args.workers))
+    print('{:<10} {:>10} {:>14} {:>14} {:>14}'.format(
+        '', 'ready', 'first result', 'all results', 'replaced'))
+    for label, preload in (('fork', False), ('preload', True)):
+        timings = [run(modules, args.workers, preload) for _ in range(args.repeat)]
+        print('{:<10} {:>8.3f} s {:>12.3f} s {:>12.3f} s {:>12.3f} s'.format(
+            label, *[median(phase) for phase in zip(*timings)]))
@@ -0,0 +1,260 @@
+"""Worker agents: standalone processes running async cells on their own pool
+of worker processes, possibly on other nodes, on behalf of the server.
+
+Agents connect to the server over TCP (i.e. a websocket), advertising their
+resources (cores, memory, and workers), and the server places each cell on
+the least loaded node, namely either its own worker pool or an agent (see
+`handlers.WorkerAgents`). The namespace of the cell is sent to the agent,
+along with the contents of its out-of-band buffers, and the result is sent
+back in the same way (see `namespace.export_namespace`).
+
+Several agents can run on the same host (e.g. the host of the server), and
+each one restarts its workers as they die or are cancelled, and connects
+again as soon as the server is available again::
+
+    python -m run_async.agents [--server ws://HOST:PORT] [--workers N] [--preload numpy]
+
+Agents run any cell (i.e. any code) the server sends them, and the server
+sends them the namespaces of the notebooks: agents on other nodes are only
+accepted if `RUN_ASYNC_AGENT_TOKEN` is set (to the same token) on the server
+and on the agents. With no token, the server only accepts the agents
+connected on a loopback address (i.e. running on its own host).
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import argparse
+import json
+import os
+import signal
+import socket
+from functools import partial
+
+try:
+    from tornado.ioloop import IOLoop
+    from tornado.locks import Lock
+    from tornado.websocket import websocket_connect, WebSocketClosedError
+    from tornado import gen
+except ImportError:
+    pass
+
+import psutil
+
+from .settings import AGENT_TOKEN, AGENT_RECONNECT_DELAY, REQUEST_ID
+from .settings import HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, PRELOAD_MODULES
+from .namespace import PackedNamespace, export_namespace, import_namespace
+from .shared_buffers import create_segment_dir, release_segments
+from .transport import MessageReader, TransferError, write_chunked
+from .utils import connection_string
+from .workers import WorkerPool, JobCancelled, preloading_context
+from .run_server import execute_cell, warm_up_worker
+
+
+class WorkerAgent:
+    """
+    Agent running the jobs (i.e. async cells) sent by the server
+    on its own pool of worker processes.
+
+    Jobs are received as packed namespaces (see `namespace.export_namespace`)
+    whose meta data hold the `request_id`, the `code` of the cell, its
+    `session` and the `serializers` of the kernel (see
+    `run_server.execute_cell`), and results are sent back likewise.
+    Progress (i.e. output streamed by the cell) and failures are sent as
+    JSON messages, and jobs are cancelled on request of the server.
+
+    Parameters
+    ----------
+    server_url : str (default: None)
+        Websocket URL of the server, e.g. ``ws://10.0.0.1:5678``. If None,
+        the server of the settings (see `settings.SERVER_ADDR`).
+    workers : int (default: None)
+        Number of worker processes. If None, the number of CPUs.
+    preload : list (default: `settings.PRELOAD_MODULES`)
+        The modules imported once in the template (forkserver) process
+        the workers are forked from.
+    token : str (default: `settings.AGENT_TOKEN`)
+        Token presented to the server (if required by the server).
+    """
+
+    def __init__(self, server_url=None, workers=None, preload=PRELOAD_MODULES,
+                 token=AGENT_TOKEN):
+        self.agent_id = '{}-{}'.format(socket.gethostname(), os.getpid())
+        if server_url is None:
+            server_url = connection_string(web_socket=True)
+        self.server_url = '{}/agents/{}'.format(server_url.rstrip('/'), self.agent_id)
+        self.workers = workers or os.cpu_count() or 1
+        self.preload = list(preload or ())
+        self.token = token
+        self.worker_pool = None
+        self.ws_conn = None
+        self._jobs = dict()  # request_id --> future of the job
+        self._write_lock = None
+        self._stopped = False
+
+    def start(self):
+        """Start the worker processes"""
+        mp_context = None
+        if self.preload:
+            mp_context = preloading_context([__package__ + '.run_server'] + self.preload)
+        self.worker_pool = WorkerPool(max_workers=self.workers, mp_context=mp_context,
+                                      initializer=warm_up_worker)
+        self.worker_pool.start()
+        # Out-of-band buffers of namespaces (and results) are written here
+        create_segment_dir()
+
+    def stop(self):
+        self._stopped = True
+        if self.ws_conn is not None:
+            self.ws_conn.close()
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown()
+
+    async def run(self):
+        """Serve the server (connecting again whenever disconnected),
+        until stopped"""
+        self._write_lock = Lock()
+        while not self._stopped:
+            try:
+                self.ws_conn = await websocket_connect(self.server_url,
+                                                       ping_interval=HEARTBEAT_INTERVAL,
+                                                       ping_timeout=HEARTBEAT_TIMEOUT)
+            except Exception as e:  # e.g. connection refused
+                print('Server not available ({}): retrying in {} seconds'.format(
+                    e, AGENT_RECONNECT_DELAY))
+                await gen.sleep(AGENT_RECONNECT_DELAY)
+                continue
+            print('Connected to ', self.server_url)
+            await self.ws_conn.write_message(json.dumps({'agent': self.resources()}))
+            await self._serve()
+            self.ws_conn = None
+            # Jobs of the former connection have failed on the server
+            for future in list(self._jobs.values()):
+                self.worker_pool.cancel(future, 'Server disconnected')
+            if not self._stopped:
+                print('Disconnected from the server')
+                await gen.sleep(AGENT_RECONNECT_DELAY)
+
+    def resources(self):
+        """Return the resources advertised to the server"""
+        return {'hostname': socket.gethostname(), 'pid': os.getpid(),
+                'cores': os.cpu_count(), 'memory': psutil.virtual_memory().total,
+                'workers': self.workers, 'token': self.token}
+
+    async def _serve(self):
+        reader = MessageReader()
+        while True:
+            message = await self.ws_conn.read_message()
+            if message is None:  # connection closed
+                return
+            if isinstance(message, str):
+                data = json.loads(message)
+                if 'cancel' in data:
+                    future = self._jobs.get(data['cancel'], None)
+                    if future is not None:
+                        self.worker_pool.cancel(future, data.get('reason', 'Job cancelled'))
+                elif 'rejected' in data:
+                    print('Rejected by the server: ', data['rejected'])
+                    self.stop()
+                continue
+            try:
+                message = reader.feed(message)
+            except TransferError as e:
+                print('Transfer failed: ', e)
+                self.ws_conn.close()
+                return
+            if message is not None:
+                self._run_job(PackedNamespace.from_buffer(message))
+
+    def _run_job(self, message):
+        """Run the job on a worker, with the out-of-band buffers of
+        its namespace written into segments of this node"""
+        meta = message.meta
+        request_id = meta[REQUEST_ID]
+        try:
+            packed_ns, handles = import_namespace(message)
+        except OSError as e:
+            self._write_json({REQUEST_ID: request_id,
+                              'error': 'Namespace not available: {}'.format(e)})
+            return
+        future = self.worker_pool.submit(execute_cell, meta['code'], packed_ns,
+                                         session=meta['session'],
+                                         serializers=meta['serializers'])
+        self._jobs[request_id] = future
+        io_loop = IOLoop.current()
+        # Output is streamed by the worker (from the pool thread)
+        future.add_progress_callback(partial(io_loop.add_callback, self._write_json,
+                                             {REQUEST_ID: request_id}))
+        io_loop.add_future(future, partial(self._job_done, request_id, handles))
+
+    def _job_done(self, request_id, handles, future):
+        # The namespace is owned by the agent (the server owns the original)
+        release_segments(handles)
+        if self._jobs.pop(request_id, None) is not future or future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            self._write_json({REQUEST_ID: request_id, 'error': str(error),
+                              'cancelled': isinstance(error, JobCancelled)})
+            return
+        result = future.result()
+        try:
+            message = export_namespace(result, meta={REQUEST_ID: request_id})
+        except OSError as e:
+            self._write_json({REQUEST_ID: request_id,
+                              'error': 'Result not available: {}'.format(e)})
+            return
+        finally:
+            # Buffers are sent along with the result
+            release_segments(PackedNamespace.from_buffer(result).segments)
+        IOLoop.current().spawn_callback(self._write_result, message.to_parts())
+
+    def _write_json(self, data, progress=None):
+        if progress is not None:
+            data = dict(data, progress=progress)
+        if self.ws_conn is not None:
+            try:
+                self.ws_conn.write_message(json.dumps(data))
+            except WebSocketClosedError:
+                pass
+
+    async def _write_result(self, parts):
+        """Write the result on the websocket, in frames (see `transport`).
+        Frames of different results are never interleaved."""
+        async with self._write_lock:
+            if self.ws_conn is None:
+                return
+            try:
+                await write_chunked(self.ws_conn, parts)
+            except WebSocketClosedError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Worker agent running async cells '
+                                                 'on behalf of the AsyncRunServer')
+    parser.add_argument('-s', '--server', default=None,
+                        help='Websocket URL of the server, e.g. ws://10.0.0.1:5678 '
+                             '(default: RUN_ASYNC_SERVER_ADDR and RUN_ASYNC_SERVER_PORT)')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('-p', '--preload', nargs='+', default=PRELOAD_MODULES, metavar='MODULE',
+                        help='Modules imported once, in the template process '
+                             'the workers are forked from')
+    args = parser.parse_args()
+
+    agent = WorkerAgent(args.server, args.workers, args.preload)
+    agent.start()
+    print('Worker agent {} ({} workers)'.format(agent.agent_id, agent.workers))
+    # SIGTERM stops the agent (and its workers) as SIGINT does
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        IOLoop.current().run_sync(agent.run)
+    except KeyboardInterrupt:
+        print('Stopping worker agent ', agent.agent_id)
+    finally:
+        agent.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,31 +7,38 @@
 from __future__ import print_function  # Python 2 compatibility
 
 import json
-from pickle import dumps as pickle_dumps
-from pickle import loads as pickle_loads
-from pickle import PicklingError
-## -- Python2
-# from six.moves.urllib.request import URLError, urlopen
-from urllib.request import URLError, urlopen
+import os
+from time import perf_counter
 from uuid import uuid4
 
-try:
-    from tornado.websocket import websocket_connect
-except ImportError:
-    pass
-
 from importlib import import_module
-from inspect import ismodule as inspect_ismodule
 
-from .settings import JS_ROLE, PY_ROLE, EXEC_OUTPUT
-from .settings import DEFAULT_BLACKLIST
+from .settings import JS_ROLE, EXEC_OUTPUT, REQUEST_ID
+from .settings import DELETED_NAMES, RESYNC_SESSION, JOB_REJECTED, MEMOIZED
+from .settings import JOB_PRIORITIES, DEFAULT_JOB_PRIORITY, TIMINGS, SERIALIZERS
+from .settings import DEFAULT_BLACKLIST, WORKER_POOL_SIZE, MAX_RUNNING_JOBS
+from .settings import PRELOAD_MODULES, EXECUTION_MODES, DEFAULT_EXECUTION_MODE
+from .settings import MAP_REDUCERS, DEFAULT_MAP_REDUCER, PROFILE_NAME
+from .settings import MEMO_CACHE_DIR
+from .settings import SERVER_STOP_TIMEOUT
 from .settings import JS_WEBSOCKET_CODE, LIGHT_HTML_OUTPUT_CELL
-from .utils import (strip_ansi_color,
-                    connection_string, format_ws_connection_id)
+from .utils import strip_ansi_color, server_request, format_ws_connection_id
+from .utils import update_output_cell, ServerAddress, server_address, set_server_address
+from .mapping import chunk_bounds, reduce_results
+from .namespace import (referenced_names, fingerprint, namespace_delta, cell_names,
+                        imported_names)
+from .namespace import pack_namespace, memo_key
+from .channel import KernelChannel
+from .threads import ThreadRunner
+from . import metrics
+from . import serializers
 
-from IPython.display import HTML
+from IPython.display import HTML, display
+from tornado.ioloop import IOLoop
 from IPython.core.magic import (Magics, magics_class, line_magic,
-                                line_cell_magic)
+                                cell_magic, line_cell_magic)
+from IPython.core.magic_arguments import (magic_arguments, argument,
+                                          parse_argstring)
 
 from .run_server import AsyncRunServer
 from threading import Thread
@@ -40,99 +47,376 @@ from threading import Thread
 import psutil
 
 
+THREAD_MODE = 'thread'
+
 # -------------------------
 # IPython (Line/Cell) Magic
 # -------------------------
 
-class WSConnector:
+class SessionSync:
+    """Notebook-side synchronisation state of the namespace.
+
+    Only names changed in the notebook since the last synchronisation are
+    sent to the server, and only names changed by the async cell are sent
+    back. The server keeps the full namespace either in a mirror of the
+    notebook namespace (which is sent to any worker executing the cell), or
+    (sticky sessions) resident in one worker process bound to the session.
+
+    Parameters
+    ----------
+    sticky : bool (default: False)
+        Whether the namespace is kept resident in a worker process
+        (i.e. a sticky session).
+    """
+
+    def __init__(self, sticky=False):
+        self.key = str(uuid4())
+        self.sticky = sticky
+        self.invalidate()
+
+    def invalidate(self):
+        """Force a full synchronisation of the namespace at the next cell"""
+        self.synced = dict()
+        self.sync_count = None
+        self.seq = 0
+
+    @property
+    def full_sync(self):
+        return self.sync_count is None
 
-    def __init__(self, connection_id, code_to_run, shell):
+    def delta(self, shell):
+        """Names changed (and deleted) in the notebook namespace
+        since the last synchronisation.
+
+        Besides names bound to new objects, names referenced by any
+        of the cells executed in the meanwhile are considered changed
+        as well, as those objects may have been changed in place.
+        """
+        if self.full_sync:
+            return set(shell.user_ns.keys()), set()
+        touched = set()
+        for source in shell.user_ns['_ih'][self.sync_count + 1:]:
+            names = referenced_names(shell, source)
+            if names is None:
+                touched = None
+                break
+            touched.update(names)
+        return namespace_delta(shell.user_ns, self.synced, touched)
+
+    def commit(self, shell, names, deleted=()):
+        """Record `names` as synchronised with the server"""
+        for name in names:
+            if name in shell.user_ns:
+                self.synced[name] = fingerprint(shell.user_ns[name])
+        for name in deleted:
+            _ = self.synced.pop(name, None)
+
+    def forget(self, names):
+        """Record `names` as not synchronised with the server
+        (i.e. to be sent again, even if not changed)"""
+        for name in names:
+            _ = self.synced.pop(name, None)
+
+
+class ValueDigests:
+    """Digests of the values of the notebook namespace read by memoized
+    cells (see `namespace.memo_key`), so that values are not pickled again
+    at each memoized cell, unless changed.
+
+    Like `SessionSync`, names referenced by any of the cells executed since
+    the last memoized cell are considered changed (i.e. digested again).
+    """
+
+    def __init__(self):
+        self.digests = dict()  # name --> (fingerprint, digest)
+        self.count = None
+
+    def current(self, shell):
+        """Return the digests of the values not changed since the
+        last memoized cell (see `memo_key`)"""
+        if self.count is not None:
+            for source in shell.user_ns['_ih'][self.count + 1:]:
+                names = referenced_names(shell, source)
+                if names is None:
+                    self.digests.clear()
+                    break
+                self.forget(names)
+        self.count = shell.execution_count
+        return self.digests
+
+    def forget(self, names):
+        """Digest the values of `names` again (e.g. changed in place)"""
+        for name in names:
+            _ = self.digests.pop(name, None)
+
+
+class CellRequest:
+    """Request of the (async) execution of a cell, sent to the
+    server on the kernel channel (see `channel.KernelChannel`)."""
+
+    def __init__(self, request_id, code_to_run, shell, session=None,
+                 priority=DEFAULT_JOB_PRIORITY, timeout=None,
+                 inputs=None, outputs=None, memoize=False, profile=None,
+                 digests=None):
         """
         Parameters
         ----------
-        connection_id: str
-            The unique ID of the connection to establish on the websocket.
+        request_id: str
+            The unique ID of the request (i.e. the session_id of the cell).
         code_to_run: str
             The content of the async cell to run_async_cell_execution
         shell: `IPython.core.interactiveshell.InteractiveShell`
             Instance of the current IPython shell running in the
             notebook.
+        session: `SessionSync` (default: None)
+            The synchronisation state of the notebook namespace. If None,
+            the whole namespace is sent.
+        priority: str (default: DEFAULT_JOB_PRIORITY)
+            The priority of the cell (one of JOB_PRIORITIES) in the
+            scheduler of the server.
+        timeout: float (default: None)
+            Seconds after which the execution of the cell is cancelled
+            (None: no timeout).
+        inputs: list (default: None)
+            Names read by the cell, besides those inferred from its source
+            (see `namespace.cell_names`), e.g. by `exec`.
+        outputs: list (default: None)
+            Names written by the cell, besides those inferred from its
+            source, e.g. objects changed by calling their methods.
+        memoize: bool (default: False)
+            Whether the result of the cell is memoized by the server, and
+            served (without running the cell) as long as the cell reads the
+            same values (see `namespace.memo_key`).
+        profile: dict (default: None)
+            Whether the cell is run under the profiler (see `profiling`),
+            namely the `name` the stats are set to, and the names of the
+            functions timed line by line (`lines`). Profiled cells
+            are never memoized.
+        digests: dict (default: None)
+            Digests of the values read by former memoized cells, reused by
+            the memoization key as long as the values do not change (see
+            `ValueDigests`).
         """
-        self.ws_conn = None
-        self.connection_id = connection_id
+        self.request_id = request_id
         self.cell_source = code_to_run
         self.shell = shell
         self.exec_count = shell.execution_count
+        self.session = session
+        self.priority = priority
+        self.timeout = timeout
+        self.reads, self.writes = self._infer_names(inputs, outputs)
+        # Modules imported by the cell (no dependency on other cells)
+        self.imports = imported_names(shell, code_to_run).difference(outputs or ())
+        self.profile = profile
+        self.memo_key = None
+        self._digests = digests
+        if memoize and profile is not None:
+            print('Cell not memoized: profiled cells are always run.')
+        elif memoize:
+            self.memo_key = self._memo_key()
+        self.sent = False
+        # Names sent (and deleted) along with the request
+        self._sent_names, self._sent_deleted = list(), list()
+        # Names (and reasons) of the objects that could not be
+        # sent to, or sent back from, the async execution
+        self.skipped = dict()
+        self.skipped_back = dict()
 
-    def connect(self):
-        """
-        Creates the connection to the Tornado Web Socket
-        """
-        # 'ws://localhost:5678/ws/<CONN_ID>'
-        conn_string = connection_string(web_socket=True,
-                                        extra='ws/{}'.format(self.connection_id))
-        websocket_connect(conn_string, callback=self.on_connected,
-                          on_message_callback=self.on_message)
-
-    def on_connected(self, f):
-        """Callback fired /on_connection/ established.
-
-        Once the connection to the websocket has been established,
-        all the currenct namespace is pickled and written to the
-        corresponding web_socket connection.
-        """
-        try:
-            ws_conn = f.result()
-            self.ws_conn = ws_conn
-            data = {'connection_id': self.connection_id,
-                    'nb_code_to_run_async': self.cell_source,}
-            msg = json.dumps(data)
-            ws_conn.write_message(message=msg)
-            white_ns = self._pack_namespace()
-            ws_conn.write_message(message=pickle_dumps(white_ns), binary=True)
-        except PicklingError as e:
-            print(str(e))
-
-    def _pack_namespace(self):
+    def message(self, channel_id, formats=None):
+        """Return the (JSON) header of the request, and the parts of its
+        (packed) namespace. Only the names changed since the last
+        synchronisation are sent, unless a full synchronisation
+        is required. Values are encoded in the `formats` the server can
+        decode, and the header tells the formats the kernel can decode."""
+        if self.sent and self.session is not None:
+            # The request (i.e. the delta of the namespace) may have been
+            # lost along with the connection
+            self.session.invalidate()
+        self.sent = True
+        data = {'connection_id': channel_id,
+                REQUEST_ID: self.request_id,
+                'nb_code_to_run_async': self.cell_source,
+                'priority': self.priority,
+                'timeout': self.timeout,
+                'kernel_pid': os.getpid(),
+                TIMINGS: metrics.drain(),
+                SERIALIZERS: {'formats': serializers.available_formats(),
+                              'encoders': serializers.encoders()},
+                'session': None}
+        names = self.reads
+        if self.session is not None:
+            full_sync = self.session.full_sync
+            if full_sync:
+                self.session.synced.clear()
+            names, deleted = self.session.delta(self.shell)
+            if self.reads is not None:
+                # Only the names read by the cell are sent: other
+                # changed names are sent as soon as a cell reads them
+                unsent = names.difference(self.reads)
+                names.intersection_update(self.reads)
+            self.session.seq += 1
+            data['session'] = self._session_header(full_sync, deleted)
+        packed_ns = self._pack_namespace(channel_id, names, formats)
+        if self.session is not None:
+            self._sent_names, self._sent_deleted = packed_ns.names, list(deleted)
+            self.session.commit(self.shell, packed_ns.names, deleted)
+            if self.reads is not None:
+                self.session.forget(unsent)
+            self.session.sync_count = self.exec_count
+        return json.dumps(data), packed_ns.to_parts()
+
+    def _session_header(self, full_sync, deleted):
+        """Return the session of the request, as sent to the
+        server (see `run_server.execute_cell`)"""
+        return {'key': self.session.key,
+                'sticky': self.session.sticky,
+                'full_sync': full_sync,
+                'seq': self.session.seq,
+                'deleted': list(deleted),
+                'inputs': self._as_list(self.reads),
+                'outputs': self._as_list(self.writes),
+                'imports': sorted(self.imports),
+                'memo_key': self.memo_key,
+                'profile': self.profile}
+
+    def _infer_names(self, inputs=None, outputs=None):
+        """Return the names read, and written, by the cell (None if
+        they cannot be inferred, i.e. all the names), along with the
+        `inputs` and `outputs` names given explicitly"""
+        inferred = cell_names(self.shell, self.cell_source)
+        if inferred is None:
+            return None, None
+        reads, writes, dynamic = inferred
+        if dynamic and inputs is None:
+            reads = None
+        elif inputs:
+            reads.update(inputs)
+        if dynamic and outputs is None:
+            writes = None
+        elif outputs:
+            writes.update(outputs)
+        return reads, writes
+
+    def _memo_key(self):
+        """Key of the result of the cell in the memoization cache of the
+        server (None if the cell cannot be memoized)"""
+        if self.reads is None:
+            print('Cell not memoized: the names it reads cannot be inferred '
+                  '(use --in).')
+            return None
+        reads = self.reads.difference(DEFAULT_BLACKLIST)
+        key = memo_key(self.cell_source, self.shell.user_ns, reads, self.writes,
+                       digests=self._digests)
+        if key is None:
+            print('Cell not memoized: the values it reads cannot be pickled.')
+        return key
+
+    @staticmethod
+    def _as_list(names):
+        return None if names is None else sorted(names)
+
+    def _pack_namespace(self, channel_id, names=None, formats=None):
         """Collect all the /pickable/ objects from the namespace
-        so to pass them to the async execution environment."""
-        white_ns = dict()
-        white_ns.setdefault('import_modules', list())
-        for k, v in self.shell.user_ns.items():
-            if not k in DEFAULT_BLACKLIST:
-                try:
-                    if inspect_ismodule(v):
-                        white_ns['import_modules'].append((k, v.__name__))
-                    else:
-                        _ = pickle_dumps({k: v})
-                        white_ns[k] = v
-                except PicklingError:
-                    continue
-                except Exception:
-                    continue
-        white_ns['connection_id'] = self.connection_id
-        return white_ns
-
-    def on_message(self, message):
-        """Callback fired /on_message/.
-
-        This hand of the web socket (Python side) will be
-        fired whenever the asynch execution is
-        completed.
+        so to pass them to the async execution environment.
+        If `names` is not None, only those names are collected.
+        Values are encoded in the `formats` the server can decode
+        (see `serializers`).
+
+        Returns
+        -------
+        `namespace.PackedNamespace`
+        """
+        start = perf_counter()
+        packed_ns = pack_namespace(self.shell.user_ns, names=names,
+                                   blacklist=DEFAULT_BLACKLIST,
+                                   meta={'connection_id': channel_id,
+                                         REQUEST_ID: self.request_id},
+                                   out_of_band=True, formats=formats)
+        metrics.record('pack', perf_counter() - start, packed_ns.nbytes)
+        self.skipped = packed_ns.skipped
+        return packed_ns
+
+    def on_ack(self):
+        pass
+
+    def on_error(self, message):
+        if self.sent and self.session is not None:
+            # The server may not have merged the namespace of the request
+            self.session.invalidate()
+        print('Async execution failed: ', message)
+
+    def on_result(self, packed_ns):
+        """Callback fired whenever the asynch execution is
+        completed, with the packed namespace sent back.
+
+        Returns
+        -------
+        bool : False if the request has to be sent again.
         """
-        if message is not None:
-            msg = dict(pickle_loads(message))
-            exec_output = None
-            if EXEC_OUTPUT in msg:
-                exec_output = msg.pop(EXEC_OUTPUT)
-
-            # Look for modules to Import
-            self._check_modules_import(msg)
-            # Update Output History
-            self._update_output_history(exec_output)
-            self.ws_conn.close()
-
-    def _check_modules_import(self, msg):
+        if not self._check_session(packed_ns):
+            return False
+        exec_output = packed_ns.meta.get(EXEC_OUTPUT, None)
+        deleted = packed_ns.meta.get(DELETED_NAMES, ())
+        self.skipped_back = packed_ns.skipped
+        # Segments of large buffers are owned by the server, unless the
+        # namespace is not mirrored by the server (i.e. sticky sessions)
+        release = self.session is None or self.session.sticky
+        with metrics.timed('unpack', packed_ns.nbytes):
+            msg = packed_ns.unpack(release=release)
+        self._report_skipped()
+
+        # Look for modules to Import
+        with metrics.timed('reimport'):
+            names = self._check_modules_import(msg, deleted)
+        memoized = packed_ns.meta.get(MEMOIZED, False)
+        if self.session is not None and memoized and self.session.sticky:
+            # The worker of the session did not run the cell, nor got the
+            # names sent along: they are sent again (or deleted) later
+            self.session.forget(self._sent_names + names)
+            self.session.synced.update(dict.fromkeys(self._sent_deleted + list(deleted)))
+        elif self.session is not None:
+            self.session.commit(self.shell, names, deleted)
+        # Update Output History
+        self._update_output_history(exec_output)
+        return True
+
+    def _check_session(self, packed_ns):
+        """Check whether the server kept the namespace sent along with
+        the cell: return False if the cell has to be sent again"""
+        if packed_ns.meta.get(RESYNC_SESSION, False):
+            # The server lost the namespace (e.g. it has been restarted,
+            # or the session worker has been replaced): send the cell
+            # again, with the full namespace
+            self.session.invalidate()
+            self.sent = False
+            return False
+        if packed_ns.meta.get(JOB_REJECTED, False) and self.session is not None:
+            # The namespace sent along with the cell may have been dropped
+            self.session.invalidate()
+        return True
+
+    def on_thread_result(self, values, deleted, exec_output):
+        """Callback fired whenever the execution of the cell in a thread
+        of the kernel is completed (see `threads.ThreadRunner`), with the
+        values of the names changed by the cell (modules included)."""
+        msg = dict(values)
+        msg['import_modules'] = None  # modules are among the values already
+        _ = self._check_modules_import(msg, deleted)
+        self._update_output_history(exec_output)
+
+    def _report_skipped(self):
+        """Print the names which could not be sent to the async execution
+        (among the names read by the cell, if known), or sent back from
+        it, along with the reasons"""
+        skipped = self.skipped
+        if self.reads is not None:
+            skipped = {name: reason for name, reason in skipped.items()
+                       if name in self.reads}
+        for label, skipped in (('to', skipped), ('back from', self.skipped_back)):
+            for name, reason in sorted(skipped.items()):
+                print('{} not sent {} the async cell: {}'.format(name, label, reason))
+
+    def _check_modules_import(self, msg, deleted=()):
         """
         Check if any module has been imported in the
         async cell. If that is the case, import
@@ -143,6 +427,12 @@ class WSConnector:
         ----------
         msg : dict
             Message dictionary returned by Async execution
+        deleted : list
+            Names deleted by the async execution.
+
+        Returns
+        -------
+        list : the names updated in the current namespace.
         """
         module_names = msg.pop('import_modules')
         modules = dict()
@@ -153,6 +443,9 @@ class WSConnector:
         self.shell.user_ns.update(msg)
         if modules:
             self.shell.user_ns.update(modules)
+        for name in deleted:
+            _ = self.shell.user_ns.pop(name, None)
+        return list(msg.keys()) + list(modules.keys())
 
     def _update_output_history(self, exec_output):
         """Update the Output history in the current
@@ -176,13 +469,193 @@ class WSConnector:
             _ = self.shell.user_ns.pop(out_cell_key_in_namespace, None)
 
 
+class ChunkRequest(CellRequest):
+    """Request of the execution of the cell of a map (see `MapJob`)
+    on one chunk of the iterable, namely its items from `start` to `stop`."""
+
+    def __init__(self, request_id, map_job, start, stop, **kwargs):
+        self.map_job = map_job
+        self.start, self.stop = start, stop
+        super(ChunkRequest, self).__init__(request_id, map_job.cell_source, map_job.shell,
+                                           session=map_job.session, **kwargs)
+
+    def _session_header(self, full_sync, deleted):
+        header = super(ChunkRequest, self)._session_header(full_sync, deleted)
+        header['map'] = {'iterable': self.map_job.iterable, 'start': self.start,
+                         'stop': self.stop, 'target': self.map_job.target}
+        return header
+
+    def on_result(self, packed_ns):
+        """Callback fired whenever the execution of the chunk is completed,
+        with the packed namespace holding the result of the chunk (if any)."""
+        if not self._check_session(packed_ns):
+            return False
+        target = self.map_job.target
+        # Results of chunks are not mirrored by the server, i.e.
+        # their segments are owned by the kernel
+        with metrics.timed('unpack', packed_ns.nbytes):
+            msg = packed_ns.unpack(release=True)
+        error = None
+        if target in packed_ns.skipped:
+            error = '{} not sent back: {}'.format(target, packed_ns.skipped[target])
+        elif target not in msg:
+            error = '{} not set'.format(target)
+        self.map_job.chunk_done(self, msg.get(target, None),
+                                packed_ns.meta.get(EXEC_OUTPUT, None) or '', error)
+        return True
+
+    def on_error(self, message):
+        if self.sent:
+            self.session.invalidate()
+        self.map_job.chunk_done(self, None, '', message)
+
+
+class MapJob:
+    """
+    Data-parallel execution of a cell (see `%%async_map`): the cell runs
+    once per chunk of the `iterable` (see `ChunkRequest`), in parallel on
+    the workers of the server, and the values the chunks set to the
+    `target` name are reduced (see `mapping.reduce_results`) into the
+    `target` name of the notebook namespace.
+
+    The namespace is sent once (along with the first chunk), and each
+    worker takes its own chunk out of the iterable. The output of the
+    chunks (in order of chunk), along with the progress of the map,
+    replaces the `LIGHT_HTML_OUTPUT_CELL` placeholder of the cell, whose
+    display ID is the `map_id`.
+
+    Parameters
+    ----------
+    map_id : str
+        The unique ID of the map.
+    cell_source : str
+        The content of the cell.
+    shell : `IPython.core.interactiveshell.InteractiveShell`
+        Instance of the current IPython shell running in the notebook.
+    session : `SessionSync`
+        The synchronisation state of the notebook namespace.
+    iterable : str
+        Name of the iterable the cell is mapped over.
+    target : str
+        Name set by the cell (for each chunk), and of the reduced result.
+    reducer : str (default: DEFAULT_MAP_REDUCER)
+        The reduction of the per-chunk results (see `mapping.reduce_results`).
+    on_completed : callable (default: None)
+        Called with the names changed (and deleted) by the map, once completed.
+    """
+
+    def __init__(self, map_id, cell_source, shell, session, iterable, target,
+                 reducer=DEFAULT_MAP_REDUCER, on_completed=None):
+        self.map_id = map_id
+        self.cell_source = cell_source
+        self.shell = shell
+        self.session = session
+        self.iterable = iterable
+        self.target = target
+        self.reducer = reducer
+        self.on_completed = on_completed
+        self.requests = list()
+        self.results = dict()  # request_id --> result of the chunk
+        self.outputs = dict()  # request_id --> output of the chunk
+        self.errors = dict()  # request_id --> reason of the failure
+
+    def chunk_requests(self, bounds, **kwargs):
+        """Return the requests of the chunks, one for each (start, stop)
+        bounds (see `mapping.chunk_bounds`)"""
+        self.requests = [ChunkRequest(str(uuid4()), self, start, stop, **kwargs)
+                         for start, stop in bounds]
+        return self.requests
+
+    def chunk_done(self, request, result, output, error=None):
+        """Record the result of the chunk (or the reason of its failure)"""
+        self.outputs[request.request_id] = output
+        if error is None:
+            self.results[request.request_id] = result
+        else:
+            self.errors[request.request_id] = error
+        if len(self.outputs) < len(self.requests):
+            progress = '[{}/{} chunks completed]\n'.format(len(self.outputs),
+                                                          len(self.requests))
+            update_output_cell(self.map_id, progress + self._output())
+        else:
+            self._reduce()
+
+    def _output(self):
+        return ''.join(self.outputs.get(request.request_id, '')
+                       for request in self.requests)
+
+    def _reduce(self):
+        """Reduce the results of the chunks into the target name"""
+        output = self._output()
+        for index, request in enumerate(self.requests):
+            if request.request_id in self.errors:
+                output += 'Chunk {} ({}[{}:{}]) failed: {}\n'.format(
+                    index, self.iterable, request.start, request.stop,
+                    self.errors[request.request_id])
+        if self.errors:
+            output += '{} not set\n'.format(self.target)
+        else:
+            results = [self.results[request.request_id] for request in self.requests]
+            try:
+                value = reduce_results(results, self.reducer, self.shell.user_ns)
+            except Exception as e:
+                output += 'Reduction of {} failed: {}: {}\n'.format(
+                    self.target, type(e).__name__, e)
+            else:
+                self.shell.user_ns[self.target] = value
+                if self.on_completed is not None:
+                    self.on_completed([self.target], ())
+        self.requests[0]._update_output_history(output)
+        update_output_cell(self.map_id, output)
+
+
 @magics_class
 class AsyncRunMagic(Magics):
 
     def __init__(self, shell, **kwargs):
         super(AsyncRunMagic, self).__init__(shell, **kwargs)
         self._server_process = None
-        
+        self._namespace_sync = SessionSync()
+        self._sticky_session = SessionSync(sticky=True)
+        self._value_digests = ValueDigests()
+        self._channel = None
+        self._thread_runner = None
+
+    @magic_arguments()
+    @argument('-s', '--session', action='store_true',
+              help='Run the cell in the sticky session of the notebook: the '
+                   'namespace is kept in memory by the same worker across cells '
+                   '(requires a server of at least 2 workers).')
+    @argument('-f', '--full-sync', action='store_true',
+              help='Send the whole namespace, rather than only the names '
+                   'changed since the last async cell.')
+    @argument('-p', '--priority', choices=JOB_PRIORITIES, default=DEFAULT_JOB_PRIORITY,
+              help='Priority of the cell, among the cells waiting to run '
+                   '(default: {}).'.format(DEFAULT_JOB_PRIORITY))
+    @argument('-t', '--timeout', type=float, default=None,
+              help='Seconds after which the execution of the cell is cancelled.')
+    @argument('-i', '--in', dest='inputs', nargs='+', default=None, metavar='NAME',
+              help='Names read by the cell, besides those inferred from its source '
+                   '(e.g. by `exec`, `globals()` or magics).')
+    @argument('-o', '--out', dest='outputs', nargs='+', default=None, metavar='NAME',
+              help='Names written by the cell, besides those inferred from its source '
+                   '(e.g. objects changed in place by calling their methods).')
+    @argument('-m', '--memoize', action='store_true',
+              help='Memoize the result of the cell: as long as the cell reads the same '
+                   'values, its output and namespace changes are served by the server '
+                   'without running it again.')
+    @argument('--profile', nargs='?', const=PROFILE_NAME, default=None, metavar='NAME',
+              help='Run the cell under the profiler: its stats (top functions by '
+                   'cumulative time) are appended to the output, and set to NAME '
+                   '(default: {}).'.format(PROFILE_NAME))
+    @argument('--profile-lines', nargs='+', default=None, metavar='FUNCTION',
+              help='Names of the functions timed line by line, when the cell is '
+                   'profiled (implies --profile).')
+    @argument('--mode', choices=EXECUTION_MODES, default=DEFAULT_EXECUTION_MODE,
+              help='Run the cell in a worker process of the server, or in a thread of '
+                   'the kernel, against a snapshot of the namespace (i.e. with no round '
+                   'trip to the server: for cells mostly waiting on I/O; '
+                   'default: {}).'.format(DEFAULT_EXECUTION_MODE))
     @line_cell_magic
     def async_run(self, line, cell=None):
         """Run code into cell asynchronously
@@ -191,38 +664,381 @@ class AsyncRunMagic(Magics):
         """
         if cell is None:
             code_to_run = line
+            args = parse_argstring(self.async_run, '')
         else:
             code_to_run = cell
+            args = parse_argstring(self.async_run, line)
+        if args.mode == THREAD_MODE:
+            return self._run_in_thread(code_to_run, args)
+        session = self._sticky_session if args.session else self._namespace_sync
+        if args.full_sync:
+            session.invalidate()
+
+        session_id = str(uuid4())
+        self._connect()
+        self._channel.submit(CellRequest(session_id, code_to_run, self.shell,
+                                         session=session, priority=args.priority,
+                                         timeout=args.timeout, inputs=args.inputs,
+                                         outputs=args.outputs, memoize=args.memoize,
+                                         profile=self._profile(args),
+                                         digests=self._digests(args)))
+
+        html_output = LIGHT_HTML_OUTPUT_CELL.format(session_id=session_id)
+        js_code = JS_WEBSOCKET_CODE.replace('__sessionid__', session_id)
+        js_code = js_code.replace('__connection_id__', format_ws_connection_id(JS_ROLE,
+                                                                               session_id))
+        js_code = js_code.replace('__port__', str(server_address().port))
+        html_output += js_code
+        return HTML(html_output)
+
+    def _connect(self):
+        """Create the kernel channel (see `channel.KernelChannel`) at first.
+        Requests fail on the channel if the server is not running."""
+        if self._channel is None:
+            self._channel = KernelChannel()
+
+    def _digests(self, args):
+        """Return the digests of the values read by memoized cells
+        (see `ValueDigests`), if the cell is memoized"""
+        if not args.memoize:
+            return None
+        return self._value_digests.current(self.shell)
 
+    @staticmethod
+    def _profile(args):
+        """Return the profile of the cell (see `CellRequest`), if profiled"""
+        if args.profile is None and args.profile_lines is None:
+            return None
+        return {'name': args.profile or PROFILE_NAME,
+                'lines': list(args.profile_lines or ())}
+
+    def _run_in_thread(self, code_to_run, args):
+        """Run the cell in a thread of the kernel (see `threads.ThreadRunner`)"""
+        if (args.session or args.memoize or args.timeout is not None or
+                self._profile(args) is not None):
+            print('--session, --memoize, --timeout and --profile are not supported '
+                  'with --mode {}'.format(THREAD_MODE))
+            return
+        if self._thread_runner is None:
+            self._thread_runner = ThreadRunner()
         session_id = str(uuid4())
-        connection_id = format_ws_connection_id(PY_ROLE, session_id)
+        request = CellRequest(session_id, code_to_run, self.shell,
+                              inputs=args.inputs, outputs=args.outputs)
+        display(HTML(LIGHT_HTML_OUTPUT_CELL.format(session_id=session_id)),
+                display_id=session_id)
+        self._thread_runner.submit(request, on_merged=self._forget_synced)
+
+    def _forget_synced(self, names, deleted):
+        """Names changed by the kernel itself (i.e. by cells run in threads,
+        or by maps) are sent again to the server (even if changed in place)"""
+        for session in (self._namespace_sync, self._sticky_session):
+            session.forget(names)
+        self._value_digests.forget(names)
+
+    @magic_arguments()
+    @argument('iterable',
+              help='Name of the iterable the cell is mapped over: the cell sees each '
+                   'chunk of the iterable in its place.')
+    @argument('--into', required=True, metavar='TARGET',
+              help='Name set by the cell for each chunk: the values of all the chunks '
+                   'are reduced into the same name of the namespace.')
+    @argument('-c', '--chunk-size', type=int, default=None,
+              help='Number of items of each chunk (default: the iterable is split '
+                   'evenly among the workers of the server).')
+    @argument('-r', '--reduce', default=DEFAULT_MAP_REDUCER, metavar='REDUCER',
+              help='Reduction of the values of the chunks: one of {}, or the name of a '
+                   'function of the namespace, called on pairs of values '
+                   '(default: {}).'.format(', '.join(MAP_REDUCERS), DEFAULT_MAP_REDUCER))
+    @argument('-p', '--priority', choices=JOB_PRIORITIES, default=DEFAULT_JOB_PRIORITY,
+              help='Priority of the chunks, among the cells waiting to run '
+                   '(default: {}).'.format(DEFAULT_JOB_PRIORITY))
+    @argument('-t', '--timeout', type=float, default=None,
+              help='Seconds after which the execution of each chunk is cancelled.')
+    @argument('-i', '--in', dest='inputs', nargs='+', default=None, metavar='NAME',
+              help='Names read by the cell, besides those inferred from its source.')
+    @cell_magic
+    def async_map(self, line, cell):
+        """Run the cell over the chunks of an iterable, in parallel on the
+        workers of the server, and reduce the values the chunks set to
+        the target name
+            Usage:\\
+              %%async_map <iterable> --into <target> [-c N] [-r REDUCER]
+        """
+        args = parse_argstring(self.async_map, line)
+        user_ns = self.shell.user_ns
+        if args.iterable not in user_ns:
+            print('{} not found in the namespace'.format(args.iterable))
+            return
+        try:
+            size = len(user_ns[args.iterable])
+        except TypeError:
+            print('{} has no length: use a sequence (e.g. a list)'.format(args.iterable))
+            return
+        if args.reduce not in MAP_REDUCERS and not callable(user_ns.get(args.reduce, None)):
+            print('Unknown reducer: {} (not a function of the namespace)'.format(args.reduce))
+            return
+        if not size:
+            print('{} is empty'.format(args.iterable))
+            return
+        self._connect()
+        map_id = str(uuid4())
+        map_job = MapJob(map_id, cell, self.shell, self._namespace_sync, args.iterable,
+                         args.into, args.reduce, on_completed=self._forget_synced)
+        display(HTML(LIGHT_HTML_OUTPUT_CELL.format(session_id=map_id)), display_id=map_id)
+        if args.chunk_size is not None and args.chunk_size > 0:
+            self._submit_map(map_job, size, args.chunk_size, args)
+            return
+        # Split evenly among the workers of the server, as told on
+        # the handshake of the channel (i.e. without blocking the kernel)
+        handshake = self._channel.handshake()
+        IOLoop.current().add_future(handshake, lambda future: self._on_handshake(
+            future, map_job, size, args))
+
+    def _on_handshake(self, future, map_job, size, args):
+        """Submit the chunks of the map, once the number of workers
+        of the server is known"""
+        try:
+            channel = future.result()
+        except Exception as e:
+            update_output_cell(map_job.map_id, 'Connection to server refused ({}). '
+                                               'Use %async_run_server first!'.format(e))
+            return
+        workers = max(1, channel.workers or 1)
+        self._submit_map(map_job, size, -(-size // workers), args)  # i.e. rounded up
+
+    def _submit_map(self, map_job, size, chunk_size, args):
+        inputs = [args.iterable] + (args.inputs or [])
+        for request in map_job.chunk_requests(chunk_bounds(size, chunk_size),
+                                              priority=args.priority, timeout=args.timeout,
+                                              inputs=inputs, outputs=[args.into]):
+            self._channel.submit(request)
+
+    @magic_arguments()
+    @argument('session_id', nargs='*',
+              help='IDs of the async cells to cancel (default: the last async cell).')
+    @argument('-a', '--all', action='store_true',
+              help='Cancel all the async cells of the notebook.')
+    @line_magic
+    def async_cancel(self, line):
+        """Cancel async cells, waiting to run or running (their worker
+        process is killed, and replaced)
+            Usage:\\
+              %async_cancel [-a] [session_id ...]
+        """
+        args = parse_argstring(self.async_cancel, line)
+        pending = [] if self._channel is None else self._channel.requests
+        threaded = [] if self._thread_runner is None else self._thread_runner.requests
+        pending += threaded
+        if args.all:
+            to_cancel = pending
+        elif args.session_id:
+            to_cancel = args.session_id
+        else:
+            to_cancel = pending[-1:]
+        if not to_cancel:
+            print('No async cell to cancel')
+        for session_id in to_cancel:
+            if session_id not in pending:
+                print('No pending async cell ', session_id)
+            elif session_id in threaded:
+                if not self._thread_runner.cancel(session_id):
+                    print('Async cell running in a thread cannot be cancelled ', session_id)
+            else:
+                self._channel.cancel(session_id)
+
+    def _server_status(self):
+        """Return the status of the server (see `run_server.StatusRequestHandler`),
+        or None if the server is not running"""
         try:
-            _ = urlopen(connection_string(web_socket=False, extra='ping'))
-        except URLError:
+            response = server_request('status')
+        except OSError:
             print("Connection to server refused!", end='  ')
             print("Use %async_run_server first!")
-        else:
-            connector = WSConnector(connection_id, code_to_run, self.shell)
-            connector.connect()
+            return None
+        return json.loads(response.decode('utf-8'))
+
+    @staticmethod
+    def _format_usage(usage):
+        if usage['rss'] is None:
+            return '{:>7} {:>10}'.format('-', '-')
+        return '{:>6.1f}% {:>7.1f} MB'.format(usage['cpu_percent'], usage['rss'] / (1 << 20))
 
-            html_output = LIGHT_HTML_OUTPUT_CELL.format(session_id=session_id)
-            js_code = JS_WEBSOCKET_CODE.replace('__sessionid__', session_id)
-            js_code = js_code.replace('__connection_id__', format_ws_connection_id(JS_ROLE,
-                                                                                   session_id))
-            html_output += js_code
-            return HTML(html_output)
+    @magic_arguments()
+    @argument('-a', '--all', action='store_true',
+              help='List the jobs of all the notebooks (default: this notebook only).')
+    @line_magic
+    def async_jobs(self, line):
+        """List the async cells (jobs) blocked (i.e. waiting for the cells
+        they depend on), queued, running, and completed by the server,
+        along with their timings
+            Usage:\\
+              %async_jobs [-a]
+        """
+        args = parse_argstring(self.async_jobs, line)
+        status = self._server_status()
+        if status is None:
+            return
+        channel_id = None if self._channel is None else self._channel.channel_id
+        jobs = [job for job in status['jobs'] if args.all or job['notebook'] == channel_id]
+        if not jobs:
+            print('No async cell')
+            return
+        workers = {worker['pid']: worker for worker in status['workers']}
+        print('{:<36}  {:<9}  {:<6}  {:>8}  {:>8}  {:>7}  {:>7} {:>10}'.format(
+            'ID', 'State', 'Prio', 'Wait', 'Run', 'PID', 'CPU', 'RSS'))
+        for job in jobs:
+            run_time = '-' if job['run_time'] is None else '{:.1f}s'.format(job['run_time'])
+            usage = '{:>7} {:>10}'.format('-', '-')
+            if job['state'] == 'running' and job['pid'] in workers:
+                usage = self._format_usage(workers[job['pid']])
+            print('{:<36}  {:<9}  {:<6}  {:>8}  {:>8}  {:>7}  {}{}'.format(
+                job['request_id'], job['state'], job['priority'],
+                '{:.1f}s'.format(job['wait_time']), run_time,
+                job['pid'] or '-', usage,
+                '' if job['notebook'] == channel_id else '  ({})'.format(job['notebook'])))
+            if job['state'] == 'blocked':
+                print('  waiting for {}'.format(', '.join(job.get('depends_on', ()))))
+            elif job.get('agent', None) is not None:
+                print('  on worker agent {}'.format(job['agent']))
+
+    @line_magic
+    def async_status(self, line):
+        """Show the status of the server: its workers (along with their CPU
+        and memory usage), the worker agents, the scheduler, and the usage
+        of each notebook
+            Usage:\\
+              %async_status
+        """
+        status = self._server_status()
+        if status is None:
+            return
+        server, scheduler = status['server'], status['scheduler']
+        print('Server PID {} (up {:.0f}s) {}'.format(server['pid'], server['uptime'],
+                                                      self._format_usage(server)))
+        print('Jobs: {} running (max {}), {} queued'.format(
+            scheduler['running'], scheduler['max_running'], scheduler['queued']))
+        memo_cache = status['memo_cache']
+        print('Memoized results: {} ({:.1f} MB in memory, {:.1f} MB on disk), '
+              '{} hits, {} misses'.format(memo_cache['entries'], memo_cache['nbytes'] / 2**20,
+                                          memo_cache['disk_nbytes'] / 2**20,
+                                          memo_cache['hits'], memo_cache['misses']))
+        print()
+        print('{:>7}  {:>7} {:>10}  {:<36}  {}'.format('Worker', 'CPU', 'RSS', 'Job', 'Notebook'))
+        for worker in status['workers']:
+            notebook = worker['notebook'] or '-'
+            if worker['sticky_session'] is not None:
+                notebook += ' (sticky session)'
+            print('{:>7}  {}  {:<36}  {}'.format(worker['pid'], self._format_usage(worker),
+                                                 worker['request_id'] or '-', notebook))
+        agents = status.get('agents', ())
+        if agents:
+            print()
+            print('{:<36}  {:>7}  {:>5}  {:>10}  {:>7}'.format('Agent', 'Workers', 'Cores',
+                                                               'Memory', 'Running'))
+            for agent in agents:
+                print('{:<36}  {:>7}  {:>5}  {:>7.1f} GB  {:>7}'.format(
+                    agent['agent_id'], agent['workers'], agent['cores'] or '-',
+                    (agent['memory'] or 0) / (1 << 30), len(agent['running'])))
+        print()
+        channel_id = None if self._channel is None else self._channel.channel_id
+        print('{:<45}  {:>10}  {:>7}  {:>6}  {:>7} {:>10}'.format(
+            'Notebook', 'Kernel PID', 'Running', 'Queued', 'CPU', 'RSS'))
+        notebooks = sorted(status['notebooks'].items(),
+                           key=lambda item: item[1]['cpu_percent'], reverse=True)
+        for connection_id, notebook in notebooks:
+            if connection_id == channel_id:
+                connection_id += ' *'
+            print('{:<45}  {:>10}  {:>7}  {:>6}  {}'.format(
+                connection_id, notebook['kernel_pid'] or '-', notebook['running'],
+                notebook['queued'], self._format_usage(notebook)))
+
+    @magic_arguments()
+    @argument('-s', '--select', nargs=2, action='append', default=[],
+              metavar=('TYPE', 'SERIALIZER'),
+              help='Encode the values of the type (qualified name, e.g. '
+                   'numpy.ndarray) with the serializer (pickle: no encoder).')
+    @line_magic
+    def async_serializers(self, line):
+        """List the serializers of the values sent to (and back from) async
+        cells, along with the values they encoded and decoded (in this
+        kernel) and the time spent, and select the encoders by type
+            Usage:\\
+              %async_serializers [-s TYPE SERIALIZER]
+        """
+        args = parse_argstring(self.async_serializers, line)
+        for type_name, name in args.select:
+            try:
+                serializers.select(type_name, None if name == serializers.PICKLE else name)
+            except ValueError as e:
+                print(e)
+        available = serializers.available_formats()
+        stats = serializers.stats()
+        print('{:<12}  {:>9}  {:>8}  {:>10}  {:>8}  {:>10}  {:>10}'.format(
+            'Serializer', 'Available', 'Encoded', 'Encode', 'Decoded', 'Decode', 'Size'))
+        for name in serializers.registered():
+            entry = stats[name]
+            print('{:<12}  {:>9}  {:>8}  {:>9.3f}s  {:>8}  {:>9.3f}s  {:>7.1f} MB'.format(
+                name, 'yes' if name in available else 'no',
+                entry['encoded'], entry['encode_time'],
+                entry['decoded'], entry['decode_time'], entry['nbytes'] / 2**20))
+        print()
+        print('{:<40}  {}'.format('Type', 'Encoder'))
+        for type_name, name in sorted(serializers.encoders().items()):
+            if name not in available:
+                name += ' (not available: pickle)'
+            print('{:<40}  {}'.format(type_name, name))
 
     def _spawn_server_process(self):
         self._server_process.start()
         print('Process Started with PID ', self._server_process.pid)
         self._server_process.join()
 
+    @magic_arguments()
+    @argument('-w', '--workers', type=int, default=WORKER_POOL_SIZE,
+              help='Number of worker processes executing the async cells '
+                   '(default: number of CPUs).')
+    @argument('-r', '--max-running', type=int, default=MAX_RUNNING_JOBS,
+              help='Maximum number of async cells running at once, further '
+                   'cells wait in the queue (default: number of workers).')
+    @argument('-c', '--memo-dir', default=MEMO_CACHE_DIR,
+              help='Folder the results of memoized cells are persisted in, across '
+                   'restarts of the server (default: results kept in memory only).')
+    @argument('-l', '--preload', nargs='+', default=PRELOAD_MODULES, metavar='MODULE',
+              help='Modules imported once in the template process the workers are '
+                   'forked from, so that workers start with them already imported '
+                   '(e.g. numpy pandas).')
+    @argument('--addr', default=None,
+              help='Host the server listens on (default: RUN_ASYNC_SERVER_ADDR, '
+                   'or 127.0.0.1).')
+    @argument('--port', type=int, default=None,
+              help='HTTP port of the server, e.g. to run several servers side by '
+                   'side (default: RUN_ASYNC_SERVER_PORT, or 5678).')
+    @argument('--socket', default=None, metavar='PATH',
+              help='Unix domain socket the kernel connects to the server on '
+                   '(default: RUN_ASYNC_SERVER_SOCKET, if set; "" for TCP only).')
     @line_magic
     def async_start_server(self, line):
+        args = parse_argstring(self.async_start_server, line)
         if (not self._server_process is None) and (self._server_process.is_alive()):
             print("Cannot Start process twice")
         else:
-            self._server_process = AsyncRunServer()
+            # The kernel connects to the server at its (new) address from now on
+            current = server_address()
+            address = ServerAddress(args.addr or current.addr, args.port or current.port,
+                                    current.socket_path if args.socket is None else args.socket)
+            set_server_address(address)
+            if self._channel is not None:
+                self._channel.close()
+                self._channel = None
+            workers = args.workers or os.cpu_count() or 1
+            if workers < 2:
+                print('Sticky sessions (%async_run --session) are not available '
+                      'with a single worker: use --workers 2 (or more).')
+            self._server_process = AsyncRunServer(pool_size=args.workers,
+                                                  max_running=args.max_running,
+                                                  memo_dir=args.memo_dir,
+                                                  preload=args.preload,
+                                                  address=address)
             th_runner = Thread(target=self._spawn_server_process,
                                daemon=True)
             th_runner.start()
@@ -232,13 +1048,21 @@ class AsyncRunMagic(Magics):
         if self._server_process is None or not self._server_process.is_alive():
             print('No Server is Running')
         else:
+            if self._channel is not None:
+                self._channel.close()
+                self._channel = None
             print("Killing SIGINT to PID ", self._server_process.pid)
-            while self._server_process.is_alive():
-                try:
-                    p = psutil.Process(self._server_process.pid)
-                    p.terminate()  # or p.kill()
-                except ProcessLookupError:
-                    pass
-            else:
-                self._server_process = None
+            try:
+                p = psutil.Process(self._server_process.pid)
+                p.terminate()
+            except (ProcessLookupError, psutil.NoSuchProcess):
+                pass
+            # The server is stopped gracefully (i.e. releasing its workers
+            # and shared resources), unless it takes too long
+            self._server_process.join(SERVER_STOP_TIMEOUT)
+            if self._server_process.is_alive():
+                print('Server not stopped in time: killing PID ', self._server_process.pid)
+                self._server_process.kill()
+                self._server_process.join()
+            self._server_process = None
 
@@ -0,0 +1,323 @@
+"""Persistent, multiplexed connection of the notebook kernel to the server
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import json
+import logging
+import socket
+from collections import OrderedDict
+from uuid import uuid4
+
+try:
+    from tornado.websocket import websocket_connect, WebSocketClosedError
+    from tornado.concurrent import Future
+    from tornado.ioloop import IOLoop
+    from tornado.locks import Lock
+    from tornado.netutil import Resolver
+except ImportError:
+    Resolver = object
+
+from .settings import PY_ROLE, REQUEST_ID, FORMATS_HEADER, WORKERS_HEADER
+from .settings import (HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, RECONNECT_DELAY,
+                       RECONNECT_MAX_DELAY, RECONNECT_ATTEMPTS)
+from .utils import format_ws_connection_id, server_address
+from .namespace import PackedNamespace
+from .serializers import PICKLE
+from .transport import MessageReader, TransferError, write_chunked
+
+logger = logging.getLogger(__name__)
+
+
+class UnixSocketResolver(Resolver):
+    """Resolver of any address to the Unix domain socket at `path`,
+    so that (websocket) clients connect to the server on the socket"""
+
+    def initialize(self, path):
+        self.path = path
+
+    async def resolve(self, host, port, family=socket.AF_UNSPEC):
+        return [(socket.AF_UNIX, self.path)]
+
+
+class KernelChannel:
+    """
+    Websocket connection of the kernel to the `AsyncRunServer`, shared by
+    all the async cells of the notebook (i.e. opened once, rather than once
+    per cell).
+
+    Requests are multiplexed on the channel, each one identified by
+    its `request_id`, and the server acknowledges each request as soon as
+    its execution is scheduled (or fails it, e.g. if its namespace could
+    not be received). Heartbeats (i.e. websocket pings) detect
+    broken connections: the channel connects again (as long as there are
+    pending requests), and sends again the requests not acknowledged yet.
+    If the server is not running (i.e. the connection is refused), the
+    requests not acknowledged yet fail at once.
+    The channel connects to the Unix domain socket of the server, if the
+    server listens on one (see `utils.ServerAddress`). The server tells
+    the formats it can decode (see `serializers`), and its number of
+    workers, on the handshake (see `handshake`).
+
+    Requests are objects providing:
+
+    * ``request_id`` : str
+    * ``message(channel_id, formats)`` : returning the JSON (str) header,
+      and the parts of the packed namespace of the request, whose values
+      are encoded in the `formats` the server can decode;
+    * ``on_ack()`` : called once the request has been acknowledged;
+    * ``on_result(packed_ns)`` : called with the packed namespace sent
+      back by the server, returning False if the request has to be sent
+      again (e.g. full synchronisation of the namespace required);
+    * ``on_error(message)`` : called if the request could not be sent,
+      or failed on the server, or its result could not be received.
+
+    Parameters
+    ----------
+    channel_id : str (default: None)
+        The connection ID of the channel. If None, a brand new
+        <PY_ROLE>---<uuid> connection ID is used.
+    address : `utils.ServerAddress` (default: None)
+        The address of the server. If None, the current address of the
+        server (see `utils.server_address`), read on each connection.
+    """
+
+    def __init__(self, channel_id=None, address=None):
+        if channel_id is None:
+            channel_id = format_ws_connection_id(PY_ROLE, str(uuid4()))
+        self.channel_id = channel_id
+        self.address = address
+        self.ws_conn = None
+        self.formats = [PICKLE]  # formats the server can decode
+        self.workers = None  # number of workers of the server
+        self._handshakes = list()  # futures resolved once connected
+        self._connecting = False
+        self._closed = False
+        self._attempts = 0
+        self._requests = OrderedDict()  # request_id --> pending request
+        self._unacked = set()
+        self._cancelled = set()  # to be sent again upon reconnection
+        self._reader = MessageReader()
+        self._receiving = None  # request whose result is being received
+        self._write_lock = Lock()
+
+    @property
+    def connected(self):
+        return self.ws_conn is not None
+
+    @property
+    def pending(self):
+        return len(self._requests)
+
+    @property
+    def requests(self):
+        """IDs of the pending requests (in order of submission)"""
+        return list(self._requests.keys())
+
+    def submit(self, request):
+        """Send the request as soon as the channel is connected"""
+        self._requests[request.request_id] = request
+        self._unacked.add(request.request_id)
+        if self.connected:
+            IOLoop.current().spawn_callback(self._send, request)
+        else:
+            self.connect()
+
+    def cancel(self, request_id):
+        """Ask the server to cancel the (pending) request, whose result
+        (i.e. the cancellation) is then received as usual.
+
+        Returns
+        -------
+        bool : False if the request is not pending.
+        """
+        if request_id not in self._requests:
+            return False
+        self._cancelled.add(request_id)
+        if self.connected:
+            IOLoop.current().spawn_callback(self._send_cancel, request_id)
+        return True
+
+    def handshake(self):
+        """Return a Future resolved with the channel once connected to the
+        server (i.e. with the `formats` and `workers` of the server), or
+        failed if the server cannot be reached"""
+        future = Future()
+        if self.connected:
+            future.set_result(self)
+            return future
+        self._handshakes.append(future)
+        self.connect()
+        return future
+
+    def connect(self):
+        if self._closed or self._connecting or self.connected:
+            return
+        self._connecting = True
+        address = self.address or server_address()
+        conn_string = address.connection_string(web_socket=True,
+                                                extra='ws/{}'.format(self.channel_id))
+        path = address.unix_socket()
+        resolver = None if path is None else UnixSocketResolver(path=path)
+        future = websocket_connect(conn_string, on_message_callback=self.on_message,
+                                   ping_interval=HEARTBEAT_INTERVAL,
+                                   ping_timeout=HEARTBEAT_TIMEOUT,
+                                   resolver=resolver)
+        IOLoop.current().add_future(future, self._on_connected)
+
+    def close(self):
+        self._closed = True
+        for request in self._requests.values():
+            request.on_error('Connection to the server closed')
+        self._requests.clear()
+        self._unacked.clear()
+        self._cancelled.clear()
+        self._fail_handshakes(ConnectionError('Connection to the server closed'))
+        if self.ws_conn is not None:
+            self.ws_conn.close()
+            self.ws_conn = None
+
+    def _on_connected(self, future):
+        self._connecting = False
+        try:
+            ws_conn = future.result()
+        except Exception as e:  # e.g. server not running (anymore)
+            if isinstance(e, (ConnectionRefusedError, FileNotFoundError)):
+                # Nothing listening: requests not acknowledged yet
+                # never reached the server
+                reason = 'Connection to server refused ({}). ' \
+                         'Use %async_run_server first!'.format(e)
+                for request_id in list(self._unacked):
+                    self._fail(request_id, reason)
+            self._fail_handshakes(e)
+            self._reconnect(e)
+            return
+        if self._closed:
+            ws_conn.close()
+            return
+        # Requests (i.e. JSON header, then frames of the namespace) are
+        # not delayed by Nagle's algorithm (TCP only)
+        ws_conn.stream.set_nodelay(True)
+        formats = ws_conn.headers.get(FORMATS_HEADER, None)
+        self.formats = [PICKLE] if not formats else formats.split(',')
+        workers = ws_conn.headers.get(WORKERS_HEADER, None)
+        self.workers = None if workers is None else int(workers)
+        self.ws_conn = ws_conn
+        handshakes, self._handshakes = self._handshakes, list()
+        for future in handshakes:
+            future.set_result(self)
+        for request_id in list(self._requests.keys()):
+            if request_id in self._unacked:
+                IOLoop.current().spawn_callback(self._send, self._requests[request_id])
+            if request_id in self._cancelled:
+                IOLoop.current().spawn_callback(self._send_cancel, request_id)
+
+    def _fail_handshakes(self, error):
+        handshakes, self._handshakes = self._handshakes, list()
+        for future in handshakes:
+            future.set_exception(error)
+
+    def _reconnect(self, error=None):
+        """Connect again (after a delay), if there are pending requests.
+        Attempts are only reset once the server acknowledges a request (or
+        sends a result), so that requests the server keeps dropping
+        eventually fail."""
+        self.ws_conn = None
+        self._reader.reset()
+        self._receiving = None
+        if self._closed or not self._requests:
+            return
+        self._attempts += 1
+        if self._attempts > RECONNECT_ATTEMPTS:
+            self._attempts = 0
+            reason = 'Connection to the server lost'
+            if error is not None:
+                reason = '{} ({})'.format(reason, error)
+            for request in self._requests.values():
+                request.on_error(reason)
+            self._requests.clear()
+            self._unacked.clear()
+            self._cancelled.clear()
+            return
+        delay = min(RECONNECT_DELAY * 2 ** (self._attempts - 1), RECONNECT_MAX_DELAY)
+        IOLoop.current().call_later(delay, self.connect)
+
+    async def _send(self, request):
+        """Write the request on the channel. The namespace is written
+        in frames (see `transport`), never interleaved with the frames
+        of other requests."""
+        text, parts = request.message(self.channel_id, self.formats)
+        async with self._write_lock:
+            ws_conn = self.ws_conn
+            if ws_conn is None:  # sent again once connected
+                return
+            try:
+                await ws_conn.write_message(text)
+                await write_chunked(ws_conn, parts)
+            except WebSocketClosedError:  # sent again once connected
+                pass
+
+    async def _send_cancel(self, request_id):
+        async with self._write_lock:
+            if self.ws_conn is None or request_id not in self._requests:
+                return
+            try:
+                await self.ws_conn.write_message(json.dumps({'connection_id': self.channel_id,
+                                                             'cancel': request_id}))
+            except WebSocketClosedError:  # sent again once connected
+                pass
+
+    def _fail(self, request_id, reason):
+        """Fail the pending request (never sent again)"""
+        request = self._requests.pop(request_id)
+        self._unacked.discard(request_id)
+        self._cancelled.discard(request_id)
+        request.on_error(reason)
+
+    def on_message(self, message):
+        """Callback fired /on_message/, namely acknowledgements and
+        errors (JSON), or frames of the results (packed namespaces) of the
+        requests, each one announced by a JSON message"""
+        if message is None:  # connection closed
+            self._reconnect()
+            return
+        if not isinstance(message, bytes):
+            data = json.loads(message)
+            request_id = data.get(REQUEST_ID, None)
+            if data.get('result', False):  # frames of its result follow
+                self._receiving = request_id
+                return
+            if request_id not in self._requests:
+                return
+            if 'error' in data:
+                logger.warning('Request %s failed: %s', request_id, data['error'])
+                self._fail(request_id, data['error'])
+            elif data.get('ack', False):
+                self._unacked.discard(request_id)
+                self._attempts = 0
+                self._requests[request_id].on_ack()
+            return
+        try:
+            message = self._reader.feed(message)
+        except TransferError as e:
+            logger.warning('Transfer of the result of %s failed: %s', self._receiving, e)
+            if self._receiving in self._requests:
+                self._fail(self._receiving, 'Result not received: {}'.format(e))
+            self._receiving = None
+            return
+        if message is None:  # more frames to come
+            return
+        self._receiving = None
+        packed_ns = PackedNamespace.from_buffer(message)
+        request = self._requests.get(packed_ns.meta.get(REQUEST_ID, None), None)
+        if request is None:  # e.g. result sent twice
+            return
+        self._unacked.discard(request.request_id)
+        self._attempts = 0
+        if request.on_result(packed_ns):
+            del self._requests[request.request_id]
+            self._cancelled.discard(request.request_id)
+        else:
+            self._unacked.add(request.request_id)
+            IOLoop.current().spawn_callback(self._send, request)
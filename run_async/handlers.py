@@ -4,17 +4,32 @@
 # Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
 # License: BSD 3 clause
 
-from collections import defaultdict
+import os
+import json
+import logging
+import shutil
+from collections import defaultdict, OrderedDict, deque
+from time import monotonic, time
 
-# from queue import Queue
-from multiprocessing import SimpleQueue
 try:
     from tornado.websocket import WebSocketHandler
 except ImportError:
     pass
 
-from .settings import JS_ROLE
+from .settings import JS_ROLE, CHANNEL_MAX_REQUESTS, JOB_HISTORY_SIZE
+from .settings import (MAX_QUEUED_JOBS, MAX_QUEUED_JOBS_PER_SESSION,
+                       JOB_PRIORITIES, DEFAULT_JOB_PRIORITY)
+from .settings import (RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_SPILL_DIR,
+                       RESULT_SPILL_MIN_SIZE, RESULT_SPILL_MAX_SIZE)
+from .settings import MEMO_CACHE_SIZE, MEMO_CACHE_DIR, MEMO_CACHE_DISK_SIZE
+from .settings import REQUEST_ID
 from .utils import format_ws_connection_id
+from .namespace import PackedNamespace, export_namespace
+from .workers import JobFuture, WorkerError, JobCancelled
+from .shared_buffers import release_segments
+from .output import OutputBuffer
+
+logger = logging.getLogger(__name__)
 
 
 class Handler():
@@ -60,24 +75,811 @@ class ResultCache(Handler):
     """Handler for caching execution results,
     namely JSON (string) output.
 
+    Results are kept in memory within a budget of `max_size` bytes, and
+    evicted in least-recently-used order, or whenever not used in the last
+    `ttl` seconds (see `expire`). Evicted results (and results of at least
+    `spill_min_size` bytes) are spilled to files in `spill_dir` (if not None),
+    within a budget of `spill_max_size` bytes (oldest files are removed first),
+    so that they can still be served to (JS) clients. Results that cannot be
+    spilled (e.g. larger than `spill_max_size`) are kept in memory, until
+    evicted.
+
     Entries' keys are the (clients) _connection_id[s], namely
     <JS_ROLE>---<session_id>
     """
 
-    def __init__(self):
+    # Whether values are bytes (rather than strings)
+    binary = False
+
+    def __init__(self, max_size=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL,
+                 spill_dir=RESULT_SPILL_DIR, spill_min_size=RESULT_SPILL_MIN_SIZE,
+                 spill_max_size=RESULT_SPILL_MAX_SIZE):
         super(ResultCache, self).__init__(factory=str)
+        self._data = OrderedDict()  # cache_id --> (value, size, time of last use)
+        self._spilled = OrderedDict()  # cache_id --> size
+        self.max_size = max_size
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self.spill_min_size = spill_min_size
+        self.spill_max_size = spill_max_size
+        self.nbytes = 0
+        self.spilled_nbytes = 0
 
     def add(self, session_id, value):
         cache_id = format_ws_connection_id(JS_ROLE, session_id)
-        super(ResultCache, self).add(cache_id, value)
+        self.remove(cache_id)
+        size = len(value) if self.binary else len(value.encode('utf-8'))
+        if self.spill_dir is not None and size >= self.spill_min_size and \
+                self._spill(cache_id, value, size):
+            return
+        self._data[cache_id] = (value, size, monotonic())
+        self.nbytes += size
+        while self.nbytes > self.max_size:
+            self._evict(next(iter(self._data)))
+
+    def get(self, cache_id):
+        entry = self._data.get(cache_id, None)
+        if entry is not None:
+            value, size, _ = entry
+            self._data[cache_id] = (value, size, monotonic())
+            self._data.move_to_end(cache_id)
+            return value
+        if cache_id in self._spilled:
+            try:
+                with self._open(cache_id, 'r') as f:
+                    return f.read()
+            except OSError:  # e.g. spill folder removed
+                self._remove_spilled(cache_id)
+        return None
+
+    def remove(self, cache_id):
+        entry = self._data.pop(cache_id, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+        if cache_id in self._spilled:
+            self._remove_spilled(cache_id)
+
+    def __contains__(self, key):
+        return key in self._data or key in self._spilled
+
+    @property
+    def entries(self):
+        return list(self._data.keys()) + list(self._spilled.keys())
+
+    def expire(self):
+        """Evict results not used in the last `ttl` seconds"""
+        now = monotonic()
+        while self._data:
+            cache_id = next(iter(self._data))
+            if now - self._data[cache_id][2] <= self.ttl:
+                break
+            self._evict(cache_id)
+
+    def clear(self):
+        """Remove all the results, including the spill folder"""
+        self._data.clear()
+        self._spilled.clear()
+        self.nbytes = self.spilled_nbytes = 0
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def _evict(self, cache_id):
+        """Move the result from memory to the spill folder (if any)"""
+        value, size, _ = self._data.pop(cache_id)
+        self.nbytes -= size
+        if self.spill_dir is not None and cache_id not in self._spilled:
+            self._spill(cache_id, value, size)
+
+    def _spill_path(self, cache_id):
+        return os.path.join(self.spill_dir, cache_id)
+
+    def _open(self, cache_id, mode):
+        if self.binary:
+            return open(self._spill_path(cache_id), mode + 'b')
+        return open(self._spill_path(cache_id), mode, encoding='utf-8')
+
+    def _spill(self, cache_id, value, size):
+        """Write the result to the spill folder, and return
+        whether it has been spilled"""
+        if size > self.spill_max_size:
+            logger.warning('Result %s of %s bytes not spilled to disk: larger than '
+                           'the spill budget (%s bytes)', cache_id, size, self.spill_max_size)
+            return False
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with self._open(cache_id, 'w') as f:
+                f.write(value)
+        except OSError as e:
+            logger.warning('Result %s could not be spilled to disk: %s', cache_id, e)
+            return False
+        self._spilled[cache_id] = size
+        self.spilled_nbytes += size
+        while self.spilled_nbytes > self.spill_max_size:
+            self._remove_spilled(next(iter(self._spilled)))
+        return True
+
+    def _remove_spilled(self, cache_id):
+        self.spilled_nbytes -= self._spilled.pop(cache_id)
+        try:
+            os.unlink(self._spill_path(cache_id))
+        except OSError:
+            pass
+
+
+class MemoCache(ResultCache):
+    """Handler for the results of memoized async cells (see
+    `%%async_run --memoize`), namely their packed namespace (bytes),
+    whose meta data include the output of the cell.
+
+    Results are kept in memory within a budget of `max_size` bytes
+    (least recently used results are evicted first) and, if `cache_dir`
+    is not None, written through to files in `cache_dir`, within a budget
+    of `disk_size` bytes, so that they are served across restarts of
+    the server (see `load`).
+
+    Entries' keys are the memoization keys of the cells (see
+    `namespace.memo_key`), namely hex digests of the source of the cell
+    along with the values it reads.
+    """
+
+    binary = True
+
+    def __init__(self, max_size=MEMO_CACHE_SIZE, cache_dir=MEMO_CACHE_DIR,
+                 disk_size=MEMO_CACHE_DISK_SIZE):
+        super(MemoCache, self).__init__(max_size=max_size, spill_dir=cache_dir,
+                                        spill_max_size=disk_size)
+        self.hits = self.misses = 0
+
+    def add(self, memo_key, value):
+        self.remove(memo_key)
+        size = len(value)
+        if self.spill_dir is not None:
+            self._spill(memo_key, value, size)
+        self._data[memo_key] = (value, size, monotonic())
+        self.nbytes += size
+        while self.nbytes > self.max_size:
+            self._evict(next(iter(self._data)))
+
+    def get(self, memo_key):
+        value = super(MemoCache, self).get(memo_key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    @property
+    def entries(self):
+        # Results in memory are written through to the cache folder (if any)
+        return list(OrderedDict.fromkeys(list(self._spilled) + list(self._data)))
+
+    def load(self):
+        """Index the results persisted in the cache folder
+        (e.g. by a previous server), oldest first"""
+        if self.spill_dir is None:
+            return
+        try:
+            entries = [entry for entry in os.scandir(self.spill_dir) if entry.is_file()]
+        except OSError:  # e.g. not created yet
+            return
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            if entry.name not in self._spilled:
+                self._spilled[entry.name] = entry.stat().st_size
+                self.spilled_nbytes += entry.stat().st_size
+        while self.spilled_nbytes > self.spill_max_size:
+            self._remove_spilled(next(iter(self._spilled)))
+
+
+class OutputStreams(Handler):
+    """Handler for the (partial) output of the running cells, as streamed
+    by the workers, so that it can be sent to (JS) clients connecting
+    while the cell is running. Only the tail of the output is kept
+    (see `output.OutputBuffer`).
+
+    Entries' keys are the session_id[s].
+    """
+
+    def __init__(self):
+        super(OutputStreams, self).__init__(factory=OutputBuffer)
+
+    def get(self, session_id):
+        return self._data[session_id]
+
+
+class ChannelState:
+    """Server-side state of a (persistent) kernel channel, which
+    outlives its websocket connections (see `channel.KernelChannel`)."""
+
+    def __init__(self, max_requests=CHANNEL_MAX_REQUESTS):
+        self.connected = False
+        self.last_used = monotonic()
+        # IDs of the requests accepted (most recent ones), to detect requests
+        # sent again by the kernel (e.g. upon reconnection)
+        self._accepted = OrderedDict()
+        self._max_requests = max_requests
+        # (Request ID, parts of the packed namespace of) results to be
+        # sent as soon as the kernel connects again
+        self.undelivered = deque(maxlen=max_requests)
+        # Futures of the running requests (request_id --> future)
+        self.running = dict()
+        # PID of the kernel (as declared by the kernel)
+        self.kernel_pid = None
+
+    def accept(self, request_id):
+        """Record the request as accepted, unless it has been already"""
+        if request_id in self._accepted:
+            return False
+        self._accepted[request_id] = True
+        while len(self._accepted) > self._max_requests:
+            self._accepted.popitem(last=False)
+        return True
+
+    def forget(self, request_id):
+        """The request can be accepted again (e.g. full synchronisation
+        of the namespace required)"""
+        _ = self._accepted.pop(request_id, None)
+
+
+class KernelChannels(Handler):
+    """Handler for the state of kernel channels (see `ChannelState`).
+
+    Entries' keys are the _connection_id[s] of the channels, namely
+    <PY_ROLE>---<channel_id>
+    """
+
+    def __init__(self):
+        super(KernelChannels, self).__init__(factory=ChannelState)
+
+    def get(self, connection_id):
+        return self._data[connection_id]
+
+    def expire(self, ttl):
+        """Remove the state of channels disconnected for more than `ttl` seconds"""
+        now = monotonic()
+        for connection_id, state in list(self._data.items()):
+            if not state.connected and now - state.last_used > ttl:
+                self.remove(connection_id)
+
+
+class JobRejected(RuntimeError):
+    """The job could not be admitted by the scheduler (i.e. too many
+    jobs are waiting to run)"""
 
 
 class ExecutionHandler(Handler):
-    """Handler to store the execution queues in order to
-    make clients to wait on correct thread queues.
-    Entries' keys are the session_id[s], namely "one queue per session_id".
+    """Handler to store the execution queues, namely the scheduler
+    of the jobs (i.e. the execution of async cells).
+
+    At most `max_running` jobs run at once, while further jobs wait in
+    the queues, and are rejected (see `submit`) if more than `max_queued`
+    jobs (or `max_queued_per_session` jobs of the same session) are waiting.
+    Jobs are started by priority (see `JOB_PRIORITIES`) and, within the
+    same priority, in round-robin order among sessions, so that a notebook
+    submitting many cells cannot starve the others.
+
+    Entries' keys are the session_id[s], namely "one queue per session_id"
+    (and per priority), of (request_id, job, on_cancel) tuples.
+
+    Parameters
+    ----------
+    io_loop : `tornado.ioloop.IOLoop`
+        The loop jobs are started on.
+    max_running : int
+        Maximum number of jobs running at once.
+    max_queued : int (default: MAX_QUEUED_JOBS)
+        Maximum number of jobs waiting to run.
+    max_queued_per_session : int (default: MAX_QUEUED_JOBS_PER_SESSION)
+        Maximum number of jobs of the same session waiting to run.
+    """
+
+    def __init__(self, io_loop, max_running, max_queued=MAX_QUEUED_JOBS,
+                 max_queued_per_session=MAX_QUEUED_JOBS_PER_SESSION):
+        super(ExecutionHandler, self).__init__(
+            factory=lambda: [deque() for _ in JOB_PRIORITIES])
+        self._io_loop = io_loop
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self.max_queued_per_session = max_queued_per_session
+        self.running = 0
+        self.queued = 0
+
+    def submit(self, session_id, request_id, job, priority=DEFAULT_JOB_PRIORITY,
+               on_cancel=None):
+        """Schedule the job, i.e. a callable returning the future of its
+        execution (or None if nothing has been started). The `on_cancel`
+        callable (if any) is called with the reason of the cancellation,
+        if the job is cancelled before being started (see `cancel`), or with
+        the exception raised by the job, if it could not be started.
+
+        Raises
+        ------
+        JobRejected : if too many jobs are waiting to run.
+        """
+        if self.queued >= self.max_queued:
+            raise JobRejected('Too many cells waiting to run ({})'.format(self.queued))
+        if session_id in self and \
+                sum(map(len, self._data[session_id])) >= self.max_queued_per_session:
+            raise JobRejected('Too many cells of the notebook waiting to '
+                              'run ({})'.format(self.max_queued_per_session))
+        level = JOB_PRIORITIES.index(priority)
+        self._data[session_id][level].append((request_id, job, on_cancel))
+        self.queued += 1
+        self._dispatch()
+
+    def cancel(self, session_id, request_id, reason='Job cancelled'):
+        """Drop the job waiting to run (if any)
+
+        Returns
+        -------
+        bool : False if the job is not waiting to run
+            (e.g. already started).
+        """
+        if session_id not in self:
+            return False
+        queues = self._data[session_id]
+        for queue in queues:
+            for entry in queue:
+                if entry[0] == request_id:
+                    queue.remove(entry)
+                    self.queued -= 1
+                    if not any(queues):
+                        self.remove(session_id)
+                    on_cancel = entry[2]
+                    if on_cancel is not None:
+                        on_cancel(reason)
+                    return True
+        return False
+
+    def resize(self, max_running):
+        """Change the maximum number of jobs running at once (e.g. as
+        worker agents join, or leave), starting waiting jobs (if any)"""
+        self.max_running = max(1, max_running)
+        self._dispatch()
+
+    def queued_jobs(self, session_id):
+        """Return the request_id[s] of the jobs of the session waiting to run
+        (in order of priority)"""
+        if session_id not in self:
+            return []
+        return [entry[0] for queue in self._data[session_id] for entry in queue]
+
+    def _next_job(self):
+        """Pop the next job to start: the first job of the highest
+        priority, from the session waiting the longest"""
+        for level in range(len(JOB_PRIORITIES)):
+            for session_id, queues in self._data.items():
+                if queues[level]:
+                    break
+            else:
+                continue
+            job = queues[level].popleft()
+            # Round-robin: the session goes to the back of the line
+            del self._data[session_id]
+            if any(queues):
+                self._data[session_id] = queues
+            self.queued -= 1
+            return job
+        return None
+
+    def _dispatch(self):
+        while self.running < self.max_running:
+            entry = self._next_job()
+            if entry is None:
+                return
+            request_id, job, on_cancel = entry
+            try:
+                future = job()
+            except Exception as e:  # e.g. the pool is shut down
+                logger.warning('Job %s could not be started: %s', request_id, e)
+                if on_cancel is not None:
+                    on_cancel(e)
+                future = None
+            if future is None:
+                continue
+            self.running += 1
+            self._io_loop.add_future(future, self._job_done)
+
+    def _job_done(self, future):
+        self.running -= 1
+        self._dispatch()
+
+
+class JobRegistry(Handler):
+    """Handler for the records of the jobs (i.e. async cells) handled by
+    the server, namely their state (`blocked`, i.e. waiting for the jobs
+    it depends on, `queued`, `running`, or `done`,
+    `cached`, `failed`, `cancelled`, `rejected` once completed), and timings.
+    Only the last `max_finished` completed jobs are kept.
+
+    Entries' keys are the request_id[s] of the jobs.
+    """
+
+    FINISHED_STATES = ('done', 'cached', 'failed', 'cancelled', 'rejected')
+
+    def __init__(self, max_finished=JOB_HISTORY_SIZE):
+        super(JobRegistry, self).__init__(factory=dict)
+        self._data = OrderedDict()
+        self._finished = deque()
+        self.max_finished = max_finished
+
+    def queued(self, request_id, notebook, priority):
+        """Record the job as waiting to run"""
+        self.remove(request_id)  # e.g. sent again to synchronise the namespace
+        self._data[request_id] = {'request_id': request_id,
+                                  'notebook': notebook,
+                                  'priority': priority,
+                                  'state': 'queued',
+                                  'depends_on': [],
+                                  'submitted_at': time(),
+                                  'started_at': None,
+                                  'finished_at': None,
+                                  'pid': None,
+                                  'agent': None,
+                                  'future': None}
+
+    def blocked(self, request_id, depends_on):
+        """Record the job as held until the jobs
+        (request_id[s]) it depends on are completed"""
+        record = self.get(request_id)
+        if record is not None:
+            record['state'] = 'blocked'
+            record['depends_on'] = list(depends_on)
+
+    def released(self, request_id):
+        """Record the (held) job as waiting to run"""
+        record = self.get(request_id)
+        if record is not None and record['state'] == 'blocked':
+            record['state'] = 'queued'
+
+    def started(self, request_id, future):
+        """Record the job as running (i.e. handed over to the worker pool)"""
+        record = self.get(request_id)
+        if record is not None:
+            record['state'] = 'running'
+            record['started_at'] = time()
+            record['agent'] = future.agent_id
+            record['future'] = future
+
+    def finished(self, request_id, state):
+        """Record the job as completed, with the final `state`"""
+        record = self.get(request_id)
+        if record is None:
+            return
+        future = record['future']
+        if future is not None:
+            record['pid'] = future.pid
+        record.update(state=state, finished_at=time(), future=None)
+        self._finished.append(request_id)
+        while len(self._finished) > self.max_finished:
+            request_id = self._finished.popleft()
+            record = self.get(request_id)
+            if record is not None and record['state'] in self.FINISHED_STATES:
+                self.remove(request_id)
+
+    def status(self):
+        """Return the (JSON serialisable) records of the jobs,
+        along with their waiting and running times (seconds)"""
+        now = time()
+        jobs = list()
+        for record in self._data.values():
+            job = dict(record)
+            future = job.pop('future')
+            if future is not None:
+                job['pid'] = future.pid
+            started_at, finished_at = job['started_at'], job['finished_at']
+            job['wait_time'] = (started_at or finished_at or now) - job['submitted_at']
+            job['run_time'] = None
+            if started_at is not None:
+                job['run_time'] = (finished_at or now) - started_at
+            jobs.append(job)
+        return jobs
+
+
+class AgentState:
+    """Server-side state of a worker agent (see `agents`), namely its
+    connection, its resources (as advertised by the agent), and the
+    jobs it is running"""
+
+    def __init__(self, connection, info):
+        self.connection = connection  # `run_server.AgentHandler`
+        self.hostname = info.get('hostname', None)
+        self.pid = info.get('pid', None)
+        self.cores = info.get('cores', None)
+        self.memory = info.get('memory', None)
+        self.workers = max(1, int(info.get('workers', 1)))
+        self.jobs = dict()  # request_id --> `workers.JobFuture`
+        self.connected_at = time()
+
+    @property
+    def load(self):
+        """Fraction of the workers of the agent running a job"""
+        return len(self.jobs) / self.workers
+
+
+class WorkerAgents(Handler):
+    """Handler for the worker agents connected to the server (see `agents`),
+    which run jobs on their own worker pools, possibly on other nodes.
+
+    Jobs are placed on the least loaded node (see `place`), and namespaces
+    are sent to agents (and results sent back) along with the contents of
+    their out-of-band buffers (see `namespace.export_namespace`).
+
+    Entries' keys are the agent_id[s], of `AgentState` entries.
+
+    Parameters
+    ----------
+    io_loop : `tornado.ioloop.IOLoop`
+        The loop jobs are sent on.
+    """
+
+    def __init__(self, io_loop):
+        super(WorkerAgents, self).__init__(factory=dict)
+        self._data = OrderedDict()  # in order of connection
+        self._io_loop = io_loop
+
+    @property
+    def capacity(self):
+        """Number of workers of all the agents"""
+        return sum(agent.workers for agent in self._data.values())
+
+    def place(self, local_load):
+        """Return the ID of the agent the next job is placed on, namely the
+        least loaded one, or None if no agent is less loaded than the local
+        worker pool (whose fraction of busy workers is `local_load`)"""
+        agent_id, load = None, local_load
+        for candidate, agent in self._data.items():
+            if agent.load < load:
+                agent_id, load = candidate, agent.load
+        return agent_id
+
+    def submit(self, agent_id, request_id, packed_ns, meta):
+        """Send the job, namely the packed namespace of the cell along with
+        its `meta` data (see `agents.WorkerAgent`), to the agent, and return
+        its future (see `workers.JobFuture`)"""
+        agent = self.get(agent_id)
+        future = JobFuture()
+        future.agent_id = agent_id
+        future.started_at = time()
+        future.set_running_or_notify_cancel()
+        meta = dict(meta, **{REQUEST_ID: request_id})
+        try:
+            message = export_namespace(packed_ns, meta=meta)
+        except OSError as e:  # e.g. segments released by a later cell
+            future.set_exception(WorkerError('Namespace not available: {}'.format(e)))
+            return future
+        agent.jobs[request_id] = future
+        self._io_loop.spawn_callback(agent.connection.write_job, message.to_parts())
+        return future
+
+    def progress(self, agent_id, request_id, payload):
+        """Deliver the progress (e.g. output) of the job run by the agent"""
+        agent = self.get(agent_id)
+        future = None if agent is None else agent.jobs.get(request_id, None)
+        if future is not None:
+            future.set_progress(payload)
+
+    def completed(self, agent_id, request_id, result=None, error=None, cancelled=False):
+        """Resolve the future of the job completed by the agent, with its
+        `result` or, if failed (or `cancelled`), with the `error` message.
+
+        Returns
+        -------
+        bool : False if the job is unknown (e.g. already failed, as
+            the agent disconnected).
+        """
+        agent = self.get(agent_id)
+        future = None if agent is None else agent.jobs.pop(request_id, None)
+        if future is None:
+            return False
+        if error is None:
+            future.set_result(result)
+        elif cancelled:
+            future.set_exception(JobCancelled(error))
+        else:
+            future.set_exception(WorkerError(error))
+        return True
+
+    def cancel(self, future, reason='Job cancelled'):
+        """Cancel the job of the future, run by an agent (which kills,
+        and replaces, the worker running the job)
+
+        Returns
+        -------
+        bool : False if the job is already completed.
+        """
+        agent = self.get(future.agent_id)
+        if agent is None or future.done():
+            return False
+        for request_id, job in agent.jobs.items():
+            if job is future:
+                agent.connection.write_message(json.dumps({'cancel': request_id,
+                                                           'reason': reason}))
+                return True
+        return False
+
+    def remove(self, agent_id):
+        """Remove the (disconnected) agent: its jobs fail"""
+        agent = self._data.pop(agent_id, None)
+        if agent is None:
+            return
+        for future in agent.jobs.values():
+            future.set_exception(WorkerError('Worker agent {} disconnected'.format(agent_id)))
+
+    def status(self):
+        """Return the (JSON serialisable) state of the agents"""
+        return [{'agent_id': agent_id, 'hostname': agent.hostname, 'pid': agent.pid,
+                 'cores': agent.cores, 'memory': agent.memory, 'workers': agent.workers,
+                 'running': list(agent.jobs.keys()),
+                 'uptime': time() - agent.connected_at}
+                for agent_id, agent in self._data.items()]
+
+
+def _overlap(names, other):
+    """Whether the two sets of names overlap (None: all the names)"""
+    if names is None:
+        return other is None or len(other) > 0
+    if other is None:
+        return len(names) > 0
+    return not names.isdisjoint(other)
+
+
+class DependencyGraph(Handler):
+    """Handler for the dependency graph of the pending jobs (i.e. held,
+    queued, or running) of each notebook namespace (i.e. namespace mirror),
+    given the names each job reads and writes.
+
+    A job depends on the pending jobs of the same namespace submitted before
+    it, whose names written it reads (or writes), or whose names read it
+    writes. Dependent jobs are held (i.e. not submitted to the scheduler)
+    until the jobs they depend on are completed (see `done`), and
+    their results merged into the mirror, while independent jobs run in
+    parallel. Jobs writing the same names are hence completed in order of
+    submission, and their results merged (in the mirror, and in the
+    notebook) in that order.
+
+    Entries' keys are the request_id[s] of the pending jobs, whose entries
+    are (key, reads, writes, depends_on, release, cancel) lists, where the
+    key is the session key of the notebook.
     """
 
     def __init__(self):
-        super(ExecutionHandler, self).__init__(factory=SimpleQueue)
+        super(DependencyGraph, self).__init__(factory=list)
+        self._data = OrderedDict()  # in order of submission
+
+    def depends_on(self, key, reads, writes):
+        """Return the request_id[s] of the pending jobs of the notebook
+        the job reading, and writing, the names (None: all the names)
+        depends on"""
+        return [request_id for request_id, (job_key, job_reads, job_writes, *_)
+                in self._data.items()
+                if job_key == key and (_overlap(job_writes, reads) or
+                                       _overlap(job_writes, writes) or
+                                       _overlap(job_reads, writes))]
+
+    def add_job(self, key, request_id, reads, writes, release, cancel=None):
+        """Add the job to the graph. If it depends on pending jobs, the job
+        is held, and released (i.e. `release` is called) as soon as they
+        are done. The `cancel` callable (if any) is called with the reason
+        of the cancellation, if the job is cancelled while held (see `cancel`).
+
+        Returns
+        -------
+        list : the request_id[s] of the jobs it depends on (if none,
+            the job is not held, and is to be started by the caller).
+        """
+        reads = None if reads is None else set(reads)
+        writes = None if writes is None else set(writes)
+        depends_on = self.depends_on(key, reads, writes)
+        if not depends_on:
+            release = cancel = None
+        self._data[request_id] = [key, reads, writes, set(depends_on), release, cancel]
+        return depends_on
+
+    def done(self, request_id):
+        """Remove the (completed) job from the graph, and release the
+        jobs no longer depending on any pending job"""
+        if request_id not in self:
+            return
+        self.remove(request_id)
+        for pending_id, entry in list(self._data.items()):
+            depends_on = entry[3]
+            # Released jobs may complete (e.g. fail) at once
+            if request_id in depends_on and pending_id in self:
+                depends_on.discard(request_id)
+                if not depends_on:
+                    self._release(pending_id)
+
+    def cancel(self, request_id, reason='Job cancelled'):
+        """Drop the held job (if any). Jobs depending on it are
+        released as soon as the other jobs they depend on are done.
+
+        Returns
+        -------
+        bool : False if the job is not held (e.g. already released).
+        """
+        entry = self.get(request_id)
+        if entry is None or entry[4] is None:
+            return False
+        cancel = entry[5]
+        self.done(request_id)
+        if cancel is not None:
+            cancel(reason)
+        return True
+
+    def _release(self, request_id):
+        entry = self.get(request_id)
+        release, entry[4] = entry[4], None
+        release()
+
+
+class NamespaceMirror(Handler):
+    """Handler mirroring the (packed) namespaces of the notebooks,
+    as last synchronised with the server. Notebooks only send names
+    changed since the last synchronisation, which are merged in the
+    mirror to provide workers with the full namespace.
+
+    The mirror owns the segments of the out-of-band buffers of its values
+    (see `shared_buffers`), and releases them as soon as values are
+    replaced or removed.
+
+    Entries' keys are the session keys of the notebooks.
+    """
+
+    def __init__(self):
+        super(NamespaceMirror, self).__init__(factory=PackedNamespace)
+        self._last_used = dict()
+        self._seq = dict()  # key --> sequence number of the last delta
+
+    def merge(self, key, packed_ns, deleted=(), full_sync=False, seq=None):
+        """Merge the (delta) packed namespace in the mirror.
+
+        Parameters
+        ----------
+        key : str
+            The session key of the notebook.
+        packed_ns : `namespace.PackedNamespace`
+            The names changed in the notebook (or by an async cell).
+        deleted : collection (default: ())
+            The names deleted from the namespace.
+        full_sync : bool (default: False)
+            Whether `packed_ns` is the whole namespace.
+        seq : int (default: None)
+            The sequence number of the delta sent by the notebook, so to
+            detect deltas received out of order (e.g. concurrent cells).
+            None for deltas sent back by async cells.
+
+        Returns
+        -------
+        bool : False if the delta could not be merged, i.e. the mirror
+            is missing (e.g. the server has been restarted) or out of
+            sync, and a full synchronisation is required.
+        """
+        if full_sync:
+            self.remove(key)
+            self.add(key, PackedNamespace())
+            self._seq[key] = 0
+        elif key not in self:
+            return False
+        if seq is not None:
+            if seq != self._seq[key] + 1:
+                self.remove(key)
+                return False
+            self._seq[key] = seq
+        released = self.get(key).update(packed_ns, deleted)
+        release_segments(released)
+        self._last_used[key] = monotonic()
+        return True
+
+    def remove(self, key):
+        if key in self:
+            release_segments(self.get(key).segments)
+        super(NamespaceMirror, self).remove(key)
+        _ = self._last_used.pop(key, None)
+        _ = self._seq.pop(key, None)
 
+    def expire(self, ttl):
+        """Remove mirrors not used in the last `ttl` seconds"""
+        now = monotonic()
+        for key, last_used in list(self._last_used.items()):
+            if now - last_used > ttl:
+                self.remove(key)
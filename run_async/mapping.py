@@ -0,0 +1,98 @@
+"""Data-parallel execution of async cells (see `%%async_map`): the cell
+runs once per chunk of an iterable of the notebook namespace, each chunk
+on a worker of the server, and the per-chunk results are reduced back
+into a target name.
+
+Chunks are never sent as such: the iterable travels (once) along with the
+shared namespace of the notebook, and each worker takes its own chunk out
+of it (see `take_chunk`), given the bounds of the chunk.
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+from functools import reduce
+from itertools import chain, islice
+from operator import add
+
+
+def chunk_bounds(size, chunk_size):
+    """(start, stop) bounds of the chunks of (at most) `chunk_size`
+    items of an iterable of `size` items"""
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+
+def take_chunk(iterable, start, stop):
+    """
+    Return the items of the iterable from `start` to `stop`: a slice of
+    the same type for sequences (e.g. lists, ranges, NumPy arrays), or a
+    list otherwise (e.g. the keys of dictionaries, or sets).
+    """
+    if hasattr(type(iterable), '__getitem__'):
+        try:
+            return iterable[start:stop]
+        except (TypeError, KeyError):  # e.g. dictionaries
+            pass
+    return list(islice(iterable, start, stop))
+
+
+def concat(results):
+    """
+    Concatenate the per-chunk results: NumPy arrays and pandas objects
+    with their own `concatenate` (and `concat`), dictionaries are merged,
+    strings joined, and any other iterable chained into a list (or a tuple).
+
+    Raises
+    ------
+    TypeError if the results cannot be concatenated (e.g. numbers).
+    """
+    first = results[0]
+    package = type(first).__module__.split('.')[0]
+    if package == 'numpy':
+        import numpy
+        return numpy.concatenate(results)
+    if package == 'pandas':
+        import pandas
+        return pandas.concat(results)
+    if isinstance(first, dict):
+        merged = dict()
+        for result in results:
+            merged.update(result)
+        return merged
+    if isinstance(first, (str, bytes)):
+        return first[:0].join(results)
+    if isinstance(first, tuple):
+        return tuple(chain.from_iterable(results))
+    return list(chain.from_iterable(results))
+
+
+def reduce_results(results, reducer, namespace=None):
+    """
+    Reduce the per-chunk results (in order of chunk).
+
+    Parameters
+    ----------
+    results : list
+        The results of the chunks.
+    reducer : str
+        Either one of `settings.MAP_REDUCERS`, namely ``concat`` (see
+        `concat`), ``sum`` (``+`` of the results) and ``list`` (the list
+        of the results), or the name of a function of the `namespace`,
+        called on pairs of results (see `functools.reduce`).
+    namespace : dict (default: None)
+        The namespace of the reducing functions.
+
+    Raises
+    ------
+    ValueError if the reducer is unknown.
+    """
+    if reducer == 'concat':
+        return concat(results)
+    if reducer == 'sum':
+        return reduce(add, results)
+    if reducer == 'list':
+        return list(results)
+    function = (namespace or {}).get(reducer, None)
+    if not callable(function):
+        raise ValueError('Unknown reducer: {} (not a function of the namespace)'.format(reducer))
+    return reduce(function, results)
@@ -0,0 +1,146 @@
+"""Latency and throughput metrics of the round trip of async cells,
+exposed by the server in the Prometheus text format (see `/metrics`).
+
+Each phase of the round trip (see `PHASES`) is timed where it happens,
+namely in the notebook kernel, in the server, or in the worker process:
+observations of the kernel and of the workers travel to the server
+along with the messages (the requests, and the results, respectively),
+as lists of ``[phase, seconds, nbytes]`` observations (see `record`).
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter
+
+from .settings import METRICS_BUCKETS, METRICS_MAX_PENDING
+
+# Phases of the round trip of a cell, in order, and where they are timed
+PHASES = ('pack',  # kernel: namespace pickled (`CellRequest._pack_namespace`)
+          'transfer',  # server: namespace received on the websocket
+          'decode',  # server: namespace decoded (and merged in the mirror)
+          'queue',  # server: waiting in the scheduler
+          'shell_setup',  # worker: warm shell prepared for the cell
+          'unpickle',  # worker: namespace loaded in the shell
+          'run_cell',  # worker: cell executed
+          'repickle',  # worker: changed names pickled
+          'result_write',  # server: result written to the kernel
+          'unpack',  # kernel: result unpickled
+          'reimport')  # kernel: modules imported again (`_check_modules_import`)
+
+# Observations of the current (kernel) process, waiting
+# to be sent to the server (see `drain`)
+_pending = deque(maxlen=METRICS_MAX_PENDING)
+
+
+def record(phase, seconds, nbytes=None):
+    """Record the observation of the phase, to be sent to the server"""
+    _pending.append([phase, seconds, nbytes])
+
+
+def drain():
+    """Return (and forget) the observations recorded so far"""
+    observations = list(_pending)
+    _pending.clear()
+    return observations
+
+
+@contextmanager
+def timed(phase, nbytes=None, observations=None):
+    """Time the (body of the) `with` statement as an observation of the
+    phase, appended to the `observations` list (if not None), or
+    recorded to be sent to the server (see `record`) otherwise"""
+    start = perf_counter()
+    yield
+    observation = [phase, perf_counter() - start, nbytes]
+    if observations is None:
+        _pending.append(observation)
+    else:
+        observations.append(observation)
+
+
+class Histogram:
+    """Cumulative histogram of observed values (Prometheus-like)"""
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # the last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        total = 0
+        for count in self.counts:
+            total += count
+            yield total
+
+
+class Metrics:
+    """Registry of the metrics of the server: a latency histogram, and a
+    counter of the bytes processed, for each phase (see `PHASES`), along
+    with counters of the jobs (by final state)."""
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self._buckets = buckets
+        self.latency = dict()  # phase --> Histogram
+        self.nbytes = dict()  # phase --> bytes
+        self.jobs = dict()  # state --> number of jobs
+
+    def observe(self, phase, seconds, nbytes=None):
+        if phase not in self.latency:
+            self.latency[phase] = Histogram(self._buckets)
+        self.latency[phase].observe(seconds)
+        if nbytes is not None:
+            self.nbytes[phase] = self.nbytes.get(phase, 0) + nbytes
+
+    def merge(self, observations):
+        """Merge the observations of another process (e.g. a worker).
+        Unknown phases (or malformed observations) are ignored."""
+        for observation in observations or ():
+            try:
+                phase, seconds, nbytes = observation
+            except (TypeError, ValueError):
+                continue
+            if phase in PHASES:
+                self.observe(phase, seconds, nbytes)
+
+    def job_finished(self, state):
+        self.jobs[state] = self.jobs.get(state, 0) + 1
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        lines = ['# HELP run_async_phase_seconds Latency of the phases of the '
+                 'round trip of async cells.',
+                 '# TYPE run_async_phase_seconds histogram']
+        for phase in PHASES:
+            histogram = self.latency.get(phase)
+            if histogram is None:
+                continue
+            bounds = [repr(float(bound)) for bound in histogram.buckets] + ['+Inf']
+            for bound, count in zip(bounds, histogram.cumulative_counts()):
+                lines.append('run_async_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(
+                    phase, bound, count))
+            lines.append('run_async_phase_seconds_sum{{phase="{}"}} {!r}'.format(
+                phase, histogram.sum))
+            lines.append('run_async_phase_seconds_count{{phase="{}"}} {}'.format(
+                phase, histogram.count))
+        lines.extend(['# HELP run_async_phase_bytes_total Bytes of the payloads '
+                      'processed by the phases of the round trip.',
+                      '# TYPE run_async_phase_bytes_total counter'])
+        for phase in PHASES:
+            if phase in self.nbytes:
+                lines.append('run_async_phase_bytes_total{{phase="{}"}} {}'.format(
+                    phase, self.nbytes[phase]))
+        lines.extend(['# HELP run_async_jobs_total Async cells completed, by final state.',
+                      '# TYPE run_async_jobs_total counter'])
+        for state, count in sorted(self.jobs.items()):
+            lines.append('run_async_jobs_total{{state="{}"}} {}'.format(state, count))
+        return '\n'.join(lines) + '\n'
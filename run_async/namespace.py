@@ -0,0 +1,695 @@
+"""Utilities to pack (serialise) shell namespaces, and to keep track
+of their changes, so to only transfer new or changed names between the
+notebook kernel and the workers.
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import ast
+import hashlib
+import struct
+import symtable
+from array import array
+from functools import partial
+from pickle import dumps as pickle_dumps
+from pickle import loads as pickle_loads
+from pickle import HIGHEST_PROTOCOL
+from types import CodeType, ModuleType
+
+from . import serializers, shared_buffers
+from .settings import SHM_MIN_BUFFER_SIZE
+
+
+def _code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names.update(_code_names(const))
+    return names
+
+
+def referenced_names(shell, source):
+    """
+    Collect all the (global) names referenced in the input
+    cell source, i.e. names that the cell may have
+    (re)bound or changed in place.
+
+    Parameters
+    ----------
+    shell : `IPython.core.interactiveshell.InteractiveShell`
+        The shell used to transform the IPython syntax (e.g. magics)
+        of the cell into plain Python code.
+    source : str
+        The source code of the cell.
+
+    Returns
+    -------
+    set : the set of referenced names, or None if the
+        source could not be compiled.
+
+    Note
+    ----
+    This is an over-approximation (e.g. attribute names are
+    included as well), which is harmless for our purposes.
+    """
+    try:
+        source = shell.input_transformer_manager.transform_cell(source)
+        code = compile(source, '<async-cell>', 'exec')
+    except Exception:  # e.g. SyntaxError
+        return None
+    return _code_names(code)
+
+
+# Names whose use makes the names read (or written) by a cell
+# impossible to infer from its source
+_DYNAMIC_NAMES = {'exec', 'eval', 'globals', 'locals', 'vars',
+                  'get_ipython', '__import__'}
+
+
+def _scope_names(table, reads, writes):
+    """Collect the global names read and written in the scope
+    (and in its nested scopes)"""
+    module_scope = table.get_type() == 'module'
+    for symbol in table.get_symbols():
+        name = symbol.get_name()
+        if module_scope or symbol.is_global():
+            if symbol.is_referenced():
+                reads.add(name)
+            if (module_scope or symbol.is_declared_global()) and \
+                    (symbol.is_assigned() or symbol.is_imported()):
+                writes.add(name)
+    for child in table.get_children():
+        _scope_names(child, reads, writes)
+
+
+def _target_name(node):
+    """Name of the object changed by the target (e.g. `a` for `a.b[0] = 1`)"""
+    while isinstance(node, (ast.Attribute, ast.Subscript, ast.Starred)):
+        node = node.value
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def cell_names(shell, source):
+    """
+    Infer the (global) names that the cell reads, and the names that
+    it writes (i.e. binds, deletes, or changes by assigning to their
+    attributes or items), from its source.
+
+    Parameters
+    ----------
+    shell : `IPython.core.interactiveshell.InteractiveShell`
+        The shell used to transform the IPython syntax (e.g. magics)
+        of the cell into plain Python code.
+    source : str
+        The source code of the cell.
+
+    Returns
+    -------
+    reads : set
+        Names read by the cell (including builtins).
+    writes : set
+        Names written by the cell.
+    dynamic : bool
+        Whether the cell may read or write further names, which cannot be
+        inferred from its source (e.g. `exec`, `globals()`, magics, or
+        `from module import *`).
+
+    None is returned if the source could not be compiled.
+
+    Note
+    ----
+    Objects changed in place by calling their methods (e.g. `a.append(1)`)
+    are not considered written.
+    """
+    try:
+        source = shell.input_transformer_manager.transform_cell(source)
+        tree = ast.parse(source, '<async-cell>', 'exec')
+        table = symtable.symtable(source, '<async-cell>', 'exec')
+    except Exception:  # e.g. SyntaxError
+        return None
+    reads, writes = set(), set()
+    _scope_names(table, reads, writes)
+    dynamic = False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if node.id in _DYNAMIC_NAMES:
+                dynamic = True
+            elif isinstance(node.ctx, ast.Del):  # the name must exist
+                reads.add(node.id)
+        elif isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+            reads.add(node.target.id)
+        elif isinstance(node, (ast.Attribute, ast.Subscript)) and \
+                isinstance(node.ctx, (ast.Store, ast.Del)):
+            name = _target_name(node)
+            if name is not None:
+                reads.add(name)
+                writes.add(name)
+        elif isinstance(node, ast.ImportFrom):
+            if any(alias.name == '*' for alias in node.names):
+                dynamic = True
+    return reads, writes, dynamic
+
+
+def imported_names(shell, source):
+    """
+    Collect the (global) names the cell only binds by import statements
+    (e.g. `import numpy as np`), namely modules (or objects of modules),
+    which are the same objects whichever cell imports them.
+
+    Parameters
+    ----------
+    shell : `IPython.core.interactiveshell.InteractiveShell`
+        The shell used to transform the IPython syntax (e.g. magics)
+        of the cell into plain Python code.
+    source : str
+        The source code of the cell.
+
+    Returns
+    -------
+    set : the imported names (empty if the source could not be compiled).
+    """
+    try:
+        source = shell.input_transformer_manager.transform_cell(source)
+        table = symtable.symtable(source, '<async-cell>', 'exec')
+    except Exception:  # e.g. SyntaxError
+        return set()
+    return {symbol.get_name() for symbol in table.get_symbols()
+            if symbol.is_imported() and not symbol.is_assigned()}
+
+
+# Container types whose size is part of their fingerprint
+_SIZED_TYPES = (list, dict, set, bytearray)
+
+
+def fingerprint(value):
+    """
+    Cheap fingerprint of a value, namely its identity along with the
+    size of builtin containers, or the `shape` of arrays (e.g. numpy
+    arrays, pandas DataFrames), so that objects grown or reshaped in
+    place are detected as changed.
+
+    No reference to the value is kept (so to not prevent its deallocation),
+    and the value is never serialised.
+    """
+    value_type = type(value)
+    if value_type in _SIZED_TYPES:
+        return id(value), value_type, len(value)
+    if isinstance(getattr(value_type, 'shape', None), property):
+        try:
+            return id(value), value_type, tuple(value.shape)
+        except Exception:
+            pass
+    return id(value), value_type
+
+
+def snapshot(namespace):
+    """Return the fingerprints of the namespace (name --> `fingerprint` of the value)"""
+    return {name: fingerprint(value) for name, value in namespace.items()}
+
+
+def namespace_delta(namespace, synced, touched=None):
+    """
+    Compute the changes of the namespace since the last synchronisation.
+
+    Parameters
+    ----------
+    namespace : dict
+        The current namespace.
+    synced : dict
+        The fingerprints (see `snapshot`) of the namespace
+        at last synchronisation.
+    touched : set (default: None)
+        Names possibly changed in place since the last synchronisation
+        (see `referenced_names`). If None, all names are considered
+        changed.
+
+    Returns
+    -------
+    changed : set
+        New names, names whose fingerprint is changed, or touched names.
+    deleted : set
+        Names not in the namespace anymore.
+    """
+    if touched is None:
+        changed = set(namespace.keys())
+    else:
+        changed = {name for name, value in namespace.items()
+                   if name in touched or synced.get(name, None) != fingerprint(value)}
+    deleted = set(synced.keys()).difference(namespace.keys())
+    return changed, deleted
+
+
+class PackedNamespace:
+    """Namespace serialised one value at a time.
+
+    Each value is encoded exactly once (there is no trial pickling to
+    check whether the value can be pickled), and the very same bytes are
+    written in the message. Values are pickled, unless encoded by another
+    serializer (see `serializers`), recorded in `formats` (name --> name
+    of the serializer). Values that could not be encoded are
+    recorded in `skipped` (name --> reason), and modules are collected
+    by name, to be imported again on the other side.
+
+    The message layout is::
+
+        <header size (8 bytes)><pickled header><value 0><value 1>...
+
+    where the header holds the names (and sizes) of values, their formats,
+    modules, skipped names, aliases, handles of out-of-band buffers (see
+    `shared_buffers`), and `meta` data (i.e. plain Python data
+    about the message, like the connection ID).
+    Decoding the header never requires to unpickle (or even to slice)
+    any value (see `from_buffer`), and values are only decoded by `unpack`.
+    """
+
+    _HEADER_SIZE = struct.Struct('!Q')
+
+    def __init__(self, meta=None):
+        self._values = dict()  # name --> encoded value
+        self._buffer = None  # message the values are (lazily) sliced from
+        self._sizes = None
+        self._names = None
+        self.modules = list()  # (alias, module name)
+        self.aliases = dict()  # name --> name (of the same object)
+        self.skipped = dict()  # name --> reason
+        self.buffers = dict()  # name --> handles of out-of-band buffers
+        self.formats = dict()  # name --> serializer (unless pickled)
+        self.meta = dict() if meta is None else meta
+
+    def _iter_buffer(self):
+        """Iterate over (name, value) pairs, slicing values from the buffer"""
+        buffer = self._buffer
+        offset = self._HEADER_SIZE.size + self._HEADER_SIZE.unpack_from(buffer)[0]
+        for name, size in zip(self._names, self._sizes):
+            yield name, buffer[offset:offset + size]
+            offset += size
+
+    @property
+    def values(self):
+        """Dictionary of encoded values (name --> bytes-like object)"""
+        if self._buffer is not None:
+            self._values.update(self._iter_buffer())
+            self._buffer = self._sizes = self._names = None
+        return self._values
+
+    @property
+    def names(self):
+        return (list(self.values.keys()) + list(self.aliases.keys()) +
+                [alias for alias, _ in self.modules])
+
+    @property
+    def segments(self):
+        """Handles of all the out-of-band buffers (see `shared_buffers`)"""
+        return [handle for handles in self.buffers.values() for handle in handles]
+
+    @property
+    def nbytes(self):
+        if self._buffer is not None:
+            return sum(self._sizes)
+        return sum(len(value) for value in self._values.values())
+
+    def to_parts(self):
+        """Serialise the packed namespace into the parts of the message
+        (i.e. without joining them, see `transport.write_chunked`)"""
+        values = self.values
+        sizes = array('Q', [len(value) for value in values.values()])
+        header = {'names': list(values.keys()), 'sizes': sizes.tobytes(),
+                  'modules': self.modules, 'aliases': self.aliases,
+                  'skipped': self.skipped, 'buffers': self.buffers,
+                  'formats': self.formats, 'meta': self.meta}
+        header = pickle_dumps(header, protocol=HIGHEST_PROTOCOL)
+        parts = [self._HEADER_SIZE.pack(len(header)), header]
+        parts.extend(values.values())
+        return parts
+
+    def to_bytes(self):
+        """Serialise the packed namespace into the message (bytes)"""
+        return b''.join(self.to_parts())
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Load a packed namespace from the message. Values are
+        (zero-copy) slices of the input buffer."""
+        buffer = memoryview(buffer)
+        offset = cls._HEADER_SIZE.size
+        header_size, = cls._HEADER_SIZE.unpack_from(buffer)
+        header = pickle_loads(buffer[offset:offset + header_size])
+        packed = cls(meta=header['meta'])
+        packed._buffer = buffer
+        packed._names = header['names']
+        packed._sizes = array('Q')
+        packed._sizes.frombytes(header['sizes'])
+        packed.modules = header['modules']
+        packed.aliases = header['aliases']
+        packed.skipped = header['skipped']
+        packed.buffers = header['buffers']
+        # Pickled values only, e.g. results memoized by former versions
+        packed.formats = header.get('formats', {})
+        return packed
+
+    def subset(self, names):
+        """Return the packed namespace restricted to `names` (along with
+        the targets of their aliases). Values are shared, not copied."""
+        packed = PackedNamespace(meta=dict(self.meta))
+        values = self.values
+        for name in names:
+            target = self.aliases.get(name, name)
+            if target not in values:
+                continue
+            packed.values[target] = values[target]
+            if target in self.buffers:
+                packed.buffers[target] = self.buffers[target]
+            if target in self.formats:
+                packed.formats[target] = self.formats[target]
+            if target != name:
+                packed.aliases[name] = target
+        packed.modules = [(alias, module) for alias, module in self.modules
+                          if alias in names]
+        return packed
+
+    def update(self, other, deleted=()):
+        """
+        Merge the `other` (delta) packed namespace into this one, and
+        remove the `deleted` names. Merged values are copied, so to
+        not keep the whole `other` message alive.
+
+        Returns
+        -------
+        list : handles of the out-of-band buffers not referenced anymore.
+        """
+        values = self.values
+        released = list()
+        modules = dict(self.modules)
+        dropped = set(deleted).union(other.names)
+        # Aliases of dropped names get their own copy of the value
+        for name, target in list(self.aliases.items()):
+            if self.aliases.get(name) != target:  # already re-pointed
+                continue
+            if target in dropped and name not in dropped:
+                del self.aliases[name]
+                values[name] = values[target]
+                if target in self.buffers:
+                    self.buffers[name] = self.buffers.pop(target)
+                if target in self.formats:
+                    self.formats[name] = self.formats.pop(target)
+                for other_name, other_target in self.aliases.items():
+                    if other_target == target:
+                        self.aliases[other_name] = name
+        for name in dropped:
+            _ = values.pop(name, None)
+            _ = self.aliases.pop(name, None)
+            _ = modules.pop(name, None)
+            _ = self.formats.pop(name, None)
+            released.extend(self.buffers.pop(name, ()))
+        for name, value in other.values.items():
+            values[name] = bytes(value)
+        self.aliases.update(other.aliases)
+        self.buffers.update(other.buffers)
+        self.formats.update(other.formats)
+        modules.update(other.modules)
+        self.modules = list(modules.items())
+        return released
+
+    def unpack(self, release=False):
+        """Decode values, and return the namespace dictionary.
+        Modules to import are listed in the `import_modules` entry.
+        Values of formats not available are recorded in `skipped`.
+
+        Out-of-band buffers are mapped in memory (i.e. never copied). If
+        `release`, their segments are released, as soon as they are mapped.
+        """
+        if self._buffer is not None:
+            values = self._iter_buffer()
+        else:
+            values = self._values.items()
+        namespace = dict()
+        try:
+            for name, value in values:
+                format_name = self.formats.get(name, serializers.PICKLE)
+                if serializers.get(format_name) is None:
+                    self.skipped[name] = 'Serializer not available: {}'.format(format_name)
+                    continue
+                handles = self.buffers.get(name, ())
+                try:
+                    buffers = [shared_buffers.map_segment(handle) for handle in handles]
+                except OSError as e:  # e.g. segment already released
+                    self.skipped[name] = '{}: {}'.format(type(e).__name__, e)
+                    continue
+                namespace[name] = serializers.loads(format_name, value, buffers)
+        finally:
+            if release:
+                shared_buffers.release_segments(self.segments)
+        for name, target in self.aliases.items():
+            if target in namespace:
+                namespace[name] = namespace[target]
+        namespace['import_modules'] = list(self.modules)
+        return namespace
+
+
+# Types whose values never need to be tracked as aliases
+_IMMUTABLE_TYPES = {int, float, complex, bool, str, bytes, type(None)}
+
+_BYTES_TYPES = (bytes, bytearray)
+
+
+def pack_namespace(namespace, names=None, blacklist=(), meta=None,
+                   out_of_band=False, formats=None, encoders=None):
+    """
+    Pack all the /pickable/ objects (and modules) in the namespace.
+    Values are encoded by the serializer selected for their type, if any,
+    or pickled (see `serializers.dumps`).
+
+    Parameters
+    ----------
+    namespace : dict
+        The namespace to pack.
+    names : set (default: None)
+        If not None, only these names are packed.
+    blacklist : collection (default: ())
+        Names to always exclude.
+    meta : dict (default: None)
+        Meta data of the message.
+    out_of_band : bool (default: False)
+        Whether large buffers are passed out-of-band (see `shared_buffers`),
+        if the server supports it.
+    formats : collection (default: None)
+        Formats the other side can decode (None: all the available ones).
+    encoders : dict (default: None)
+        Serializers selected for each type (default: `serializers.encoders`).
+
+    Returns
+    -------
+    `PackedNamespace`
+
+    Note
+    ----
+    Names bound to the same (mutable) object are packed once (see
+    `PackedNamespace.aliases`), so that they are still bound to the
+    same object once unpacked. However, objects shared among the values
+    of different names (e.g. items of two lists) are duplicated.
+    """
+    packed = PackedNamespace(meta=meta)
+    values, aliases, skipped = packed.values, packed.aliases, packed.skipped
+    packed_ids = dict()  # id --> name (mutable objects only)
+    out_of_band = out_of_band and shared_buffers.available()
+    for name, value in namespace.items():
+        if name in blacklist or (names is not None and name not in names):
+            continue
+        if isinstance(value, ModuleType):
+            packed.modules.append((name, value.__name__))
+            continue
+        tracked = type(value) not in _IMMUTABLE_TYPES
+        if tracked and id(value) in packed_ids:
+            aliases[name] = packed_ids[id(value)]
+            continue
+        handles = list()
+        buffer_callback = rollback = None
+        to_pickle = value
+        if out_of_band:
+            buffer_callback = partial(shared_buffers.store_buffer, handles)
+            rollback = partial(_release_handles, handles)
+            if type(value) in _BYTES_TYPES and len(value) >= SHM_MIN_BUFFER_SIZE:
+                to_pickle = shared_buffers.OutOfBandBytes(value)
+        try:
+            format_name, values[name] = serializers.dumps(
+                to_pickle, formats, encoders, buffer_callback, rollback)
+        except Exception as e:
+            skipped[name] = '{}: {}'.format(type(e).__name__, e)
+        else:
+            if format_name != serializers.PICKLE:
+                packed.formats[name] = format_name
+            if tracked:
+                packed_ids[id(value)] = name
+            if handles:
+                packed.buffers[name] = handles
+    return packed
+
+
+def _release_handles(handles):
+    """Release the segments of the handles, and forget them"""
+    shared_buffers.release_segments(handles)
+    del handles[:]
+
+
+# Entry of the packed namespace wrapped by `export_namespace`
+_EXPORTED_NAMESPACE = 'namespace'
+
+
+def export_namespace(packed_ns, meta=None):
+    """
+    Wrap the (packed) namespace into a message to another node (e.g. a
+    worker agent, see `agents`), which does not share the segments of the
+    out-of-band buffers: the contents of the segments are sent along, and
+    written into segments of the other node (see `import_namespace`).
+    Segments are not released.
+
+    Parameters
+    ----------
+    packed_ns : bytes
+        The packed namespace (see `PackedNamespace.to_bytes`).
+    meta : dict (default: None)
+        Meta data of the message.
+
+    Returns
+    -------
+    `PackedNamespace` : the message, whose values are the packed
+        namespace, and the (mapped) segments by handle.
+
+    Raises
+    ------
+    OSError if a segment is not available (e.g. already released).
+    """
+    message = PackedNamespace(meta=meta)
+    message.values[_EXPORTED_NAMESPACE] = packed_ns
+    for handle in PackedNamespace.from_buffer(packed_ns).segments:
+        message.values[handle] = shared_buffers.map_segment(handle)
+    return message
+
+
+def import_namespace(message):
+    """
+    Unwrap the packed namespace of the message (see `export_namespace`),
+    writing its out-of-band buffers into new segments of this node.
+
+    Returns
+    -------
+    bytes : the packed namespace, referencing the new segments.
+    list : handles of the new segments (to be released by the caller).
+    """
+    values = message.values
+    packed = PackedNamespace.from_buffer(values.pop(_EXPORTED_NAMESPACE))
+    handles = dict()  # handle (of the other node) --> handle
+    try:
+        for handle, buffer in values.items():
+            handles[handle] = shared_buffers.write_segment(buffer)
+    except OSError:
+        shared_buffers.release_segments(handles.values())
+        raise
+    packed.buffers = {name: [handles[handle] for handle in name_handles]
+                      for name, name_handles in packed.buffers.items()}
+    return packed.to_bytes(), list(handles.values())
+
+
+def _value_digest(value):
+    """
+    Digest of the (pickled) value, along with its (out-of-band) buffers.
+
+    Functions and classes of ``__main__`` (i.e. of the notebook) are
+    digested by value, so that redefining them changes the digest.
+
+    Returns
+    -------
+    bytes : the digest.
+    bool : whether the digest may be cached as long as the fingerprint
+        of the value does not change (see `fingerprint`), i.e. unless
+        digested by value (along with the globals functions read).
+
+    Raises
+    ------
+    ValueError if the value references objects of ``__main__``,
+    and cloudpickle is not installed.
+    """
+    if isinstance(value, ModuleType):
+        return value.__name__.encode('utf-8'), True
+    buffers = list()
+    data, by_value = serializers.pickle_main(value, buffer_callback=buffers.append)
+    if by_value:
+        serializer = serializers.get(serializers.CLOUDPICKLE)
+        if serializer is None:
+            raise ValueError('Objects of __main__ are digested by value '
+                             'with cloudpickle, which is not installed')
+        buffers = list()
+        data = serializer.dumps(value, buffer_callback=buffers.append)
+    digest = hashlib.blake2b(data, digest_size=20)
+    for buffer in buffers:
+        try:
+            digest.update(buffer.raw())
+        except BufferError:  # not contiguous
+            digest.update(memoryview(buffer).tobytes())
+    return digest.digest(), not by_value
+
+
+def memo_key(source, namespace, reads, writes=None, digests=None):
+    """
+    Key of the result of the cell in the memoization cache, namely the
+    (hex) digest of the source of the cell, of the `writes` names, and of the
+    (pickled) values of the `reads` names in the namespace.
+
+    Parameters
+    ----------
+    source : str
+        The source of the cell.
+    namespace : dict
+        The namespace the cell is executed in.
+    reads : collection
+        The names read by the cell (see `cell_names`).
+    writes : collection (default: None)
+        The names written by the cell.
+    digests : dict (default: None)
+        Digests of the values of former keys (name --> (fingerprint,
+        digest)), reused as long as the fingerprint of the value does
+        not change, and updated with the new ones. The caller drops the
+        names whose values may have been changed in place.
+
+    Returns
+    -------
+    str : the key, or None if any value cannot be pickled.
+
+    Note
+    ----
+    Names also written by the cell, which are either not defined or bound
+    to modules (e.g. imported by the cell itself), are left out, so that
+    the key does not change once the cell has been run.
+    Values are digested as pickled, hence equal values may get different
+    keys, e.g. sets of strings across interpreters (whose hashes are
+    randomised), and the result is simply not found in the cache.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(pickle_dumps((source, sorted(writes or ())), HIGHEST_PROTOCOL))
+    writes = set(writes or ())
+    for name in sorted(reads):
+        if name in writes and (name not in namespace or
+                               isinstance(namespace[name], ModuleType)):
+            continue
+        digest.update(name.encode('utf-8') + b'\0')
+        if name not in namespace:
+            digest.update(b'\0')
+            continue
+        value = namespace[name]
+        value_fingerprint = fingerprint(value)
+        cached = digests.get(name, None) if digests is not None else None
+        if cached is not None and cached[0] == value_fingerprint:
+            digest.update(cached[1])
+            continue
+        try:
+            value_digest, cacheable = _value_digest(value)
+        except Exception:
+            return None
+        if digests is not None:
+            if cacheable:
+                digests[name] = (value_fingerprint, value_digest)
+            else:
+                _ = digests.pop(name, None)
+        digest.update(value_digest)
+    return digest.hexdigest()
@@ -0,0 +1,244 @@
+"""Streaming of the output (stdout and stderr) of async cells, while
+they are running.
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import io
+import sys
+from collections import deque
+from contextlib import contextmanager
+from threading import Thread, Event, Lock, local
+
+from .settings import (OUTPUT_FLUSH_INTERVAL, OUTPUT_BATCH_SIZE,
+                       OUTPUT_BUFFER_SIZE)
+
+TRUNCATED_OUTPUT = '[... output truncated ...]\n'
+
+
+class OutputBuffer:
+    """Text buffer keeping (at most) the last `max_size` characters
+    of the output."""
+
+    def __init__(self, max_size=OUTPUT_BUFFER_SIZE):
+        self.max_size = max_size
+        self.truncated = False
+        self._chunks = deque()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, text):
+        self._chunks.append(text)
+        self._size += len(text)
+        while self._size > self.max_size:
+            self.truncated = True
+            exceeding = self._size - self.max_size
+            first = self._chunks.popleft()
+            if len(first) > exceeding:
+                self._chunks.appendleft(first[exceeding:])
+                self._size -= exceeding
+            else:
+                self._size -= len(first)
+
+    def getvalue(self):
+        text = ''.join(self._chunks)
+        if self.truncated:
+            text = TRUNCATED_OUTPUT + text
+        return text
+
+
+class _StreamWriter(io.TextIOBase):
+    """File-like object replacing `sys.stdout` (or `sys.stderr`)"""
+
+    def __init__(self, streamer, name):
+        super(_StreamWriter, self).__init__()
+        self._streamer = streamer
+        self._name = name
+
+    @property
+    def name(self):
+        return '<{}>'.format(self._name)
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if not isinstance(text, str):
+            raise TypeError('write() argument must be str, not {}'.format(
+                type(text).__name__))
+        self._streamer.write(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class OutputStreamer:
+    """
+    Capture the output (both stdout and stderr) of the cell, and send it
+    in batches while the cell is running. Writes are coalesced, and sent
+    either every `flush_interval` seconds, or as soon as `batch_size`
+    characters are buffered, whichever comes first.
+
+    Parameters
+    ----------
+    send : callable
+        Function called (possibly from a background thread) with the
+        text of each batch.
+    flush_interval : float (default: `settings.OUTPUT_FLUSH_INTERVAL`)
+    batch_size : int (default: `settings.OUTPUT_BATCH_SIZE`)
+    max_size : int (default: `settings.OUTPUT_BUFFER_SIZE`)
+        Characters of the output to keep (i.e. the tail) for `getvalue`.
+
+    Examples
+    --------
+    >>> with OutputStreamer(send) as streamer:
+    ...     print('Running')
+    >>> streamer.getvalue()
+    'Running\\n'
+    """
+
+    def __init__(self, send, flush_interval=OUTPUT_FLUSH_INTERVAL,
+                 batch_size=OUTPUT_BATCH_SIZE, max_size=OUTPUT_BUFFER_SIZE):
+        self._send = send
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._output = OutputBuffer(max_size)
+        self._batch = list()
+        self._batch_chars = 0
+        self._lock = Lock()
+        self._stopped = Event()
+        self._flusher = None
+        self._saved_streams = None
+
+    def write(self, text):
+        with self._lock:
+            self._output.append(text)
+            self._batch.append(text)
+            self._batch_chars += len(text)
+            full = self._batch_chars >= self._batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch, self._batch, self._batch_chars = self._batch, list(), 0
+        if batch:
+            try:
+                self._send(''.join(batch))
+            except Exception:  # e.g. the pool has gone away
+                pass
+
+    def getvalue(self):
+        """The (tail of the) whole output"""
+        with self._lock:
+            return self._output.getvalue()
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self._flush_interval):
+            self.flush()
+
+    def start(self):
+        """Start sending the output in batches, without capturing
+        `sys.stdout` and `sys.stderr` (see `ThreadRedirection`)"""
+        self._flusher = Thread(target=self._flush_loop, daemon=True,
+                               name='OutputStreamer')
+        self._flusher.start()
+
+    def stop(self):
+        """Stop sending the output, and send the last batch"""
+        self._stopped.set()
+        self._flusher.join()
+        self.flush()
+
+    def __enter__(self):
+        self._saved_streams = sys.stdout, sys.stderr
+        sys.stdout = _StreamWriter(self, 'stdout')
+        sys.stderr = _StreamWriter(self, 'stderr')
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sys.stdout, sys.stderr = self._saved_streams
+        self.stop()
+        return False
+
+
+class _DispatchingWriter:
+    """File-like object replacing `sys.stdout` (or `sys.stderr`), writing
+    to the streamer of the current thread, if redirected, or to the
+    original stream"""
+
+    def __init__(self, redirection, stream):
+        self._redirection = redirection
+        self._stream = stream
+
+    def __getattr__(self, name):  # e.g. encoding, fileno
+        return getattr(self._stream, name)
+
+    def write(self, text):
+        streamer = self._redirection.streamer
+        if streamer is None:
+            return self._stream.write(text)
+        if not isinstance(text, str):
+            raise TypeError('write() argument must be str, not {}'.format(
+                type(text).__name__))
+        streamer.write(text)
+        return len(text)
+
+    def flush(self):
+        if self._redirection.streamer is None:
+            self._stream.flush()
+
+
+class ThreadRedirection:
+    """
+    Capture the output of (some) threads, each one into its own
+    `OutputStreamer`, leaving the output of any other thread to the
+    original streams. `sys.stdout` and `sys.stderr` are replaced as long
+    as any thread is redirected.
+
+    Examples
+    --------
+    >>> redirection = ThreadRedirection()
+    >>> with redirection.redirect(streamer):  # in the thread
+    ...     print('Running')
+    """
+
+    def __init__(self):
+        self._local = local()
+        self._lock = Lock()
+        self._redirected = 0
+        self._saved_streams = None
+        self._writers = None
+
+    @property
+    def streamer(self):
+        """The streamer of the current thread (None if not redirected)"""
+        return getattr(self._local, 'streamer', None)
+
+    @contextmanager
+    def redirect(self, streamer):
+        """Redirect the output of the current thread to the `streamer`"""
+        with self._lock:
+            if not self._redirected:
+                self._saved_streams = sys.stdout, sys.stderr
+                self._writers = (_DispatchingWriter(self, sys.stdout),
+                                 _DispatchingWriter(self, sys.stderr))
+                sys.stdout, sys.stderr = self._writers
+            self._redirected += 1
+        self._local.streamer = streamer
+        try:
+            yield streamer
+        finally:
+            self._local.streamer = None
+            with self._lock:
+                self._redirected -= 1
+                # Streams replaced in the meanwhile (e.g. by
+                # `capture_output`) are left alone
+                stdout, stderr = self._writers
+                if not self._redirected and sys.stdout is stdout and sys.stderr is stderr:
+                    sys.stdout, sys.stderr = self._saved_streams
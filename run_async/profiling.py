@@ -0,0 +1,208 @@
+"""Profiling of async cells (``%%async_run --profile``).
+
+The cell is run by the worker under `cProfile`, restricted to the code of the
+cell itself and to the functions it calls (i.e. not the machinery of the shell
+running it, such as the rendering of tracebacks), and the stats
+are aggregated into a `CellProfile`: the top functions by cumulative time,
+along with line-level timings of the functions chosen by name (if any),
+measured by a (line) trace function.
+
+The `CellProfile` is sent back to the notebook as a name of the namespace of
+the cell, and its table is appended to the output of the cell.
+Nothing of this module is involved in cells which are not profiled.
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import cProfile
+import linecache
+import os
+import pstats
+import sys
+from time import perf_counter
+
+from .settings import PROFILE_TOP_FUNCTIONS
+
+# Builtins the shell runs the (compiled) statements of cells with
+_CELL_RUNNERS = (('~', 0, '<built-in method builtins.exec>'),
+                 ('~', 0, '<built-in method builtins.eval>'))
+
+
+def _label(filename, lineno, name):
+    """Label of a function, as in `pstats` (builtins have no file)"""
+    if filename == '~':
+        return name
+    return '{}:{}({})'.format(os.path.basename(filename), lineno, name)
+
+
+def _qualname(code):
+    return getattr(code, 'co_qualname', code.co_name)  # Python < 3.11
+
+
+class CellProfile:
+    """
+    Aggregated stats of a profiled async cell.
+
+    Attributes
+    ----------
+    total_time : float
+        Seconds spent running the code of the cell (profiling included,
+        i.e. the same as the cumulative time of the cell).
+    functions : list
+        The top functions by cumulative time, as dictionaries with the
+        `function` (label), `filename`, `line`, number of `calls` (and of
+        `primitive_calls`, i.e. not recursive), `total_time` (spent in the
+        function itself) and `cumulative_time` (spent in its callees too).
+    lines : dict
+        Line-level timings, by label of the (chosen) function: lists of
+        dictionaries with the `line` number, its `hits`, the `time` spent
+        on the line (callees included), and its `source`.
+    """
+
+    def __init__(self, total_time, functions, lines=None):
+        self.total_time = total_time
+        self.functions = functions
+        self.lines = lines or dict()
+
+    def format(self):
+        """Return the (text) tables of the stats"""
+        rows = ['Profile of the cell: {:.3f} s'.format(self.total_time),
+                '{:>10} {:>10} {:>10}  {}'.format('ncalls', 'tottime', 'cumtime',
+                                                  'function')]
+        for stats in self.functions:
+            calls = str(stats['calls'])
+            if stats['primitive_calls'] != stats['calls']:
+                calls += '/{}'.format(stats['primitive_calls'])
+            rows.append('{:>10} {:>10.4f} {:>10.4f}  {}'.format(
+                calls, stats['total_time'], stats['cumulative_time'], stats['function']))
+        for function, lines in self.lines.items():
+            rows.extend(['', 'Line timings of {}'.format(function),
+                         '{:>6} {:>10} {:>10}  {}'.format('line', 'hits', 'time', 'source')])
+            for stats in lines:
+                rows.append('{:>6} {:>10} {:>10.4f}  {}'.format(
+                    stats['line'], stats['hits'], stats['time'], stats['source']))
+        return '\n'.join(rows) + '\n'
+
+    def __str__(self):
+        return self.format()
+
+    def __repr__(self):
+        return '<CellProfile: {} functions, {:.3f} s>'.format(len(self.functions),
+                                                             self.total_time)
+
+    def _repr_pretty_(self, printer, cycle):
+        printer.text(self.format())
+
+
+class CellProfiler:
+    """
+    Context manager profiling the cells run by the shell in its scope.
+
+    Only the code of the cells is profiled, as the profiler is enabled
+    around each call of `InteractiveShell.run_code` (i.e. once the cell
+    has been transformed and compiled).
+
+    Parameters
+    ----------
+    shell : `IPython.core.interactiveshell.InteractiveShell`
+        The shell running the cells.
+    top : int (default: `settings.PROFILE_TOP_FUNCTIONS`)
+        Number of functions reported, by cumulative time.
+    lines : list (default: None)
+        Names (or qualified names) of the functions timed line by line.
+    """
+
+    def __init__(self, shell, top=PROFILE_TOP_FUNCTIONS, lines=None):
+        self.shell = shell
+        self.top = top
+        self.targets = frozenset(lines or ())
+        self.profiler = cProfile.Profile()
+        self._cell_files = set()
+        self._line_timings = dict()  # code --> {line: [hits, time]}
+
+    def __enter__(self):
+        run_code = self.shell.run_code
+
+        async def profiled_run_code(code_obj, result=None, *, async_=False):
+            self._cell_files.add(code_obj.co_filename)
+            previous_trace = sys.gettrace()
+            if self.targets:
+                sys.settrace(self._trace_call)
+            self.profiler.enable()
+            try:
+                return await run_code(code_obj, result, async_=async_)
+            finally:
+                self.profiler.disable()
+                if self.targets:
+                    sys.settrace(previous_trace)
+
+        self.shell.run_code = profiled_run_code
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        del self.shell.run_code
+
+    def _trace_call(self, frame, event, arg):
+        """Global trace function: only the chosen functions are traced"""
+        code = frame.f_code
+        if code.co_name not in self.targets and _qualname(code) not in self.targets:
+            return None
+        timings = self._line_timings.setdefault(code, dict())
+        current = [None, 0.]  # line being run, and since when
+
+        def trace_lines(frame, event, arg):
+            if event == 'exception':  # the line is not over yet
+                return trace_lines
+            now = perf_counter()
+            line, started = current
+            if line is not None:
+                stats = timings.setdefault(line, [0, 0.])
+                stats[0] += 1
+                stats[1] += now - started
+            current[0] = frame.f_lineno if event == 'line' else None
+            current[1] = perf_counter()
+            return trace_lines
+
+        return trace_lines
+
+    def _cell_functions(self, stats):
+        """Return the functions of the cells, along with the
+        functions called by them (directly or not)"""
+        reached = {function for function in stats if function[0] in self._cell_files}
+        pending = set(stats).difference(reached)
+        while True:
+            called = {function for function in pending
+                      if not reached.isdisjoint(stats[function][4])}
+            if not called:
+                return reached
+            reached.update(called)
+            pending.difference_update(called)
+
+    def stats(self):
+        """Return the aggregated stats (see `CellProfile`)"""
+        functions = list()
+        stats = pstats.Stats(self.profiler).stats
+        reached = self._cell_functions(stats)
+        # Statements of cells are run by the shell (i.e. not by the cells)
+        total_time = sum(caller_stats[3] for runner in _CELL_RUNNERS if runner in stats
+                         for caller, caller_stats in stats[runner][4].items()
+                         if caller not in reached)
+        for function in reached:
+            filename, lineno, name = function
+            if filename in self._cell_files and name == '<module>':
+                continue  # statements of the cells (see `total_time`)
+            cc, nc, tt, ct, _ = stats[function]
+            functions.append({'function': _label(filename, lineno, name),
+                              'filename': filename, 'line': lineno,
+                              'calls': nc, 'primitive_calls': cc,
+                              'total_time': tt, 'cumulative_time': ct})
+        functions.sort(key=lambda stats: stats['cumulative_time'], reverse=True)
+        lines = dict()
+        for code, timings in self._line_timings.items():
+            # Sources of the cells are cached by the shell of the worker only
+            lines[_label(code.co_filename, code.co_firstlineno, _qualname(code))] = [
+                {'line': line, 'hits': hits, 'time': elapsed,
+                 'source': linecache.getline(code.co_filename, line).rstrip()}
+                for line, (hits, elapsed) in sorted(timings.items())]
+        return CellProfile(total_time, functions[:self.top], lines)
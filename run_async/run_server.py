@@ -7,50 +7,139 @@
 # Tornado Import
 try:
     from tornado.httpserver import HTTPServer
-    from tornado.ioloop import IOLoop
+    from tornado.ioloop import IOLoop, PeriodicCallback
     from tornado.web import Application, RequestHandler
-    from tornado.websocket import WebSocketHandler
+    from tornado.websocket import WebSocketHandler, WebSocketClosedError
+    from tornado.locks import Lock
+    from tornado.netutil import bind_unix_socket
 except ImportError:
     WebSocketHandler = RequestHandler = Application = object
 
 # Execution
+import asyncio
 from multiprocessing import Process as mp_Process
-# -- Python2 Compatibility WARNING
-# Python 2 requires **futures**
-# https://github.com/agronholm/pythonfutures
-from concurrent.futures import ProcessPoolExecutor
-from threading import Thread
+import os
+import hmac
+import signal
+import socket
+from ipaddress import ip_address
+from time import monotonic, time, perf_counter
+from .workers import (WorkerPool, WorkerError, JobCancelled, send_progress,
+                      preloading_context)
 
 # Shell Namespace restoring
-from inspect import ismodule as inspect_ismodule
 from importlib import import_module
 
 # Messaging
 import json
-import pickle
+from concurrent.futures import Future
+from functools import partial
+
+# Usage of resources (see `StatusRequestHandler`)
+import psutil
+
+# Diagnostics of the server (e.g. each request, at DEBUG level)
+import logging
 
 # IPython
-from IPython.utils.io import capture_output
 from IPython.core.interactiveshell import InteractiveShell
+from traitlets.config import Config
 
 # Handlers and Utils
 from .handlers import (WebSocketConnectionHandler, ResultCache,
-                       ExecutionHandler)
-from .settings import JS_ROLE, PY_ROLE, SERVER_PORT, SERVER_ADDR
-from .utils import parse_ws_connection_id
+                       ExecutionHandler, NamespaceMirror, OutputStreams,
+                       KernelChannels, JobRejected, JobRegistry, MemoCache,
+                       DependencyGraph, WorkerAgents, AgentState)
+from .settings import JS_ROLE, PY_ROLE
+from .settings import WORKER_POOL_SIZE, PRELOAD_MODULES, SESSION_TTL
+from .settings import MAX_RUNNING_JOBS, JOB_PRIORITIES, DEFAULT_JOB_PRIORITY
+from .settings import EXEC_OUTPUT, DELETED_NAMES, RESYNC_SESSION, REQUEST_ID
+from .settings import JOB_REJECTED, TIMINGS, MEMOIZABLE, MEMOIZED
+from .settings import FORMATS_HEADER, WORKERS_HEADER, SERIALIZERS
+from .settings import MEMO_CACHE_DIR
+from .settings import HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, AGENT_TOKEN
+from .settings import DEFAULT_BLACKLIST, SERVER_STOP_TIMEOUT
+from .namespace import referenced_names, snapshot, namespace_delta
+from .namespace import PackedNamespace, pack_namespace, import_namespace
+from .mapping import take_chunk
+from .serializers import available_formats
+from .shared_buffers import (create_segment_dir, remove_segment_dir, set_segment_dir,
+                             release_segments, release_process_segments)
+from .transport import MessageReader, TransferError, write_chunked
+from .output import OutputStreamer
+from .profiling import CellProfiler
+from .metrics import Metrics, timed
+from .utils import parse_ws_connection_id, format_ws_connection_id
+from .utils import server_address, set_server_address
 
+logger = logging.getLogger(__name__)
 
-def execute_cell(raw_cell, current_ns):
-    """
-    Perform the execution of the async cell
-    """
-    # Create a new InteractiveShell
-    shell = InteractiveShell()
+
+# InteractiveShell kept warm in each worker process,
+# along with its pristine user namespace
+_worker_shell = None
+_worker_shell_ns = None
+# Key of the sticky session whose namespace is resident in the worker shell
+_worker_session = None
+
+
+def _new_shell():
+    """Create a new InteractiveShell to run async cells"""
+    # Cells are run silently, so no history is needed: this also
+    # avoids all the workers to contend the (sqlite) history database
+    config = Config()
+    config.HistoryManager.enabled = False
+    shell = InteractiveShell(config=config)
     # Disable Debugger
     shell.call_pdb = False
     shell.pdb = False
+    return shell
+
+
+def warm_up_worker(segment_dir=None):
+    """Initializer of worker processes: the InteractiveShell is
+    created as soon as the worker starts, i.e. before it is needed
+    to run any cell. Shared buffers are written to `segment_dir`
+    (if not None), i.e. the folder of the port of the server."""
+    global _worker_shell, _worker_shell_ns
+    if segment_dir is not None:
+        set_segment_dir(segment_dir)
+    _worker_shell = _new_shell()
+    _worker_shell_ns = dict(_worker_shell.user_ns)
+
+
+def get_worker_shell():
+    """Return the (warm) InteractiveShell of the current worker process"""
+    if _worker_shell is None:
+        warm_up_worker()
+    return _worker_shell
+
+
+def reset_worker_shell():
+    """Restore the pristine namespace of the worker shell, releasing
+    all the objects of the last executed cell.
+
+    This is way cheaper than either creating a new shell, or
+    calling `InteractiveShell.reset`.
+    """
+    if _worker_shell is not None:
+        _worker_shell.user_ns.clear()
+        _worker_shell.user_ns.update(_worker_shell_ns)
 
-    # Process and Inject in the Namespace imported modules
+
+def release_worker_session():
+    """Drop the namespace of the sticky session (if any) resident
+    in the worker shell"""
+    global _worker_session
+    _worker_session = None
+    reset_worker_shell()
+
+
+def _load_namespace(shell, packed_ns, release=False):
+    """Inject the (packed) namespace into the shell, importing modules.
+    If `release`, the segments of out-of-band buffers are released
+    as soon as they are loaded."""
+    current_ns = PackedNamespace.from_buffer(packed_ns).unpack(release=release)
     module_names = current_ns.pop('import_modules')
     modules = {}
     if module_names:
@@ -61,31 +150,180 @@ def execute_cell(raw_cell, current_ns):
     if modules:
         shell.user_ns.update(modules)
 
-    output = ''
-    with capture_output() as io:
-        _ = shell.run_cell(raw_cell,silent=True,
-                           shell_futures=False)
 
-    # Update Namespace
-    updated_namespace = dict()
-    updated_namespace.setdefault('import_modules', list())
-    for k, v in shell.user_ns.items():
+def _pack_namespace(shell, names=None, meta=None, timings=None, out_of_band=True,
+                    serializers=None):
+    """Pack the /pickable/ objects (and modules) from the
+    shell namespace, optionally restricted to `names`.
+    Names of the shell itself (e.g. `In`, `Out`) are excluded.
+    The `timings` of the cell (if any) are sent along in the meta data.
+    Large buffers are passed out-of-band, unless not `out_of_band`
+    (e.g. results to be memoized, which outlive the segments).
+    Values are encoded in the formats the kernel can decode, by the
+    encoders it selected (see `serializers`), if any."""
+    blacklist = set(DEFAULT_BLACKLIST).union(shell.user_ns_hidden)
+    serializers = serializers or dict()
+    start = perf_counter()
+    packed_ns = pack_namespace(shell.user_ns, names=names, blacklist=blacklist,
+                               meta=meta, out_of_band=out_of_band,
+                               formats=serializers.get('formats', None),
+                               encoders=serializers.get('encoders', None))
+    if timings is not None:
+        timings.append(['repickle', perf_counter() - start, packed_ns.nbytes])
+        packed_ns.meta[TIMINGS] = timings
+    return packed_ns.to_bytes()
+
+
+def _run_cell(shell, raw_cell, outputs=None, profile=None):
+    """Run the cell in the shell, and return its output along with
+    the names changed, and deleted, by the cell, and whether the cell
+    succeeded.
+    Besides names bound to new objects, the `outputs` names written by the
+    cell (if None, all the names referenced by the cell) are changed.
+    The output is streamed to the server while the cell is running.
+    If `profile` (see `execute_cell`), the cell is run under the profiler:
+    its stats are set to the `name` of the profile, and appended to the
+    output."""
+    before = snapshot(shell.user_ns)
+    profiler = None
+    with OutputStreamer(send_progress) as output:
+        if profile is None:
+            result = shell.run_cell(raw_cell, silent=True,
+                                    shell_futures=False)
+        else:
+            with CellProfiler(shell, lines=profile['lines']) as profiler:
+                result = shell.run_cell(raw_cell, silent=True,
+                                        shell_futures=False)
+    if outputs is None:
+        touched = referenced_names(shell, raw_cell)
+    else:
+        touched = set(outputs)
+    changed, deleted = namespace_delta(shell.user_ns, before, touched)
+    output = output.getvalue()
+    if profiler is not None:
+        stats = profiler.stats()
+        shell.user_ns[profile['name']] = stats
+        changed.add(profile['name'])
+        deleted.discard(profile['name'])
+        output += stats.format()
+    return output, changed, deleted, result.success
+
+
+def _session_outputs(session):
+    return None if session is None else session.get('outputs', None)
+
+
+def _session_profile(session):
+    return None if session is None else session.get('profile', None)
+
+
+def _pack_result(shell, session, output, changed, deleted, success, timings,
+                 serializers=None):
+    """Pack the names changed by the cell, along with its output and the
+    names it deleted. Results of memoized cells (see `namespace.memo_key`)
+    are packed in-band, and flagged to be memoized if the cell succeeded."""
+    meta = {EXEC_OUTPUT: output, DELETED_NAMES: list(deleted)}
+    memoized = session is not None and session.get('memo_key', None) is not None
+    if memoized:
+        meta[MEMOIZABLE] = success
+    return _pack_namespace(shell, changed, meta=meta, timings=timings,
+                           out_of_band=not memoized, serializers=serializers)
+
+
+def execute_cell(raw_cell, packed_ns, session=None, serializers=None):
+    """
+    Perform the execution of the async cell
+
+    Parameters
+    ----------
+    raw_cell : str
+        The source of the cell to execute
+    packed_ns : bytes
+        The namespace of the cell (see `namespace.PackedNamespace`)
+    session : dict (default: None)
+        The session of the cell, namely a dictionary with the session `key`,
+        whether the session is `sticky`, whether a `full_sync` of the namespace
+        is required, the names `deleted` from the notebook namespace, and
+        the names read (`inputs`) and written (`outputs`) by the cell
+        (None if unknown, see `namespace.cell_names`), the names it
+        `imports` (see `namespace.imported_names`), along with the
+        `memo_key` of the cell (None if not memoized).
+        Profiled cells (see `profiling`) have a `profile` entry, namely the
+        `name` the stats are set to, and the names of the functions
+        timed line by line (`lines`).
+        Chunks of maps (see `mapping`) have a `map` entry, namely the
+        name of the `iterable`, the `start` and `stop` of the chunk, and
+        the `target` name of the result: the cell sees the chunk in place
+        of the iterable, and only the target is returned.
+        Only the names changed by the cell are returned, unless `session`
+        is None.
+        The namespace of a sticky session is kept resident in the worker,
+        therefore `packed_ns` only contains the names changed in the notebook
+        since the last cell.
+        Segments of out-of-band buffers are released once loaded, unless
+        owned by the namespace mirror of the server (i.e. not sticky sessions).
+    serializers : dict (default: None)
+        The `formats` the kernel can decode, and the `encoders` it selected
+        by type (see `serializers`), used to encode the result.
+
+    Returns
+    -------
+    bytes : the packed namespace after the execution of the cell, whose
+        meta data include the (captured) output of the cell, and
+        the names deleted by the cell.
+    """
+    global _worker_session
+    timings = list()
+    start = perf_counter()
+    shell = get_worker_shell()
+    if session is None or not session['sticky']:
+        if _worker_session is not None:
+            release_worker_session()
+        timings.append(['shell_setup', perf_counter() - start, None])
         try:
-            if inspect_ismodule(v):
-                updated_namespace['import_modules'].append((k, v.__name__))
-            else:
-                _ = pickle.dumps({k:v})
-                updated_namespace[k] = v
-        except TypeError:
-            continue
-        except pickle.PicklingError:
-            continue
-        except AttributeError:
-            continue
-
-    # if not output:
-    output += io.stdout
-    return output, updated_namespace
+            with timed('unpickle', len(packed_ns), timings):
+                _load_namespace(shell, packed_ns, release=session is None)
+            chunk = None if session is None else session.get('map', None)
+            if chunk is not None:
+                # The cell sees its own chunk of the iterable
+                iterable = shell.user_ns[chunk['iterable']]
+                shell.user_ns[chunk['iterable']] = take_chunk(iterable, chunk['start'],
+                                                              chunk['stop'])
+            with timed('run_cell', observations=timings):
+                output, changed, deleted, success = _run_cell(shell, raw_cell,
+                                                              _session_outputs(session),
+                                                              _session_profile(session))
+            if session is None:
+                changed, deleted = None, set()
+            elif chunk is not None:
+                # Only the result of the chunk is sent back
+                changed, deleted = changed.intersection([chunk['target']]), set()
+            return _pack_result(shell, session, output, changed, deleted,
+                                success, timings, serializers)
+        finally:
+            # Get the shell ready for the next cell
+            reset_worker_shell()
+
+    if session['full_sync'] or _worker_session != session['key']:
+        if not session['full_sync']:
+            # Session state is gone (e.g. the worker has been replaced)
+            release_segments(PackedNamespace.from_buffer(packed_ns).segments)
+            return PackedNamespace(meta={RESYNC_SESSION: True}).to_bytes()
+        release_worker_session()
+        _worker_session = session['key']
+
+    for name in session['deleted']:
+        _ = shell.user_ns.pop(name, None)
+    timings.append(['shell_setup', perf_counter() - start, None])
+    with timed('unpickle', len(packed_ns), timings):
+        _load_namespace(shell, packed_ns, release=True)
+    with timed('run_cell', observations=timings):
+        output, changed, deleted, success = _run_cell(shell, raw_cell,
+                                                      _session_outputs(session),
+                                                      _session_profile(session))
+    return _pack_result(shell, session, output, changed, deleted, success, timings,
+                        serializers)
+
 
 class AsyncRunHandler(WebSocketHandler):
     """
@@ -94,94 +332,480 @@ class AsyncRunHandler(WebSocketHandler):
     actual communication occuring on the
     web socket between the (JS) client and
     (PY) server.
+
+    Requests of many cells are multiplexed on the (persistent) connection
+    of the kernel (see `channel.KernelChannel`): each request is identified
+    by its `request_id`, namely the session_id of the cell, which is also
+    used by the JS client of the cell.
     """
 
     def __init__(self, application, request, **kwargs):
         super(AsyncRunHandler, self).__init__(application,
                                               request, **kwargs)
         self._session_id = ''
-        self._code_to_run = None
-        self._user_ns = None
+        self._requests = dict()  # request_id --> (partially) received request
+        self._receiving = None  # request whose namespace is being received
+        self._reader = MessageReader()
+        self._write_lock = Lock()
 
     # noinspection PyMethodOverriding
-    def initialize(self, connection_handler, result_cache, io_loop):
+    def initialize(self, connection_handler, result_cache, io_loop,
+                   worker_pool, namespace_mirror, output_streams,
+                   kernel_channels, scheduler, jobs, metrics, memo_cache,
+                   dependencies, agents):
         """Initialize the WebsocketHandler injecting proper handlers
         instances.
         These handlers will be used to store reference to client connections,
         to cache execution results, and to manage
         a system of output queues, respectively.
+        The (shared) worker pool is used to execute the cells, the
+        namespace mirror to merge namespace deltas sent by notebooks,
+        the output streams to buffer the output of running cells,
+        the kernel channels to keep track of requests across reconnections,
+        the scheduler (i.e. `handlers.ExecutionHandler`) to queue the
+        execution of cells, the job registry to record their state,
+        the metrics to time the phases of their round trip, the
+        memoization cache to serve the results of memoized cells, the
+        dependency graph to hold cells until the cells they depend on
+        are completed, and the worker agents to run cells on other nodes.
         """
         self._connection_handler = connection_handler
         self._execution_cache = result_cache
         self._ioloop = io_loop
+        self._worker_pool = worker_pool
+        self._namespace_mirror = namespace_mirror
+        self._output_streams = output_streams
+        self._kernel_channels = kernel_channels
+        self._scheduler = scheduler
+        self._jobs = jobs
+        self._metrics = metrics
+        self._memo_cache = memo_cache
+        self._dependencies = dependencies
+        self._agents = agents
 
     def check_origin(self, origin):
         return True
 
+    def prepare(self):
+        # Formats the workers can decode, and the number of workers (e.g.
+        # to split maps), sent on the handshake (see `channel.KernelChannel`)
+        self.set_header(FORMATS_HEADER, ','.join(available_formats()))
+        self.set_header(WORKERS_HEADER, str(self._worker_pool.max_workers +
+                                            self._agents.capacity))
+
     def open(self, connection_id):
         """
         """
-        print('Connection Opened for: ', connection_id)
+        logger.debug('Connection opened for %s', connection_id)
+        # Small messages (e.g. acknowledgements) are not delayed by
+        # Nagle's algorithm (TCP only)
+        self.set_nodelay(True)
         self._connection_id = connection_id
-        _, session_id = parse_ws_connection_id(connection_id)
+        role_name, session_id = parse_ws_connection_id(connection_id)
         self._session_id = session_id
 
         # ADD Websocket Connection
         self._connection_handler.add(connection_id, self)
 
-    def process_work_completed(self, future):
+        if role_name == PY_ROLE:
+            channel = self._kernel_channels.get(connection_id)
+            channel.connected = True
+            channel.last_used = monotonic()
+            # Send the results completed while the kernel was disconnected
+            while channel.undelivered:
+                self._ioloop.spawn_callback(self.write_namespace,
+                                            *channel.undelivered.popleft())
+
+    def process_work_completed(self, request_id, session, future, memoized=False):
         """
         Callback injected in Tornado IOLoop to be called
         whenever the future (concurrent.ProcessPoolExecutor) is completed.
+        Results of memoized cells are stored in the memoization cache,
+        unless `memoized` (i.e. served from the cache).
         """
         # This output will go to the server stdout
         # to be removed
-        print('Future Completed')
+        logger.debug('Future completed')
 
         # Get Execution results
-        output, namespace = future.result()  # potentially blocking call
+        try:
+            result = future.result()
+            packed_ns = PackedNamespace.from_buffer(result)
+            self._metrics.merge(packed_ns.meta.pop(TIMINGS, None))
+            if packed_ns.meta.pop(MEMOIZABLE, False):
+                self._memo_cache.add(session['memo_key'], packed_ns.to_bytes())
+        except Exception as e:  # e.g. the worker died
+            # Output streamed so far (if any) is not lost
+            output = ''
+            if request_id in self._output_streams:
+                output = self._output_streams.get(request_id).getvalue()
+            if isinstance(e, JobCancelled):
+                output += 'Async execution cancelled: {}\n'.format(e)
+            else:
+                output += 'Async execution failed: {}: {}\n'.format(type(e).__name__, e)
+            packed_ns = PackedNamespace(meta={EXEC_OUTPUT: output,
+                                              JOB_REJECTED: isinstance(e, JobRejected)})
+        packed_ns.meta[REQUEST_ID] = request_id
+        if memoized:
+            packed_ns.meta[MEMOIZED] = True
+
+        if packed_ns.meta.get(RESYNC_SESSION, False):
+            # The kernel will send the cell again, along with its full namespace
+            self._kernel_channels.get(self._connection_id).forget(request_id)
+            self._write_to_kernel(request_id, packed_ns.to_parts())
+            self._dependencies.done(request_id)
+            return
+
+        if session is not None and not session['sticky'] and 'map' not in session:
+            # Keep the mirror of the notebook namespace up to date (results of
+            # chunks are reduced by the kernel, and owned by the kernel)
+            self._namespace_mirror.merge(session['key'], packed_ns,
+                                         packed_ns.meta.get(DELETED_NAMES, ()))
+        # Cells depending on this cell run against the merged mirror
+        self._dependencies.done(request_id)
 
         # Post-execution processing
-        data = {'session_id': self._session_id,
+        output = packed_ns.meta[EXEC_OUTPUT]
+        data = {'session_id': request_id,
                 'output': output}
 
         # ADD Cache Result
         # print('Caching results for ', self.cache_id)
         # FIXME: This does not work if the output includes Images
-        # TODO: Try using pickle here, instead of json
         jsonified = json.dumps(data)
-        self._execution_cache.add(self._session_id, jsonified)
+        self._execution_cache.add(request_id, jsonified)
+        self._output_streams.remove(request_id)
+        # The (JS) client may be already waiting for the output
+        self._write_to_client(request_id, jsonified)
 
+        # Send to the client the updated namespace, along with the
+        # execution output to allow for *Output History UPDATE*
+        # (values of the packed namespace are forwarded as they are,
+        # i.e. never unpickled)
+        self._write_to_kernel(request_id, packed_ns.to_parts())
+
+    def _write_to_client(self, request_id, json_data):
+        """Write to the JS client of the cell, if connected"""
+        ws_conn = self._connection_handler.get(format_ws_connection_id(JS_ROLE,
+                                                                       request_id))
+        if ws_conn:
+            ws_conn.write_message(json_data)
+
+    def stream_output(self, request_id, output):
+        """Buffer the (partial) output of the running cell, and send
+        it to the JS client of the cell (if connected)"""
+        self._output_streams.get(request_id).append(output)
+        self._write_to_client(request_id, json.dumps({'session_id': request_id,
+                                                      'output': output,
+                                                      'partial': True}))
+
+    def _write_to_kernel(self, request_id, parts):
         # Get WebSocket Connection of the client to receive updates in
-        # the namespace of the cell
+        # the namespace of the cell (i.e. the current connection of the kernel)
         ws_conn = self._connection_handler.get(self._connection_id)
         if ws_conn:
-            # Send to the client the updated namespace
-            # Add Execution output to allow for *Output History UPDATE*
-            message = {'exec_output': output}
-            message.update(namespace)
-            bin_message = pickle.dumps(message)
-            # Write again on the web socket so to fire JS Client side.
-            ws_conn.write_message(bin_message, binary=True)
+            self._ioloop.spawn_callback(ws_conn.write_namespace, request_id, parts)
+        else:
+            logger.warning('No connection found for %s', self._connection_id)
+            self._kernel_channels.get(self._connection_id).undelivered.append(
+                (request_id, parts))
+
+    async def write_namespace(self, request_id, parts):
+        """Write the (packed) namespace of the request on the web socket,
+        in frames (see `transport`), announced by a JSON message (so that the
+        kernel can fail the request, should the frames be rejected). Frames
+        of different namespaces are never interleaved."""
+        async with self._write_lock:
+            try:
+                start = perf_counter()
+                await self.write_message(json.dumps({REQUEST_ID: request_id, 'result': True}))
+                await write_chunked(self, parts)
+                self._metrics.observe('result_write', perf_counter() - start,
+                                      sum(map(len, parts)))
+            except WebSocketClosedError:
+                # Sent again as soon as the kernel connects again
+                self._kernel_channels.get(self._connection_id).undelivered.append(
+                    (request_id, parts))
+
+    def schedule_cell_execution(self, request_id, code_to_run, user_ns, session,
+                                priority=DEFAULT_JOB_PRIORITY, timeout=None,
+                                serializers=None):
+        """Queue the execution of the cell in the scheduler, and acknowledge
+        the request to the kernel (or reject it, if too many cells are
+        waiting to run). The result is encoded by the `serializers` of the
+        kernel (see `execute_cell`).
+
+        Cells of (non-sticky) sessions are held until the pending cells of
+        the notebook they depend on (i.e. writing names they read or write,
+        or reading names they write) are completed, and their results
+        merged into the mirror (see `handlers.DependencyGraph`)."""
+        if session is not None and not session['sticky']:
+            # The notebook only sent the names changed since the last cell,
+            # which are merged in the mirror of the notebook namespace
+            # (the worker gets the full namespace from the mirror)
+            start = perf_counter()
+            delta = PackedNamespace.from_buffer(user_ns)
+            merged = self._namespace_mirror.merge(session['key'], delta, session['deleted'],
+                                                  session['full_sync'], session['seq'])
+            self._metrics.observe('decode', perf_counter() - start, len(user_ns))
+            if not merged:
+                release_segments(delta.segments)
+                self._resync(request_id)
+                return
+            user_ns = None
+            reads, writes = session.get('inputs', None), session.get('outputs', None)
+            if 'map' in session:
+                writes = ()  # chunks never write the mirror (see `MapJob`)
+            # Modules are the same objects, whichever cell imports them
+            imports = session.get('imports', ())
+            if reads is not None:
+                reads = set(reads).difference(imports)
+            if writes is not None:
+                writes = set(writes).difference(imports)
+            depends_on = self._dependencies.depends_on(session['key'], reads, writes)
+            if depends_on and session.get('memo_key', None) is not None:
+                # The memoization key was computed (by the kernel)
+                # on values the cells it depends on will replace
+                session = dict(session, memo_key=None)
+        memo_key = None if session is None else session.get('memo_key', None)
+        if memo_key is not None:
+            result = self._memo_cache.get(memo_key)
+            if result is not None and not self._decodable(result, serializers):
+                result = None  # run again, for a kernel lacking some formats
+            if result is not None:
+                self._serve_memoized(request_id, user_ns, session, priority, result)
+                return
+        job = partial(self.run_async_cell_execution, request_id, code_to_run,
+                      user_ns, session, timeout, serializers)
+        on_cancel = partial(self._job_failed, request_id, user_ns, session)
+        self._jobs.queued(request_id, self._connection_id, priority)
+        if session is None or session['sticky']:
+            # Cells of sticky sessions run one at a time (on their worker)
+            if self._submit_job(request_id, job, priority, on_cancel):
+                self._ack(request_id)
+            return
+        submit = partial(self._submit_job, request_id, job, priority, on_cancel)
+        depends_on = self._dependencies.add_job(
+            session['key'], request_id, reads, writes, release=submit,
+            cancel=lambda reason: on_cancel(JobCancelled(reason)))
+        if depends_on:
+            logger.debug('Holding %s until %s completed', request_id, ', '.join(depends_on))
+            self._jobs.blocked(request_id, depends_on)
+            self._ack(request_id)
+        elif submit():
+            self._ack(request_id)
+
+    def _submit_job(self, request_id, job, priority, on_cancel):
+        """Submit the job to the scheduler, and return whether it has been
+        admitted (rejected jobs are reported as failed)"""
+        self._jobs.released(request_id)
+        try:
+            self._scheduler.submit(self._connection_id, request_id, job, priority,
+                                   on_cancel=partial(self._job_not_started, on_cancel))
+        except JobRejected as e:
+            logger.warning('Rejected %s: %s', request_id, e)
+            on_cancel(e)
+            return False
+        return True
+
+    @staticmethod
+    def _job_not_started(on_cancel, reason):
+        """Report the job cancelled (with the `reason`), or failed (if
+        `reason` is the exception raised while starting it)"""
+        on_cancel(reason if isinstance(reason, Exception) else JobCancelled(reason))
+
+    @staticmethod
+    def _decodable(result, serializers):
+        """Whether the kernel can decode all the values of the result"""
+        formats = None if serializers is None else serializers.get('formats', None)
+        if formats is None:
+            return True
+        return set(PackedNamespace.from_buffer(result).formats.values()).issubset(formats)
+
+    def _serve_memoized(self, request_id, user_ns, session, priority, result):
+        """Complete the cell with its memoized `result`, without running it"""
+        logger.debug('Memoized result for %s', request_id)
+        if user_ns is not None:
+            # Never handed over to the worker (of the sticky session)
+            release_segments(PackedNamespace.from_buffer(user_ns).segments)
+        self._jobs.queued(request_id, self._connection_id, priority)
+        self._job_finished(request_id, 'cached')
+        self._ack(request_id)
+        done = Future()
+        done.set_result(result)
+        self.process_work_completed(request_id, session, done, memoized=True)
+
+    def run_async_cell_execution(self, request_id, code_to_run, user_ns, session,
+                                 timeout=None, serializers=None):
+        """Start the execution of the cell (as soon as scheduled), and
+        return a future resolved once its completion is handled (None if
+        the cell could not be started), so that the scheduler frees the
+        slot of the cell before its result reaches the kernel.
+        The cell is cancelled if not completed within `timeout` seconds."""
+        # Non-blocking: the job is queued on the shared worker pool
+        # (or on the worker of the sticky session)
+        if session is None:
+            future = self._worker_pool.submit(execute_cell, code_to_run, user_ns,
+                                              serializers=serializers)
+        elif session['sticky']:
+            future = self._worker_pool.submit_sticky(session['key'], execute_cell,
+                                                     code_to_run, user_ns,
+                                                     session=session,
+                                                     serializers=serializers)
+        else:
+            mirror = self._namespace_mirror.get(session['key'])
+            if mirror is None:  # e.g. out of sync, because of a later cell
+                self._resync(request_id)
+                return None
+            if session.get('inputs', None) is not None:
+                # Only the names read by the cell are sent to the worker
+                mirror = mirror.subset(session['inputs'])
+            agent_id = self._agents.place(self._local_load())
+            if agent_id is None:
+                future = self._worker_pool.submit(execute_cell, code_to_run,
+                                                  mirror.to_bytes(), session=session,
+                                                  serializers=serializers)
+            else:
+                future = self._agents.submit(agent_id, request_id, mirror.to_bytes(),
+                                             {'code': code_to_run, 'session': session,
+                                              'serializers': serializers})
+        self._kernel_channels.get(self._connection_id).running[request_id] = future
+        self._jobs.started(request_id, future)
+        record = self._jobs.get(request_id)
+        if record is not None:
+            self._metrics.observe('queue', record['started_at'] - record['submitted_at'])
+        timeout_handle = None
+        if timeout:
+            reason = 'Timed out after {} seconds'.format(timeout)
+            timeout_handle = self._ioloop.call_later(timeout, self._cancel_job,
+                                                     future, reason)
+        # Output is streamed by the worker (from the pool thread)
+        stream_output = partial(self._ioloop.add_callback, self.stream_output, request_id)
+        future.add_progress_callback(stream_output)
+        completed = Future()
+        self._ioloop.add_future(future, partial(self._job_completed, request_id,
+                                                user_ns, session, timeout_handle,
+                                                completed))
+        return completed
+
+    def _local_load(self):
+        """Fraction of the (shared) workers of the pool running a job"""
+        workers = [job for _, job, session_key in self._worker_pool.workers
+                   if session_key is None]
+        if not workers:
+            return 1.0
+        return sum(job is not None for job in workers) / len(workers)
+
+    def _cancel_job(self, future, reason):
+        """Cancel the job of the future, run either by a worker of the
+        pool, or by a worker agent"""
+        if future.agent_id is not None:
+            return self._agents.cancel(future, reason)
+        return self._worker_pool.cancel(future, reason)
+
+    def _job_completed(self, request_id, user_ns, session, timeout_handle, completed,
+                       future):
+        """Callback fired as soon as the execution of the cell is completed.
+        The job is `completed` (for the scheduler) on the loop, once handled."""
+        try:
+            self._handle_completion(request_id, user_ns, session, timeout_handle, future)
+        finally:
+            completed.set_result(None)
+
+    def _handle_completion(self, request_id, user_ns, session, timeout_handle, future):
+        """Record the state of the completed cell, and send back its result"""
+        if timeout_handle is not None:
+            self._ioloop.remove_timeout(timeout_handle)
+        _ = self._kernel_channels.get(self._connection_id).running.pop(request_id, None)
+        if isinstance(future.exception(), WorkerError):
+            # The worker died (e.g. killed upon cancellation): its segments
+            # (including those of the namespace of the cell) have no owner
+            if user_ns is not None:
+                release_segments(PackedNamespace.from_buffer(user_ns).segments)
+            if future.pid is not None:
+                release_process_segments(future.pid, future.started_at)
+        error = future.exception()
+        if error is None:
+            self._job_finished(request_id, 'done')
+        else:
+            self._job_finished(request_id, 'cancelled' if isinstance(error, JobCancelled)
+                               else 'failed')
+        self.process_work_completed(request_id, session, future)
+
+    def _job_failed(self, request_id, user_ns, session, error):
+        """Report the failure of the cell, never executed (e.g. rejected,
+        cancelled before being started, or failed to start)"""
+        if user_ns is not None:
+            release_segments(PackedNamespace.from_buffer(user_ns).segments)
+        if isinstance(error, JobRejected):
+            state = 'rejected'
+        elif isinstance(error, JobCancelled):
+            state = 'cancelled'
         else:
-            print("No Connection found for ", self._connection_id)
+            state = 'failed'
+        self._job_finished(request_id, state)
+        failed = Future()
+        failed.set_exception(error)
+        self.process_work_completed(request_id, session, failed)
+
+    def _job_finished(self, request_id, state):
+        self._jobs.finished(request_id, state)
+        self._metrics.job_finished(state)
 
-    def run_async_cell_execution(self):
-        with ProcessPoolExecutor() as executor:
-            future = executor.submit(execute_cell, self._code_to_run, self._user_ns)
-            self._ioloop.add_future(future, self.process_work_completed)
-            # self.process_work_completed(future)
+    def cancel_cell_execution(self, request_id, reason='Cancelled'):
+        """Cancel the cell, either waiting to run, or running
+        (whose worker is killed, and replaced)"""
+        if self._dependencies.cancel(request_id, reason) or \
+                self._scheduler.cancel(self._connection_id, request_id, reason):
+            logger.info('Cancelled %s (not started)', request_id)
+            return
+        future = self._kernel_channels.get(self._connection_id).running.get(request_id)
+        if future is not None and self._cancel_job(future, reason):
+            logger.info('Cancelled %s', request_id)
+
+    def _resync(self, request_id):
+        """Ask the kernel to send the cell again, along with
+        its full namespace"""
+        self._kernel_channels.get(self._connection_id).forget(request_id)
+        resync = PackedNamespace(meta={RESYNC_SESSION: True,
+                                       REQUEST_ID: request_id})
+        self._write_to_kernel(request_id, resync.to_parts())
+        self._dependencies.done(request_id)
+
+    def _ack(self, request_id):
+        """Acknowledge the request to the kernel"""
+        self.write_message(json.dumps({REQUEST_ID: request_id, 'ack': True}))
+
+    def _transfer_failed(self, error):
+        """Fail the request whose namespace was being received (the rest
+        of its frames are dropped, see `transport.MessageReader`): the
+        kernel reports the error, rather than sending the request again"""
+        request_id, self._receiving = self._receiving, None
+        if request_id is None or self._requests.pop(request_id, None) is None:
+            return
+        self.write_message(json.dumps({REQUEST_ID: request_id,
+                                       'error': 'Namespace not received: {}'.format(error)}))
 
     def on_message(self, message):
         """
         Handler method activated every time a new
         message is received on the web socket.
         """
-        try:
+        if isinstance(message, bytes):
+            # Binary Message: a frame of the packed namespace (whose
+            # values are only unpickled by the worker)
+            try:
+                message = self._reader.feed(message)
+            except TransferError as e:
+                logger.warning('Transfer failed for %s: %s', self._connection_id, e)
+                self._transfer_failed(e)
+                return
+            if message is None:  # more frames to come
+                return
+            self._receiving = None
+            data = PackedNamespace.from_buffer(message).meta
+        else:
             data = json.loads(message)
-        except TypeError:
-            # Binary Message
-            data = pickle.loads(message)
 
         connection_id = data.get('connection_id', '')
         role_name, _ = parse_ws_connection_id(connection_id)
@@ -193,28 +817,186 @@ class AsyncRunHandler(WebSocketHandler):
             ws_conn = self._connection_handler.get(connection_id)
             if ws_conn and json_data:
                 ws_conn.write_message(json_data)  # JS Client
-            else:
-                print('No connection nor data stored for ', role_name)
+            elif ws_conn and self._session_id in self._output_streams:
+                # The cell is still running: send the output so far
+                # (further output is sent as soon as it is received)
+                output = self._output_streams.get(self._session_id).getvalue()
+                ws_conn.write_message(json.dumps({'session_id': self._session_id,
+                                                  'output': output,
+                                                  'partial': True}))
+            elif not ws_conn:
+                logger.warning('No connection stored for %s', role_name)
 
         elif role_name == PY_ROLE:  # parse the code to run_async_cell_execution
+            channel = self._kernel_channels.get(self._connection_id)
+            channel.last_used = monotonic()
+            if 'cancel' in data:
+                self.cancel_cell_execution(data['cancel'])
+                return
+            if 'kernel_pid' in data:
+                channel.kernel_pid = data['kernel_pid']
+            request_id = data.get(REQUEST_ID, self._session_id)
+            request = self._requests.setdefault(request_id, dict())
             if 'nb_code_to_run_async' in data:
-                self._code_to_run = data['nb_code_to_run_async']
+                # The frames of its namespace follow
+                self._receiving = request_id
+                # Timings of the kernel (e.g. of previous cells)
+                self._metrics.merge(data.get(TIMINGS, None))
+                request['received_at'] = perf_counter()
+                request['code'] = data['nb_code_to_run_async']
+                request['session'] = data.get('session', None)
+                request['priority'] = data.get('priority', DEFAULT_JOB_PRIORITY)
+                request['timeout'] = data.get('timeout', None)
+                request['serializers'] = data.get(SERIALIZERS, None)
             else:  # namespace
-                self._user_ns = data
-
-            if self._code_to_run and self._user_ns:
-                # Start the execution of the cell
-                print("Starting Execution")
-                # t = Thread(target=self.run_async_cell_execution)
-                # t.start()
-                self.run_async_cell_execution()
+                request['user_ns'] = message
+                if 'received_at' in request:
+                    self._metrics.observe('transfer', perf_counter() - request['received_at'],
+                                          len(message))
+
+            if 'code' in request and 'user_ns' in request:
+                del self._requests[request_id]
+                if not channel.accept(request_id):
+                    # Sent again by the kernel (e.g. upon reconnection)
+                    self._ack(request_id)
+                    return
+                priority = request['priority']
+                if priority not in JOB_PRIORITIES:
+                    priority = DEFAULT_JOB_PRIORITY
+                # Queue the execution of the cell
+                logger.debug('Scheduling execution')
+                self.schedule_cell_execution(request_id, request['code'],
+                                             request['user_ns'], request['session'],
+                                             priority, request['timeout'],
+                                             request['serializers'])
         else:
-            print('No Action found for Role: ', role_name)
+            logger.warning('No action found for role %s', role_name)
 
     def on_close(self):
-        # REMOVE WebSocketConnection
-        print('Closing Connection for ', self._connection_id)
-        self._connection_handler.remove(self._connection_id)
+        # REMOVE WebSocketConnection (unless the kernel
+        # has already connected again)
+        logger.debug('Closing connection for %s', self._connection_id)
+        if self._connection_handler.get(self._connection_id) is self:
+            self._connection_handler.remove(self._connection_id)
+            if self._connection_id in self._kernel_channels:
+                channel = self._kernel_channels.get(self._connection_id)
+                channel.connected = False
+                channel.last_used = monotonic()
+
+
+class AgentHandler(WebSocketHandler):
+    """
+    WebSocket Handler of the worker agents (see `agents`).
+
+    Agents join the server (i.e. cells are placed on them, see
+    `handlers.WorkerAgents`) as soon as they advertise their resources,
+    and leave as soon as they disconnect (their running cells fail).
+    Results are received as packed namespaces, whose out-of-band buffers
+    are written into segments of the server (see `namespace.import_namespace`).
+    """
+
+    def __init__(self, application, request, **kwargs):
+        super(AgentHandler, self).__init__(application, request, **kwargs)
+        self._agent_id = None
+        self._reader = MessageReader()
+        self._write_lock = Lock()
+
+    # noinspection PyMethodOverriding
+    def initialize(self, agents, scheduler):
+        """Inject the handler of the worker agents, and the scheduler
+        (whose capacity grows with the workers of the agents)"""
+        self._agents = agents
+        self._scheduler = scheduler
+
+    def check_origin(self, origin):
+        return True
+
+    def open(self, agent_id):
+        self.set_nodelay(True)
+        self._agent_id = agent_id
+
+    def on_message(self, message):
+        if isinstance(message, bytes):  # a frame of a result
+            try:
+                message = self._reader.feed(message)
+            except TransferError as e:
+                logger.warning('Transfer failed for agent %s: %s', self._agent_id, e)
+                self.close()
+                return
+            if message is not None:
+                self._job_completed(PackedNamespace.from_buffer(message))
+            return
+        data = json.loads(message)
+        if 'agent' in data:
+            self._join(data['agent'])
+        elif 'progress' in data:
+            self._agents.progress(self._agent_id, data[REQUEST_ID], data['progress'])
+        elif 'error' in data:
+            self._agents.completed(self._agent_id, data[REQUEST_ID], error=data['error'],
+                                   cancelled=data.get('cancelled', False))
+
+    def _is_local(self):
+        """Whether the agent connected from the host of the server, i.e. on
+        a loopback address (or on the Unix domain socket of the server)"""
+        context = self.request.connection.context
+        if getattr(context, 'address_family', None) == getattr(socket, 'AF_UNIX', None):
+            return True
+        try:
+            return ip_address(self.request.remote_ip).is_loopback
+        except ValueError:
+            return False
+
+    def _join(self, info):
+        # Agents run any cell they are sent: with no token, only local ones join
+        if AGENT_TOKEN is None:
+            rejected = None if self._is_local() else 'Token required for remote agents'
+        elif not hmac.compare_digest(str(info.get('token', None)), AGENT_TOKEN):
+            rejected = 'Invalid token'
+        else:
+            rejected = None
+        if rejected is not None:
+            logger.warning('Rejected worker agent %s: %s', self._agent_id, rejected)
+            self.write_message(json.dumps({'rejected': rejected}))
+            self.close()
+            return
+        self._leave()  # e.g. connected again, before the former connection is closed
+        agent = AgentState(self, info)
+        self._agents.add(self._agent_id, agent)
+        self._scheduler.resize(self._scheduler.max_running + agent.workers)
+        logger.info('Worker agent %s joined (%s workers)', self._agent_id, agent.workers)
+
+    def _leave(self):
+        agent = self._agents.get(self._agent_id)
+        if agent is None:
+            return
+        self._agents.remove(self._agent_id)
+        self._scheduler.resize(self._scheduler.max_running - agent.workers)
+        logger.info('Worker agent %s left', self._agent_id)
+
+    def _job_completed(self, message):
+        request_id = message.meta[REQUEST_ID]
+        try:
+            result, handles = import_namespace(message)
+        except OSError as e:
+            self._agents.completed(self._agent_id, request_id,
+                                   error='Result not available: {}'.format(e))
+            return
+        if not self._agents.completed(self._agent_id, request_id, result):
+            release_segments(handles)
+
+    async def write_job(self, parts):
+        """Write the job (packed namespace) on the web socket, in frames
+        (see `transport`). Frames of different jobs are never interleaved."""
+        async with self._write_lock:
+            try:
+                await write_chunked(self, parts)
+            except WebSocketClosedError:
+                pass  # the job fails as the agent leaves
+
+    def on_close(self):
+        agent = self._agents.get(self._agent_id)
+        if agent is not None and agent.connection is self:
+            self._leave()
 
 
 class PingRequestHandler(RequestHandler):
@@ -224,6 +1006,114 @@ class PingRequestHandler(RequestHandler):
         self.write("Server is Up'n'Running!")
 
 
+# psutil.Process of the server and of the workers, kept across
+# requests so that their CPU usage is measured since the last request
+_processes = dict()
+
+
+def process_usage(pid):
+    """Return the CPU usage (percent, since the last call) and the
+    resident memory (bytes) of the process, if still running"""
+    process = _processes.get(pid)
+    try:
+        if process is None:
+            process = _processes[pid] = psutil.Process(pid)
+            # First measure: average usage since the process started
+            cpu_times = process.cpu_times()
+            elapsed = max(time() - process.create_time(), 1e-3)
+            cpu_percent = (cpu_times.user + cpu_times.system) / elapsed * 100
+            _ = process.cpu_percent()  # measured from now on
+        else:
+            cpu_percent = process.cpu_percent()
+        return {'pid': pid, 'cpu_percent': cpu_percent,
+                'rss': process.memory_info().rss}
+    except psutil.Error:  # e.g. the process is gone
+        _ = _processes.pop(pid, None)
+        return {'pid': pid, 'cpu_percent': None, 'rss': None}
+
+
+class MetricsRequestHandler(RequestHandler):
+    """Request Handler of the metrics of the server (see `metrics`),
+    in the Prometheus text format"""
+
+    # noinspection PyMethodOverriding
+    def initialize(self, metrics):
+        self._metrics = metrics
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self._metrics.render())
+
+
+class StatusRequestHandler(RequestHandler):
+    """Request Handler of the (JSON) status of the server, namely the
+    jobs queued, running and completed, the workers (along with their
+    CPU and memory usage), the worker agents (along with the resources
+    they advertised), and the usage of resources by each notebook
+    (i.e. by each kernel channel)."""
+
+    # noinspection PyMethodOverriding
+    def initialize(self, worker_pool, scheduler, jobs, kernel_channels, memo_cache,
+                   agents, started_at):
+        self._worker_pool = worker_pool
+        self._agents = agents
+        self._scheduler = scheduler
+        self._jobs = jobs
+        self._kernel_channels = kernel_channels
+        self._memo_cache = memo_cache
+        self._started_at = started_at
+
+    def get(self):
+        jobs = self._jobs.status()
+        job_of_pid = {job['pid']: job for job in jobs
+                      if job['state'] == 'running' and job['pid'] is not None}
+        notebooks = dict()
+        for connection_id in self._kernel_channels.entries:
+            channel = self._kernel_channels.get(connection_id)
+            notebooks[connection_id] = {'kernel_pid': channel.kernel_pid,
+                                        'connected': channel.connected,
+                                        'blocked': 0, 'queued': 0, 'running': 0,
+                                        'cpu_percent': 0.0, 'rss': 0}
+        for job in jobs:
+            if job['state'] in ('blocked', 'queued', 'running') and \
+                    job['notebook'] in notebooks:
+                notebooks[job['notebook']][job['state']] += 1
+        workers = list()
+        for pid, _, session_key in self._worker_pool.workers:
+            worker = process_usage(pid)
+            job = job_of_pid.get(pid)
+            worker['request_id'] = None if job is None else job['request_id']
+            worker['notebook'] = None if job is None else job['notebook']
+            worker['sticky_session'] = session_key
+            workers.append(worker)
+            notebook = notebooks.get(worker['notebook'])
+            if notebook is not None and worker['rss'] is not None:
+                notebook['cpu_percent'] += worker['cpu_percent']
+                notebook['rss'] += worker['rss']
+        server = process_usage(os.getpid())
+        server['uptime'] = time() - self._started_at
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'server': server,
+                               'scheduler': {'max_running': self._scheduler.max_running,
+                                             'running': self._scheduler.running,
+                                             'queued': self._scheduler.queued},
+                               'workers': workers,
+                               'agents': self._agents.status(),
+                               'memo_cache': {'entries': len(self._memo_cache.entries),
+                                              'nbytes': self._memo_cache.nbytes,
+                                              'disk_nbytes': self._memo_cache.spilled_nbytes,
+                                              'hits': self._memo_cache.hits,
+                                              'misses': self._memo_cache.misses},
+                               'notebooks': notebooks,
+                               'jobs': jobs}))
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    # Further signals must not interrupt the shutdown
+    signal.signal(signum, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
 class AsyncRunServer(mp_Process):
     """The main `multiprocessing.Process` class
     controlling the execution of the
@@ -231,44 +1121,191 @@ class AsyncRunServer(mp_Process):
 
     This class is in charge to handle
     references to the IO Loop (Tornado Loop
-    so far) and the Http Server.
+    so far), the Http Server, and the pool of
+    worker processes shared by all the sessions.
+
+    Parameters
+    ----------
+    pool_size : int (default: `settings.WORKER_POOL_SIZE`)
+        The number of worker processes executing cells.
+        If None, the number of CPUs in the machine is used.
+    max_running : int (default: `settings.MAX_RUNNING_JOBS`)
+        The maximum number of cells running at once.
+        If None, as many as the worker processes.
+    memo_dir : str (default: `settings.MEMO_CACHE_DIR`)
+        The folder the results of memoized cells are persisted in.
+        If None, results are only kept in memory.
+    preload : list (default: `settings.PRELOAD_MODULES`)
+        The modules imported once in the template (forkserver) process
+        the workers are forked from. If empty, workers are forked from
+        the server process.
+    address : `utils.ServerAddress` (default: None)
+        The address (host, port, and Unix domain socket) the server
+        listens on. If None, the current one (see `utils.server_address`).
     """
 
-    def __init__(self):
+    def __init__(self, pool_size=WORKER_POOL_SIZE, max_running=MAX_RUNNING_JOBS,
+                 memo_dir=MEMO_CACHE_DIR, preload=PRELOAD_MODULES, address=None):
         super(AsyncRunServer, self).__init__()
+        self.address = address or server_address()
         self.io_loop = None
         self.http_server = None
+        self.pool_size = pool_size
+        self.max_running = max_running
+        self.memo_dir = memo_dir
+        self.preload = list(preload or ())
+        self.worker_pool = None
+        self.scheduler = None
+        self.namespace_mirror = None
+        self.results_cache = None
+        self.kernel_channels = None
+        self.jobs = None
+        self.metrics = None
+        self.memo_cache = None
+        self.dependencies = None
+        self.agents = None
+
+    def release_idle_sessions(self):
+        """Release the sessions (namespace mirrors, and sticky sessions)
+        inactive for more than `settings.SESSION_TTL` seconds, and evict
+        results not used in the last `settings.RESULT_CACHE_TTL` seconds"""
+        self.results_cache.expire()
+        self.kernel_channels.expire(SESSION_TTL)
+        self.namespace_mirror.expire(SESSION_TTL)
+        now = monotonic()
+        for key, last_used in self.worker_pool.sticky_sessions.items():
+            if now - last_used > SESSION_TTL:
+                logger.info('Releasing idle session %s', key)
+                self.worker_pool.submit_sticky(key, release_worker_session)
+                self.worker_pool.release(key)
 
     def run(self):
         #logging.basicConfig(filename='runserver.log',level=logging.DEBUG)
 
-        IOLoop.clear_current()
-        IOLoop.clear_instance()
-        self.io_loop = IOLoop.instance()
+        # The server is forked from a process (e.g. the kernel) which may
+        # have an (asyncio) event loop already: its selector (and wake-up
+        # pipe) would be shared with the parent, stealing events of either
+        # process, hence the server runs on a brand-new loop
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.io_loop = IOLoop.current()
+        # Shared buffers (and results) go to the folders of its port
+        address = self.address
+        set_server_address(address)
+
+        # Workers are spawned once, and shared by all the sessions
+        mp_context = None
+        if self.preload:
+            # Along with the modules of the workers (e.g. IPython)
+            mp_context = preloading_context([__package__ + '.run_server'] + self.preload)
+            if mp_context is None:
+                logger.warning('Modules not preloaded: forkserver not available')
+        self.worker_pool = WorkerPool(max_workers=self.pool_size,
+                                      mp_context=mp_context,
+                                      initializer=warm_up_worker,
+                                      initargs=(address.segment_dir(),))
+        self.worker_pool.start()
+        if self.worker_pool.max_sticky_sessions < 1:
+            logger.warning('Sticky sessions (%%async_run --session) not available: '
+                           'they require at least 2 workers')
+        max_running = self.max_running
+        if max_running is None:
+            max_running = self.worker_pool.max_workers
+        self.scheduler = ExecutionHandler(self.io_loop, max_running)
+        self.namespace_mirror = NamespaceMirror()
+        output_streams = OutputStreams()
+        self.kernel_channels = KernelChannels()
+        self.jobs = JobRegistry()
+        self.metrics = Metrics()
+        self.memo_cache = MemoCache(cache_dir=self.memo_dir)
+        self.dependencies = DependencyGraph()
+        self.agents = WorkerAgents(self.io_loop)
+        sessions_check = PeriodicCallback(self.release_idle_sessions,
+                                          SESSION_TTL * 1000 / 10)
+        sessions_check.start()
 
         ws_connection_handler = WebSocketConnectionHandler()
-        results_cache = ResultCache()
+        self.results_cache = results_cache = ResultCache(spill_dir=address.spill_dir())
         tornado_app = Application(handlers=[
             (r"/ws/(.*)", AsyncRunHandler, {'connection_handler': ws_connection_handler,
                                             'result_cache': results_cache,
                                             'io_loop': self.io_loop,
+                                            'worker_pool': self.worker_pool,
+                                            'namespace_mirror': self.namespace_mirror,
+                                            'output_streams': output_streams,
+                                            'kernel_channels': self.kernel_channels,
+                                            'scheduler': self.scheduler,
+                                            'jobs': self.jobs,
+                                            'metrics': self.metrics,
+                                            'memo_cache': self.memo_cache,
+                                            'dependencies': self.dependencies,
+                                            'agents': self.agents,
                                             }),
-            (r"/ping", PingRequestHandler)])
+            (r"/agents/(.*)", AgentHandler, {'agents': self.agents,
+                                             'scheduler': self.scheduler}),
+            (r"/ping", PingRequestHandler),
+            (r"/status", StatusRequestHandler, {'worker_pool': self.worker_pool,
+                                                'scheduler': self.scheduler,
+                                                'jobs': self.jobs,
+                                                'kernel_channels': self.kernel_channels,
+                                                'memo_cache': self.memo_cache,
+                                                'agents': self.agents,
+                                                'started_at': time()}),
+            (r"/metrics", MetricsRequestHandler, {'metrics': self.metrics})],
+            # Heartbeats of (persistent) kernel channels
+            websocket_ping_interval=HEARTBEAT_INTERVAL,
+            websocket_ping_timeout=HEARTBEAT_TIMEOUT)
         self.http_server = HTTPServer(tornado_app)
+        # SIGTERM (e.g. `%async_stop_server`) stops the server gracefully
+        signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+        listening = False
+        unix_socket = None
         try:
-            self.http_server.listen(port=SERVER_PORT,
-                                    address=SERVER_ADDR)
-            if not self.io_loop._running:
-                print('Running Server Loop')
+            self.http_server.listen(port=address.port,
+                                    address=address.addr)
+            if address.socket_path is not None:
+                # Kernels connect on the Unix domain socket (only
+                # JS clients, in the browser, need the HTTP port)
+                try:
+                    self.http_server.add_socket(bind_unix_socket(address.socket_path))
+                    unix_socket = address.socket_path
+                except OSError as e:
+                    logger.warning('Unix domain socket not available: %s', e)
+            # Segments (and results) possibly left behind
+            # by a previous server are released
+            remove_segment_dir()
+            create_segment_dir()
+            results_cache.clear()
+            # Results memoized by a previous server (if persisted)
+            self.memo_cache.load()
+            listening = True
+            if not self.io_loop.asyncio_loop.is_running():
+                logger.info('Running server loop')
                 self.io_loop.start()
             else:
-                print("IOLoop already running")
+                logger.warning('IOLoop already running')
         except OSError:
-            print("Server is already running!")
+            logger.warning('Server is already running!')
         except KeyboardInterrupt:  # SIGINT, SIGTERM
-            print('Closing Server Loop')
-            self.http_server.close_all_connections()
-            self.io_loop.stop()
+            logger.info('Closing server loop')
+            # The loop is stopped already: connections are closed on it
+            self.http_server.stop()
+            try:
+                self.io_loop.run_sync(self.http_server.close_all_connections,
+                                      timeout=SERVER_STOP_TIMEOUT)
+            except (Exception, KeyboardInterrupt):
+                # e.g. timed out, or the interrupt raised again by the
+                # (handler) task it was raised in
+                pass
+        finally:
+            self.worker_pool.shutdown()
+            if listening:
+                remove_segment_dir()
+                results_cache.clear()
+            if unix_socket is not None:
+                try:
+                    os.unlink(unix_socket)
+                except OSError:
+                    pass
 
 
 if __name__ == '__main__':
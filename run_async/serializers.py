@@ -0,0 +1,408 @@
+"""Registry of the serializers (i.e. formats) of the values of namespaces.
+
+Values are pickled, unless an encoder is selected for their type (see
+`select`), and accepts the value, e.g. raw buffers for NumPy arrays, or
+Arrow IPC streams for pandas DataFrames (given back unchanged). Values that cannot be pickled (e.g. lambdas), or
+whose pickle references objects of ``__main__`` (e.g. functions and classes
+defined in the notebook, which the other side would not find), are
+pickled by value with cloudpickle, if installed.
+
+The format of each value travels along with the value (see
+`namespace.PackedNamespace`), and is only used if the other side can
+decode it: each side tells the other the formats it can decode (see
+`available_formats`), i.e. the server on the handshake of the kernel
+channel, and the kernel in each request.
+
+Each serializer keeps the count (and size) of the values it has encoded
+and decoded in the current process, along with the time spent (see `stats`).
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import io
+import struct
+from collections import OrderedDict
+from pickle import dumps as pickle_dumps
+from pickle import loads as pickle_loads
+from pickle import HIGHEST_PROTOCOL, Pickler, PickleBuffer, PicklingError
+from time import perf_counter
+from types import FunctionType
+
+try:
+    import cloudpickle
+except ImportError:
+    cloudpickle = None
+
+from .settings import TYPE_SERIALIZERS
+
+PICKLE = 'pickle'
+CLOUDPICKLE = 'cloudpickle'
+
+# Name of the module of objects defined in the notebook (or in async cells)
+_MAIN_MODULE = '__main__'
+
+
+class Serializer:
+    """Encoder (and decoder) of values, into bytes.
+
+    Like pickle (protocol 5), large buffers may be passed out-of-band: they
+    are handed over (as `pickle.PickleBuffer`) to the `buffer_callback`,
+    which returns False if the buffer has been taken out-of-band, and the
+    same buffers are given back (in order) to `loads`.
+    """
+
+    name = None
+
+    def available(self):
+        """Whether the serializer can be used (e.g. its package is installed)"""
+        return True
+
+    def accepts(self, value):
+        """Whether the serializer can encode the value"""
+        return True
+
+    def dumps(self, value, buffer_callback=None):
+        raise NotImplementedError
+
+    def loads(self, data, buffers=()):
+        raise NotImplementedError
+
+    @staticmethod
+    def _dump_buffer(buffer, buffer_callback):
+        """Hand over the (contiguous) buffer to the `buffer_callback`
+        (if any), and return it if it has to be passed in-band"""
+        buffer = PickleBuffer(buffer)
+        if buffer_callback is not None and not buffer_callback(buffer):
+            return b''
+        return buffer.raw()
+
+
+class _MainPickler(Pickler):
+    """Pickler recording whether any function or class of ``__main__``
+    has been pickled (i.e. by reference)"""
+
+    def __init__(self, file, buffer_callback=None):
+        super().__init__(file, HIGHEST_PROTOCOL, buffer_callback=buffer_callback)
+        self.references_main = False
+
+    def reducer_override(self, obj):
+        if (isinstance(obj, (type, FunctionType)) and
+                getattr(obj, '__module__', None) == _MAIN_MODULE):
+            self.references_main = True
+        return NotImplemented
+
+
+def pickle_main(value, buffer_callback=None):
+    """
+    Pickle the value (highest protocol).
+
+    Returns
+    -------
+    bytes : the pickled value (None if it references objects of
+        ``__main__`` which cannot be pickled by reference).
+    bool : whether the pickle references functions (or classes) of
+        ``__main__``, which other interpreters would not find.
+    """
+    file = io.BytesIO()
+    pickler = _MainPickler(file, buffer_callback=buffer_callback)
+    try:
+        pickler.dump(value)
+    except Exception:
+        # e.g. functions no longer bound to their name in `__main__`
+        if not pickler.references_main:
+            raise
+        return None, True
+    return file.getvalue(), pickler.references_main
+
+
+class PickleSerializer(Serializer):
+    """Default serializer: pickle (highest protocol)"""
+
+    name = PICKLE
+
+    def dumps(self, value, buffer_callback=None):
+        return pickle_dumps(value, HIGHEST_PROTOCOL, buffer_callback=buffer_callback)
+
+    def dumps_main(self, value, buffer_callback=None):
+        """Pickle the value, along with whether it references
+        objects of ``__main__`` (see `pickle_main`)"""
+        return pickle_main(value, buffer_callback=buffer_callback)
+
+    def loads(self, data, buffers=()):
+        return pickle_loads(data, buffers=buffers)
+
+
+class CloudPickleSerializer(PickleSerializer):
+    """Pickle by value of functions (e.g. lambdas) and classes defined
+    interactively, see https://github.com/cloudpipe/cloudpickle"""
+
+    name = CLOUDPICKLE
+
+    def available(self):
+        return cloudpickle is not None
+
+    def dumps(self, value, buffer_callback=None):
+        return cloudpickle.dumps(value, HIGHEST_PROTOCOL, buffer_callback=buffer_callback)
+
+
+class NumpySerializer(Serializer):
+    """Raw buffer of NumPy arrays (of any dtype but objects), along with
+    their dtype and shape.
+
+    Layout::
+
+        <header size (4 bytes)><dtype.str, shape, order (pickled)><data>
+
+    where data is empty if passed out-of-band.
+    """
+
+    name = 'numpy'
+    _HEADER_SIZE = struct.Struct('!I')
+
+    def available(self):
+        try:
+            import numpy
+        except ImportError:
+            return False
+        return True
+
+    def accepts(self, value):
+        return (not value.dtype.hasobject and
+                (value.flags.c_contiguous or value.flags.f_contiguous))
+
+    def dumps(self, value, buffer_callback=None):
+        order = 'C' if value.flags.c_contiguous else 'F'
+        header = pickle_dumps((value.dtype.str, value.shape, order), HIGHEST_PROTOCOL)
+        # Bytes in memory order (dtypes like datetime64 do not export buffers)
+        data = self._dump_buffer(value.reshape(-1, order='A').view('u1'), buffer_callback)
+        return b''.join([self._HEADER_SIZE.pack(len(header)), header, data])
+
+    def loads(self, data, buffers=()):
+        import numpy
+        data = memoryview(data)
+        header_size, = self._HEADER_SIZE.unpack_from(data)
+        offset = self._HEADER_SIZE.size + header_size
+        dtype, shape, order = pickle_loads(data[self._HEADER_SIZE.size:offset])
+        if buffers:
+            buffer = buffers[0]  # mapped copy-on-write, i.e. writable
+        else:
+            buffer = bytearray(data[offset:])
+        return numpy.frombuffer(buffer, dtype=dtype).reshape(shape, order=order)
+
+
+class ArrowSerializer(Serializer):
+    """Arrow IPC stream of pandas DataFrames (requires pyarrow).
+
+    Only DataFrames the round trip gives back unchanged are accepted,
+    namely with no object columns (nor index levels), whose values would
+    be converted (e.g. lists into arrays, or strings into the string dtype
+    of pandas 3, whichever pandas encoded them), no `attrs` (dropped by
+    former versions of pyarrow), and no frequency of the index (dropped).
+    """
+
+    name = 'arrow'
+
+    def available(self):
+        try:
+            import pandas
+            import pyarrow
+        except ImportError:
+            return False
+        return True
+
+    def accepts(self, value):
+        if value.attrs or getattr(value.index, 'freq', None) is not None:
+            return False
+        index = value.index
+        levels = index.levels if hasattr(index, 'levels') else [index]
+        return not any(dtype == object for dtype in list(value.dtypes) +
+                       [level.dtype for level in levels])
+
+    def dumps(self, value, buffer_callback=None):
+        import pyarrow
+        table = pyarrow.Table.from_pandas(value)
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return bytes(self._dump_buffer(sink.getvalue(), buffer_callback))
+
+    def loads(self, data, buffers=()):
+        import pyarrow
+        buffer = buffers[0] if buffers else data
+        with pyarrow.ipc.open_stream(pyarrow.py_buffer(buffer)) as reader:
+            return reader.read_all().to_pandas()
+
+
+_serializers = OrderedDict()  # name --> serializer
+_encoders = dict(TYPE_SERIALIZERS)  # qualified name of the type --> serializer name
+_stats = dict()  # name --> [encoded, encode seconds, decoded, decode seconds, nbytes]
+_available = dict()  # name --> whether available (checked once)
+
+
+def register(serializer):
+    """Register the serializer (replacing any serializer of the same name)"""
+    _serializers[serializer.name] = serializer
+    _ = _available.pop(serializer.name, None)
+    _ = _stats.setdefault(serializer.name, [0, 0., 0, 0., 0])
+
+
+def get(name):
+    """Return the serializer (None if not registered, or not available)"""
+    serializer = _serializers.get(name, None)
+    if serializer is None:
+        return None
+    if name not in _available:
+        _available[name] = serializer.available()
+    return serializer if _available[name] else None
+
+
+def registered():
+    """Names of all the registered serializers"""
+    return list(_serializers.keys())
+
+
+def available_formats():
+    """Names of the serializers available in the current process"""
+    return [name for name in _serializers if get(name) is not None]
+
+
+def type_name(value_type):
+    """Qualified name of the type, e.g. ``numpy.ndarray``"""
+    return '{}.{}'.format(value_type.__module__, value_type.__qualname__)
+
+
+def select(type_name, name=None):
+    """Select the serializer of the values of the type (by qualified
+    name, see `type_name`). If `name` is None, values of the type are
+    pickled."""
+    if name is None:
+        _ = _encoders.pop(type_name, None)
+    elif name not in _serializers:
+        raise ValueError('Unknown serializer: {}'.format(name))
+    else:
+        _encoders[type_name] = name
+
+
+def encoders():
+    """Serializers selected for each type (qualified name --> serializer)"""
+    return dict(_encoders)
+
+
+def stats():
+    """Count, time (seconds) spent, and size (bytes) of the values encoded and
+    decoded by each serializer (in the current process) so far"""
+    return {name: {'encoded': encoded, 'encode_time': encode_time,
+                   'decoded': decoded, 'decode_time': decode_time, 'nbytes': nbytes}
+            for name, (encoded, encode_time, decoded, decode_time, nbytes) in _stats.items()}
+
+
+def _candidates(value, formats, selected):
+    """Serializers to try on the value, in order"""
+    candidates = list()
+    name = selected.get(type_name(type(value)), None)
+    if name is not None and name != PICKLE and (formats is None or name in formats):
+        serializer = get(name)
+        if serializer is not None and serializer.accepts(value):
+            candidates.append(serializer)
+    candidates.append(_serializers[PICKLE])
+    if formats is None or CLOUDPICKLE in formats:
+        serializer = get(CLOUDPICKLE)
+        if serializer is not None:
+            candidates.append(serializer)
+    return candidates
+
+
+def dumps(value, formats=None, selected=None, buffer_callback=None, rollback=None):
+    """
+    Encode the value with the serializer selected for its type (if any),
+    or with pickle, falling back on cloudpickle.
+
+    Parameters
+    ----------
+    value : object
+        The value to encode.
+    formats : collection (default: None)
+        Formats the other side can decode (None: all the available ones).
+    selected : dict (default: None)
+        Serializers selected for each type (default: `encoders`).
+    buffer_callback : callable (default: None)
+        Callback of large buffers, to be passed out-of-band (see `Serializer`).
+    rollback : callable (default: None)
+        Called whenever the encoding of a serializer is discarded, so to
+        discard the buffers passed out-of-band along with it.
+
+    Returns
+    -------
+    (name of the serializer, bytes)
+
+    Raises
+    ------
+    The exception of the last serializer, if the value cannot be encoded.
+    """
+    if selected is None:
+        selected = _encoders
+    out_of_band = list()  # sizes of the buffers passed out-of-band
+    if buffer_callback is not None:
+        callback = buffer_callback
+
+        def buffer_callback(buffer):
+            in_band = callback(buffer)
+            if not in_band:
+                out_of_band.append(memoryview(buffer).nbytes)
+            return in_band
+
+    candidates = _candidates(value, formats, selected)
+    error = None
+    for serializer in candidates:
+        start = perf_counter()
+        del out_of_band[:]
+        references_main = False
+        try:
+            if serializer.name == PICKLE:
+                data, references_main = serializer.dumps_main(
+                    value, buffer_callback=buffer_callback)
+                if data is None:
+                    raise PicklingError('Cannot pickle objects of __main__ '
+                                        'by reference: {!r}'.format(value))
+            else:
+                data = serializer.dumps(value, buffer_callback=buffer_callback)
+        except Exception as e:
+            error = e
+        else:
+            # Objects of `__main__` are pickled by reference (i.e. by name):
+            # they are pickled by value by the next serializer, if any
+            if not references_main or serializer is candidates[-1]:
+                stats = _stats[serializer.name]
+                stats[0] += 1
+                stats[1] += perf_counter() - start
+                stats[4] += len(data) + sum(out_of_band)
+                return serializer.name, data
+        if rollback is not None:
+            rollback()
+    raise error
+
+
+def loads(name, data, buffers=()):
+    """
+    Decode the value encoded by the serializer `name`.
+
+    Raises
+    ------
+    ValueError if the serializer is not available.
+    """
+    serializer = get(name)
+    if serializer is None:
+        raise ValueError('Serializer not available: {}'.format(name))
+    start = perf_counter()
+    value = serializer.loads(data, buffers=buffers)
+    stats = _stats[name]
+    stats[2] += 1
+    stats[3] += perf_counter() - start
+    return value
+
+
+register(PickleSerializer())
+register(CloudPickleSerializer())
+register(NumpySerializer())
+register(ArrowSerializer())
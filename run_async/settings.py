@@ -5,11 +5,155 @@ Main Configuration Settings
 # Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
 # License: BSD 3 clause
 
+import os
+import socket
+import tempfile
+
 JS_ROLE = 'JS'
 PY_ROLE = 'PYTHON'
 
-SERVER_ADDR = '127.0.0.1'
-SERVER_PORT = 5678
+# Address of the server: the HTTP (and websocket) port, used by the JS clients
+# in the browser (and by the kernel), and the Unix domain socket (if not None)
+# which the kernel connects to instead (i.e. the kernel channel, see `channel`).
+# They are read from the RUN_ASYNC_SERVER_ADDR, RUN_ASYNC_SERVER_PORT and
+# RUN_ASYNC_SERVER_SOCKET (a path) environment variables, if set, e.g. to run
+# several servers side by side on the same host (folders of shared buffers,
+# and of results, are named after the port). They are the defaults of the
+# address set by `%async_start_server` (see `utils.ServerAddress`)
+SERVER_ADDR = os.environ.get('RUN_ASYNC_SERVER_ADDR', '127.0.0.1')
+SERVER_PORT = int(os.environ.get('RUN_ASYNC_SERVER_PORT', 5678))
+SERVER_SOCKET = None
+if hasattr(socket, 'AF_UNIX'):
+    SERVER_SOCKET = os.environ.get('RUN_ASYNC_SERVER_SOCKET', None) or None
+
+# Number of worker processes executing async cells
+# (None: as many as the CPUs in the machine)
+WORKER_POOL_SIZE = None
+
+# Modules (e.g. ['numpy', 'pandas']) imported once in the template process
+# the workers are forked from (i.e. a forkserver, see `workers.preloading_context`),
+# so that workers (replaced ones included) start with them already imported.
+# If empty, workers are forked from the server process
+PRELOAD_MODULES = []
+
+# Buffers (e.g. of NumPy arrays) of at least SHM_MIN_BUFFER_SIZE bytes
+# are passed out-of-band, in memory-mapped files of SHM_DIR (when available),
+# rather than in the websocket messages. The folder is named after the port
+# of the server (see `utils.set_server_address`)
+SHM_MIN_BUFFER_SIZE = 1 << 20
+SHM_DIR_TEMPLATE = os.path.join('/dev/shm', 'run_async-{port}')
+SHM_DIR = SHM_DIR_TEMPLATE.format(port=SERVER_PORT)
+
+# Serializers of the values of namespaces (see `serializers`), selected
+# by type (qualified name of the type --> name of the serializer): values
+# of other types are pickled (or pickled by value with cloudpickle, if
+# installed, e.g. functions and classes defined in the notebook).
+# pandas DataFrames are named `pandas.core.frame.DataFrame` before pandas 3,
+# and `pandas.DataFrame` since. They are sent as Arrow IPC streams only if
+# Arrow gives them back unchanged (see `serializers.ArrowSerializer`), e.g.
+# DataFrames with object columns (lists, or strings before pandas 3) are pickled
+TYPE_SERIALIZERS = {'numpy.ndarray': 'numpy',
+                    'pandas.core.frame.DataFrame': 'arrow',
+                    'pandas.DataFrame': 'arrow'}
+
+# Maximum size (bytes) of each frame of (binary) messages on websockets
+# (see `transport`), well below the default limit of Tornado (10 MiB)
+TRANSFER_CHUNK_SIZE = 1 << 20
+
+# Maximum size (bytes) of the (reassembled) binary messages received on
+# websockets, i.e. allocated upon their first frame (namespaces sent to and
+# by worker agents carry the contents of their buffers too). It is read from
+# the RUN_ASYNC_MAX_MESSAGE_SIZE environment variable, if set
+TRANSFER_MAX_MESSAGE_SIZE = int(os.environ.get('RUN_ASYNC_MAX_MESSAGE_SIZE', 4 << 30))
+
+# Kernel channels (see `channel`): seconds between heartbeats (i.e. websocket
+# pings), and before a connection without heartbeats is closed (no longer than
+# the interval, as required by Tornado); delay (seconds,
+# doubled at each attempt up to RECONNECT_MAX_DELAY) and maximum number of
+# attempts to reconnect; number of (most recent) requests remembered by the
+# server, so to never execute twice the requests sent again upon reconnection
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_TIMEOUT = 10
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 8
+RECONNECT_ATTEMPTS = 8
+CHANNEL_MAX_REQUESTS = 1024
+
+# Worker agents (see `agents`): token the agents must present to join the
+# server (None: only agents on the host of the server, i.e. connected on a
+# loopback address, are accepted), and seconds between the attempts of
+# agents to connect to the server (e.g. not running yet, or restarted)
+AGENT_TOKEN = os.environ.get('RUN_ASYNC_AGENT_TOKEN', None)
+AGENT_RECONNECT_DELAY = 2
+
+# Scheduler of async cells (see `handlers.ExecutionHandler`): maximum number
+# of cells running at once (None: as many as the worker processes), and of
+# cells waiting to run (in total, and per notebook), beyond which further
+# cells are rejected; priority levels of cells (highest first)
+MAX_RUNNING_JOBS = None
+MAX_QUEUED_JOBS = 256
+MAX_QUEUED_JOBS_PER_SESSION = 64
+JOB_PRIORITIES = ('high', 'normal', 'low')
+DEFAULT_JOB_PRIORITY = 'normal'
+
+# Execution modes of async cells: in a worker process of the server, or in
+# a thread of the kernel (see `threads`), i.e. for cells mostly waiting on
+# I/O, with no round trip to the server; number of threads in the kernel
+EXECUTION_MODES = ('process', 'thread')
+DEFAULT_EXECUTION_MODE = 'process'
+THREAD_POOL_SIZE = 8
+
+# Reductions of the per-chunk results of maps (see `%%async_map`),
+# besides functions of the notebook namespace
+MAP_REDUCERS = ('concat', 'sum', 'list')
+DEFAULT_MAP_REDUCER = 'concat'
+
+# Profiled cells (see `%%async_run --profile` and `profiling`): name of the
+# namespace the stats are set to (by default), and number of the functions
+# reported, by cumulative time
+PROFILE_NAME = 'async_profile'
+PROFILE_TOP_FUNCTIONS = 20
+
+# Number of (most recent) completed jobs listed by the status
+# of the server (see `handlers.JobRegistry`)
+JOB_HISTORY_SIZE = 100
+
+# Metrics of the round trip of async cells (see `metrics`): upper bounds
+# (seconds) of the buckets of latency histograms, and maximum number of
+# observations kept by the kernel until the next cell is sent to the server
+METRICS_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+METRICS_MAX_PENDING = 1024
+
+# Seconds granted to the server to stop gracefully (see `%async_stop_server`),
+# before being killed
+SERVER_STOP_TIMEOUT = 10
+
+# Output of async cells is streamed (see `output`) in batches, sent every
+# OUTPUT_FLUSH_INTERVAL seconds (or as soon as OUTPUT_BATCH_SIZE characters
+# are written), and only its last OUTPUT_BUFFER_SIZE characters are kept
+OUTPUT_FLUSH_INTERVAL = 0.5
+OUTPUT_BATCH_SIZE = 1 << 16
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Results of async cells (i.e. their output, to be sent to JS clients) are
+# kept in memory up to RESULT_CACHE_SIZE bytes, and for RESULT_CACHE_TTL
+# seconds since their last use. Then, they are spilled to RESULT_SPILL_DIR
+# (if not None) up to RESULT_SPILL_MAX_SIZE bytes, as well as results of
+# at least RESULT_SPILL_MIN_SIZE bytes (the folder is named after the port).
+RESULT_CACHE_SIZE = 32 << 20
+RESULT_CACHE_TTL = 3600
+RESULT_SPILL_DIR_TEMPLATE = os.path.join(tempfile.gettempdir(), 'run_async-results-{port}')
+RESULT_SPILL_DIR = RESULT_SPILL_DIR_TEMPLATE.format(port=SERVER_PORT)
+RESULT_SPILL_MIN_SIZE = 1 << 20
+RESULT_SPILL_MAX_SIZE = 1 << 30
+
+# Results of memoized async cells (see `%%async_run --memoize`) are kept in
+# memory up to MEMO_CACHE_SIZE bytes (least recently used results are evicted
+# first) and, if MEMO_CACHE_DIR is not None, persisted in that folder up to
+# MEMO_CACHE_DISK_SIZE bytes, so that they survive restarts of the server
+MEMO_CACHE_SIZE = 256 << 20
+MEMO_CACHE_DIR = None
+MEMO_CACHE_DISK_SIZE = 4 << 30
 
 # Separator String for WebSocket connections
 CONNECTION_ID_SEP = '---'
@@ -19,6 +163,13 @@ LIGHT_HTML_OUTPUT_CELL = '''
 <pre class="{session_id}-output" style="display: none"></pre>
 '''
 
+# Output of async cells shown by the kernel itself (i.e. cells run in
+# threads, and maps), replacing (i.e. updating the display of) their
+# LIGHT_HTML_OUTPUT_CELL placeholder
+KERNEL_HTML_OUTPUT_CELL = '''
+<pre class="{session_id}-output">{output}</pre>
+'''
+
 # Not Yet Used
 CSS_CODE = '''
 
@@ -128,7 +279,7 @@ function checkCookie() {
 
 function requestCellOutput() {
 
-    var host = 'ws://localhost:5678/ws/__connection_id__';
+    var host = 'ws://localhost:__port__/ws/__connection_id__';
 
     var ws = new WebSocket(host);
 
@@ -141,7 +292,14 @@ function requestCellOutput() {
     ws.onmessage = function(evt){
         var res = $.parseJSON(evt.data);
         var session_id = "__sessionid__";
-        if (session_id == res.session_id) {
+        if (session_id == res.session_id && res.partial) {
+            // Output streamed while the cell is running
+            if (res.output.length > 0){
+                $('pre[class="__sessionid__-output"]').append(IPython.utils.fixConsole(res.output));
+                $('pre[class="__sessionid__-waiting"]').hide();
+                $('pre[class="__sessionid__-output"]').show();
+            }
+        } else if (session_id == res.session_id) {
             $('pre[class="__sessionid__-output"]').html(IPython.utils.fixConsole(res.output));
             $('pre[class="__sessionid__-waiting"]').hide();
             if (res.output.length > 0){
@@ -171,9 +329,38 @@ $(document).ready(function(){
 '''
 
 EXEC_OUTPUT = 'exec_output'
+REQUEST_ID = 'request_id'
+# Timings of the phases of the round trip (see `metrics`)
+TIMINGS = 'timings'
+
+# Delta transfer of namespaces: names deleted from the namespace,
+# and request (to the kernel) of a full namespace synchronisation
+DELETED_NAMES = 'deleted_names'
+RESYNC_SESSION = 'resync_session'
+
+# Cell rejected by the scheduler of the server (i.e. never executed)
+JOB_REJECTED = 'job_rejected'
+
+# Memoization of async cells: result of the cell to be memoized (i.e. the
+# cell succeeded), and result served from the memoization cache
+MEMOIZABLE = 'memoizable'
+MEMOIZED = 'memoized'
+
+# Negotiation of the serializers (see `serializers`): header of the handshake
+# of the kernel channel, listing the formats the server can decode, and entry
+# of requests, with the formats the kernel can decode and its encoders by type
+FORMATS_HEADER = 'X-Run-Async-Formats'
+SERIALIZERS = 'serializers'
+# Header of the handshake of the kernel channel, telling the number of
+# workers of the server (i.e. local workers and workers of agents)
+WORKERS_HEADER = 'X-Run-Async-Workers'
+
+# Seconds of inactivity after which a session is released, i.e. its
+# namespace is dropped from the server (and from the sticky worker)
+SESSION_TTL = 3600
 
 # List of names to be excluded from pickling during the async process
 DEFAULT_BLACKLIST = ['__builtin__', '__builtins__', '__doc__',
                      '__loader__', '__name__', '__package__',
-                     '__spec__', '_sh', 'exit', 'quit', 'MyMagics',
+                     '__spec__', '_sh', 'exit', 'quit', 'get_ipython', 'MyMagics',
                      'AsyncRunMagic', 'Magics', 'cmagic', 'magics_class']
\ No newline at end of file
@@ -0,0 +1,125 @@
+"""Out-of-band transfer of large buffers (e.g. of NumPy arrays), through
+memory-mapped files shared by the notebook kernel, the server, and the workers.
+
+Large buffers exposed by objects supporting pickle protocol 5 (see PEP 574)
+are written (once) into a *segment*, i.e. a file in `settings.SHM_DIR` (the
+folder of the port of the server, see `set_segment_dir`), and
+only the *handle* of the segment (its file name) travels along with the
+pickled object. The receiving side maps the segment in memory, and the object
+is unpickled without copying its buffer.
+
+Segments are mapped copy-on-write, so that in place changes are never seen
+by the other processes. Each segment is released (unlinked) by its owner:
+the server, for segments referenced by the mirror of a notebook namespace,
+or the receiving side otherwise. Mappings outlive their (unlinked) files,
+and the whole folder is removed when the server stops.
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import os
+import mmap
+import shutil
+from pickle import PickleBuffer
+from uuid import uuid4
+
+from .settings import SHM_DIR, SHM_MIN_BUFFER_SIZE
+
+# Folder of the segments (i.e. of the port of the server, see `set_segment_dir`)
+_segment_dir = SHM_DIR
+
+
+def set_segment_dir(path):
+    """Set the folder of the segments (e.g. of another server, see
+    `utils.set_server_address`), in this process"""
+    global _segment_dir
+    _segment_dir = path
+
+
+def segment_dir():
+    """Return the folder of the segments"""
+    return _segment_dir
+
+
+def available():
+    """Whether segments can be used, i.e. the server has created the folder"""
+    return os.path.isdir(_segment_dir)
+
+
+def create_segment_dir():
+    """Create the folder of the segments, if shared memory
+    (i.e. `/dev/shm`) is supported by the system"""
+    if os.path.isdir(os.path.dirname(_segment_dir)):
+        os.makedirs(_segment_dir, exist_ok=True)
+
+
+def remove_segment_dir():
+    """Release all the segments, removing their folder"""
+    shutil.rmtree(_segment_dir, ignore_errors=True)
+
+
+def write_segment(buffer):
+    """Copy the (contiguous) buffer into a new segment, and return its handle
+    (prefixed by the PID of the process, see `release_process_segments`)"""
+    handle = '{}-{}'.format(os.getpid(), uuid4().hex)
+    with open(os.path.join(_segment_dir, handle), 'xb') as f:
+        f.write(buffer)
+    return handle
+
+
+def map_segment(handle):
+    """Map the segment in memory (copy-on-write), and return the mapping"""
+    with open(os.path.join(_segment_dir, handle), 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+
+def release_segments(handles):
+    """Unlink the segments. Existing mappings are still valid."""
+    for handle in handles:
+        try:
+            os.unlink(os.path.join(_segment_dir, handle))
+        except OSError:  # e.g. already released
+            pass
+
+
+def release_process_segments(pid, since):
+    """Release the segments written by the process `pid` since the
+    (wall-clock) time `since`, e.g. by a worker killed while
+    executing a job (whose segments have no owner)."""
+    prefix = '{}-'.format(pid)
+    try:
+        entries = list(os.scandir(_segment_dir))
+    except OSError:  # e.g. shared memory not available
+        return
+    for entry in entries:
+        try:
+            if entry.name.startswith(prefix) and entry.stat().st_mtime >= since:
+                os.unlink(entry.path)
+        except OSError:  # e.g. already released
+            pass
+
+
+def store_buffer(handles, buffer):
+    """`buffer_callback` of `pickle.dumps`: buffers of at least
+    `SHM_MIN_BUFFER_SIZE` bytes are written into segments (whose handles
+    are appended to `handles`), and therefore pickled out-of-band."""
+    try:
+        raw = buffer.raw()
+    except BufferError:  # non-contiguous buffer
+        return True
+    if raw.nbytes < SHM_MIN_BUFFER_SIZE:
+        return True
+    handles.append(write_segment(raw))
+    return False
+
+
+class OutOfBandBytes:
+    """Wrapper of (large) `bytes` and `bytearray` objects, which
+    are otherwise always pickled in-band"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce_ex__(self, protocol):
+        return type(self.value), (PickleBuffer(self.value),)
@@ -0,0 +1,175 @@
+"""Execution of async cells in a pool of threads of the notebook kernel
+(see `%%async_run --mode thread`), i.e. with no round trip to the server:
+no websocket, no (de)serialization of the namespace, and no worker process.
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import ast
+import asyncio
+import sys
+import traceback
+from ast import PyCF_ALLOW_TOP_LEVEL_AWAIT, PyCF_ONLY_AST
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from inspect import CO_COROUTINE
+
+from IPython.lib.pretty import pretty
+from tornado.ioloop import IOLoop
+
+from .settings import THREAD_POOL_SIZE
+from .namespace import referenced_names, snapshot, namespace_delta
+from .output import OutputBuffer, OutputStreamer, ThreadRedirection
+from .utils import update_output_cell
+
+# Name the value of the last expression of the cell is bound to, while
+# the cell runs (see `ThreadRunner._execute`)
+_RESULT_NAME = '_async_cell_result'
+
+
+class ThreadRunner:
+    """
+    Pool of threads running async cells in the kernel, each one against a
+    snapshot (i.e. a shallow copy) of the notebook namespace. Once the cell
+    is completed, the names it changed are merged back into the notebook
+    namespace (see `CellRequest.on_thread_result`) on the IOLoop of the
+    kernel, and its output replaces the `LIGHT_HTML_OUTPUT_CELL`
+    placeholder of the cell (whose display ID is the ID of the request).
+    The output is streamed into the placeholder while the cell is running.
+    As in the notebook, the value of the last expression of the cell (if
+    not None, and not followed by a semicolon) is part of the output.
+
+    Values are shared with the cell (i.e. not copied), and threads hold the
+    GIL while running Python code: threads fit cells mostly waiting on disk,
+    network, or subprocesses. Cells waiting for a thread can be cancelled,
+    whereas running cells cannot.
+
+    Parameters
+    ----------
+    pool_size : int (default: `settings.THREAD_POOL_SIZE`)
+        Number of threads running the cells.
+    """
+
+    def __init__(self, pool_size=THREAD_POOL_SIZE):
+        self.pool_size = pool_size
+        self._pool = ThreadPoolExecutor(max_workers=pool_size,
+                                        thread_name_prefix='AsyncCell')
+        self._redirection = ThreadRedirection()
+        self._futures = OrderedDict()  # request_id --> future
+        self._outputs = dict()  # request_id --> output streamed so far
+
+    @property
+    def requests(self):
+        """IDs of the pending requests (in order of submission)"""
+        return list(self._futures.keys())
+
+    def submit(self, request, on_merged=None):
+        """
+        Run the cell of the request in a thread.
+
+        Parameters
+        ----------
+        request : `async_run_magic.CellRequest`
+        on_merged : callable (default: None)
+            Called with the names changed (and deleted) by the cell, once
+            they are merged back into the notebook namespace.
+        """
+        shell = request.shell
+        source = shell.transform_cell(request.cell_source)
+        # Source lines of tracebacks are looked up in the cache of the shell
+        filename = shell.compile.cache(source, request.exec_count,
+                                       raw_code=request.cell_source)
+        touched = request.writes
+        if touched is None:
+            touched = referenced_names(shell, request.cell_source)
+        namespace = dict(shell.user_ns)
+        before = snapshot(namespace)
+
+        io_loop = IOLoop.current()
+        self._outputs[request.request_id] = OutputBuffer()
+        streamer = OutputStreamer(partial(io_loop.add_callback, self._stream, request))
+        future = self._pool.submit(self._execute, source, filename, namespace, streamer)
+        self._futures[request.request_id] = future
+        io_loop.add_future(future, partial(self._completed, request, namespace, before,
+                                           touched, streamer, on_merged))
+
+    def cancel(self, request_id):
+        """Cancel the request, unless its cell is running already.
+
+        Returns
+        -------
+        bool : False if the request is not pending, or its cell is running.
+        """
+        future = self._futures.get(request_id, None)
+        return future is not None and future.cancel()
+
+    def shutdown(self):
+        """Cancel the cells waiting for a thread, and release the threads
+        as soon as the running cells are completed"""
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _compile(source, filename):
+        """Compile the cell, binding the value of its last expression
+        (if any) to `_RESULT_NAME`, so that its value is displayed.
+
+        Returns
+        -------
+        (code object, whether the value of the last expression is displayed)
+        """
+        flags = PyCF_ALLOW_TOP_LEVEL_AWAIT
+        tree = compile(source, filename, 'exec', flags=flags | PyCF_ONLY_AST,
+                       dont_inherit=True)
+        displayed = (bool(tree.body) and isinstance(tree.body[-1], ast.Expr) and
+                     not source.rstrip().endswith(';'))
+        if displayed:
+            last = tree.body[-1]
+            tree.body[-1] = ast.copy_location(
+                ast.Assign(targets=[ast.Name(_RESULT_NAME, ast.Store())],
+                           value=last.value), last)
+            ast.fix_missing_locations(tree)
+        return compile(tree, filename, 'exec', flags=flags, dont_inherit=True), displayed
+
+    def _execute(self, source, filename, namespace, streamer):
+        """Run the (transformed) source of the cell in the namespace, in
+        the current thread. Tracebacks are part of the output of the cell."""
+        streamer.start()
+        try:
+            with self._redirection.redirect(streamer):
+                try:
+                    code, displayed = self._compile(source, filename)
+                    result = eval(code, namespace)
+                    if code.co_flags & CO_COROUTINE:  # top-level `await`
+                        asyncio.run(result)
+                    value = namespace.pop(_RESULT_NAME, None)
+                    if displayed and value is not None:
+                        print(pretty(value))
+                except (Exception, SystemExit):
+                    etype, value, tb = sys.exc_info()
+                    # Frames of the runner are left out
+                    traceback.print_exception(etype, value, tb.tb_next)
+        finally:
+            streamer.stop()
+
+    def _stream(self, request, text):
+        """Show the output of the cell streamed so far"""
+        output = self._outputs.get(request.request_id, None)
+        if output is not None:
+            output.append(text)
+            update_output_cell(request.request_id, output.getvalue())
+
+    def _completed(self, request, namespace, before, touched, streamer, on_merged, future):
+        _ = self._futures.pop(request.request_id, None)
+        _ = self._outputs.pop(request.request_id, None)
+        if future.cancelled():
+            update_output_cell(request.request_id, 'Cancelled')
+            return
+        changed, deleted = namespace_delta(namespace, before, touched)
+        exec_output = streamer.getvalue()
+        request.on_thread_result({name: namespace[name] for name in changed},
+                                 deleted, exec_output)
+        if on_merged is not None:
+            on_merged(changed, deleted)
+        update_output_cell(request.request_id, exec_output)
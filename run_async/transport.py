@@ -0,0 +1,159 @@
+"""Framed, chunked transfer of (binary) messages over websockets.
+
+Binary messages (i.e. packed namespaces) are split into frames of at most
+`settings.TRANSFER_CHUNK_SIZE` bytes of payload, well below the maximum
+websocket message size of Tornado. Each frame is laid out as::
+
+    <message ID (4 bytes)><message size (8 bytes)><offset (8 bytes)>
+    <CRC-32 of the payload (4 bytes)><payload>
+
+Frames are written one at a time (i.e. the next frame is written once the
+previous one has been flushed), and never require to join the whole message
+in memory. On the receiving side, frames are reassembled in place, in a
+buffer allocated once for the whole message (of at most
+`settings.TRANSFER_MAX_MESSAGE_SIZE` bytes). Once a frame is rejected, the
+remaining frames of its message are dropped, up to the first frame
+(i.e. at offset 0) of the next message.
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import struct
+from itertools import count
+from zlib import crc32
+
+from .settings import TRANSFER_CHUNK_SIZE, TRANSFER_MAX_MESSAGE_SIZE
+
+_FRAME_HEADER = struct.Struct('!IQQI')
+
+# IDs of the messages written by this process
+_message_ids = count()
+
+
+class TransferError(ValueError):
+    """Raised whenever a frame is corrupted, or does not
+    match the message being reassembled."""
+
+
+def iter_frames(parts, chunk_size=TRANSFER_CHUNK_SIZE, message_id=None):
+    """
+    Split the message into frames.
+
+    Parameters
+    ----------
+    parts : list
+        The (bytes-like) parts of the message, e.g. as
+        returned by `namespace.PackedNamespace.to_parts`.
+    chunk_size : int (default: `settings.TRANSFER_CHUNK_SIZE`)
+        The maximum size of the payload of each frame.
+    message_id : int (default: None)
+        The ID of the message, carried by each frame. If None,
+        the next ID of the messages of this process.
+
+    Yields
+    ------
+    bytes : the frames of the message.
+    """
+    if message_id is None:
+        message_id = next(_message_ids) & 0xFFFFFFFF
+    parts = [memoryview(part).cast('B') for part in parts]
+    total = sum(part.nbytes for part in parts)
+    chunk, chunk_bytes, checksum, start = list(), 0, 0, 0
+    for part in parts:
+        offset = 0
+        while offset < part.nbytes:
+            piece = part[offset:offset + chunk_size - chunk_bytes]
+            chunk.append(piece)
+            checksum = crc32(piece, checksum)
+            chunk_bytes += piece.nbytes
+            offset += piece.nbytes
+            if chunk_bytes == chunk_size:
+                yield b''.join([_FRAME_HEADER.pack(message_id, total, start, checksum)] +
+                               chunk)
+                start += chunk_bytes
+                chunk, chunk_bytes, checksum = list(), 0, 0
+    if chunk or not total:
+        yield b''.join([_FRAME_HEADER.pack(message_id, total, start, checksum)] + chunk)
+
+
+async def write_chunked(ws_conn, parts, chunk_size=TRANSFER_CHUNK_SIZE):
+    """Write the message on the websocket connection (either side),
+    one frame at a time (see `iter_frames`)."""
+    for frame in iter_frames(parts, chunk_size):
+        await ws_conn.write_message(frame, binary=True)
+
+
+class MessageReader:
+    """Reassemble messages from their frames, as received
+    from the websocket connection.
+
+    Parameters
+    ----------
+    max_size : int (default: `settings.TRANSFER_MAX_MESSAGE_SIZE`)
+        The maximum size of the messages (larger ones are rejected
+        upon their first frame, i.e. before being allocated).
+    """
+
+    def __init__(self, max_size=TRANSFER_MAX_MESSAGE_SIZE):
+        self.max_size = max_size
+        self._message_id = None
+        self._buffer = None
+        self._received = 0
+
+    def reset(self):
+        self._message_id = None
+        self._buffer = None
+        self._received = 0
+
+    def feed(self, frame):
+        """
+        Add the frame to the message being reassembled.
+
+        Returns
+        -------
+        bytearray : the whole message, once its last frame is
+            received, None otherwise (or if the frame is dropped,
+            i.e. part of a message already rejected).
+
+        Raises
+        ------
+        TransferError : if the frame is corrupted, or does not follow the
+            frame received last, or exceeds the size of the message (or the
+            message the maximum size): the message being reassembled is
+            discarded, along with its remaining frames.
+        """
+        frame = memoryview(frame)
+        try:
+            message_id, total, offset, checksum = _FRAME_HEADER.unpack_from(frame)
+        except struct.error:
+            self.reset()
+            raise TransferError('Truncated frame')
+        payload = frame[_FRAME_HEADER.size:]
+        if crc32(payload) != checksum:
+            self.reset()
+            raise TransferError('Corrupted frame (CRC-32 mismatch)')
+        if self._buffer is None:
+            if offset != 0:  # the rest of a rejected message
+                return None
+        elif (message_id != self._message_id or offset != self._received or
+              len(self._buffer) != total):
+            self.reset()
+            raise TransferError('Frame of a different message')
+        end = offset + payload.nbytes
+        if end > total:
+            self.reset()
+            raise TransferError('Frame exceeding the message size')
+        if self._buffer is None:
+            if total > self.max_size:
+                raise TransferError('Message of {} bytes exceeding the maximum '
+                                    'size ({} bytes)'.format(total, self.max_size))
+            self._message_id = message_id
+            self._buffer = bytearray(total)
+        self._buffer[offset:end] = payload
+        self._received = end
+        if end < total:
+            return None
+        message = self._buffer
+        self.reset()
+        return message
@@ -4,8 +4,18 @@
 # Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
 # License: BSD 3 clause
 
+import os
+import socket
+from html import escape
+from http.client import HTTPConnection
+from urllib.request import urlopen
+
+from IPython.display import HTML, update_display
 from IPython.utils.coloransi import TermColors, color_templates
-from .settings import SERVER_ADDR, SERVER_PORT, CONNECTION_ID_SEP
+from .settings import SERVER_ADDR, SERVER_PORT, SERVER_SOCKET, CONNECTION_ID_SEP
+from .settings import SHM_DIR_TEMPLATE, RESULT_SPILL_DIR, RESULT_SPILL_DIR_TEMPLATE
+from .settings import KERNEL_HTML_OUTPUT_CELL
+from .shared_buffers import set_segment_dir
 
 COLORS = [color[1] for color in color_templates]
 
@@ -29,13 +39,160 @@ def strip_ansi_color(text):
     return text
 
 
-def connection_string(web_socket=True, extra=''):
-    if web_socket:
-        protocol = 'ws'
-    else:
-        protocol = 'http'
-    return '{proto}://{server}:{port}/{extra}'.format(proto=protocol, server=SERVER_ADDR,
-                                                      port= SERVER_PORT, extra=extra)
+def update_output_cell(session_id, output):
+    """Replace the `LIGHT_HTML_OUTPUT_CELL` placeholder of the async cell
+    (displayed with the `session_id` as display ID) with its output"""
+    output = escape(strip_ansi_color(output)) if output else ''
+    update_display(HTML(KERNEL_HTML_OUTPUT_CELL.format(session_id=session_id,
+                                                       output=output)),
+                   display_id=session_id)
+
+
+class ServerAddress:
+    """
+    Address of the server: its HTTP (and websocket) host and port, used by
+    the JS clients in the browser (and by the kernel), and its Unix domain
+    socket (if any), which the kernel connects to instead.
+
+    Parameters
+    ----------
+    addr : str (default: `settings.SERVER_ADDR`)
+        The host the server listens on.
+    port : int (default: `settings.SERVER_PORT`)
+        The HTTP port of the server (folders of shared buffers,
+        and of results, are named after the port).
+    socket_path : str (default: `settings.SERVER_SOCKET`)
+        The path of the Unix domain socket of the server (None: TCP only).
+    """
+
+    def __init__(self, addr=None, port=None, socket_path=None):
+        self.addr = addr or SERVER_ADDR
+        self.port = int(port or SERVER_PORT)
+        if socket_path is None:
+            socket_path = SERVER_SOCKET
+        self.socket_path = socket_path or None
+
+    def connection_string(self, web_socket=True, extra=''):
+        protocol = 'ws' if web_socket else 'http'
+        return '{proto}://{server}:{port}/{extra}'.format(proto=protocol, server=self.addr,
+                                                          port=self.port, extra=extra)
+
+    def unix_socket(self):
+        """Return the path of the Unix domain socket of the server,
+        if the server listens on one (None otherwise, i.e. TCP only)"""
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            return self.socket_path
+        return None
+
+    def segment_dir(self):
+        """Return the folder of the shared buffers (see `shared_buffers`)"""
+        return SHM_DIR_TEMPLATE.format(port=self.port)
+
+    def spill_dir(self):
+        """Return the folder results are spilled to (see `handlers.ResultCache`),
+        None if results are not spilled (i.e. `settings.RESULT_SPILL_DIR` is None)"""
+        if RESULT_SPILL_DIR is None:
+            return None
+        return RESULT_SPILL_DIR_TEMPLATE.format(port=self.port)
+
+    def __repr__(self):
+        address = '{}:{}'.format(self.addr, self.port)
+        if self.socket_path is not None:
+            address += ' ({})'.format(self.socket_path)
+        return '<ServerAddress: {}>'.format(address)
+
+
+# Address of the server the kernel connects to (see `set_server_address`)
+_server_address = ServerAddress()
+
+
+def server_address():
+    """Return the current address of the server (see `ServerAddress`)"""
+    return _server_address
+
+
+def set_server_address(address):
+    """
+    Set the address of the server, read on each (further) connection to the
+    server, e.g. as chosen by `%async_start_server --port`. Shared buffers
+    are written to, and read from, the folder of its port from now on.
+
+    Parameters
+    ----------
+    address : `ServerAddress`
+        The new address of the server.
+    """
+    global _server_address
+    _server_address = address
+    set_segment_dir(address.segment_dir())
+
+
+def connection_string(web_socket=True, extra='', address=None):
+    """Return the URL of the resource `extra` of the server
+    (at `address`, or at the current address of the server)"""
+    return (address or _server_address).connection_string(web_socket, extra)
+
+
+def server_socket(address=None):
+    """Return the path of the Unix domain socket of the server,
+    if the server listens on one (None otherwise, i.e. TCP only)"""
+    return (address or _server_address).unix_socket()
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """HTTP connection over a Unix domain socket"""
+
+    def __init__(self, path, timeout=None, address=None):
+        address = address or _server_address
+        super(UnixHTTPConnection, self).__init__(address.addr, address.port, timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def server_request(extra='', timeout=10, address=None):
+    """
+    GET the resource of the server (e.g. `ping`), on its Unix domain
+    socket if any (see `server_socket`), or on its HTTP port otherwise.
+
+    Parameters
+    ----------
+    extra : str
+        The resource, e.g. `ping` or `status`.
+    timeout : float (default: 10)
+        Seconds before the request is abandoned.
+    address : `ServerAddress` (default: None)
+        The address of the server. If None, the current one
+        (see `server_address`).
+
+    Returns
+    -------
+    bytes : the body of the response.
+
+    Raises
+    ------
+    OSError : if the server is not reachable (e.g. `URLError`),
+        or the response is not successful.
+    """
+    address = address or _server_address
+    path = address.unix_socket()
+    if path is None:
+        return urlopen(address.connection_string(web_socket=False, extra=extra),
+                       timeout=timeout).read()
+    connection = UnixHTTPConnection(path, timeout=timeout, address=address)
+    try:
+        connection.request('GET', '/' + extra)
+        response = connection.getresponse()
+        body = response.read()
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise OSError('{} {}'.format(response.status, response.reason))
+    return body
 
 def format_ws_connection_id(role_name, session_id):
     """
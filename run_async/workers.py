@@ -0,0 +1,571 @@
+"""Pool of long-lived worker processes executing the async cells
+"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import os
+import signal
+import traceback
+from collections import deque
+from queue import SimpleQueue
+from time import monotonic, time
+from concurrent.futures import Future, CancelledError
+from multiprocessing import get_context, get_all_start_methods
+from multiprocessing.connection import wait as mp_wait
+from threading import Thread, Lock
+
+# Seconds between checks (of idle workers) that the pool process is still alive
+PARENT_CHECK_INTERVAL = 1.0
+
+# Connection to the pool (in worker processes only), see `send_progress`
+_pool_conn = None
+_pool_conn_lock = Lock()
+
+
+class WorkerError(RuntimeError):
+    """Raised (on the future) whenever a worker process dies
+    while executing a job, or the job result could not be
+    sent back to the pool."""
+
+
+class JobCancelled(WorkerError):
+    """Raised (on the future) whenever the job is cancelled
+    (see `WorkerPool.cancel`)."""
+
+
+class JobFuture(Future):
+    """Future of a job submitted to the `WorkerPool`, which
+    also delivers the progress of the job (see `send_progress`)."""
+
+    def __init__(self):
+        super(JobFuture, self).__init__()
+        # PID of the worker executing the job, and (wall-clock)
+        # time the job was handed over to the worker
+        self.pid = None
+        self.started_at = None
+        # ID of the worker agent executing the job (None: local worker)
+        self.agent_id = None
+        self._progress_lock = Lock()
+        self._progress = list()  # received before any callback is added
+        self._progress_callbacks = list()
+
+    def add_progress_callback(self, fn):
+        """Attach a callable to be called with the payload of each progress
+        message of the job. Progress messages received so far are
+        delivered immediately.
+
+        Note: callbacks are called by the dispatcher thread of the pool.
+        """
+        with self._progress_lock:
+            self._progress_callbacks.append(fn)
+            pending, self._progress = self._progress, list()
+        for payload in pending:
+            fn(payload)
+
+    def set_progress(self, payload):
+        with self._progress_lock:
+            callbacks = list(self._progress_callbacks)
+            if not callbacks:
+                self._progress.append(payload)
+        for fn in callbacks:
+            try:
+                fn(payload)
+            except Exception:
+                traceback.print_exc()
+
+
+def send_progress(payload):
+    """Send the (picklable) `payload` to the pool, as progress of the
+    job being executed (see `JobFuture.add_progress_callback`).
+    To be called by jobs: no-op outside worker processes."""
+    if _pool_conn is None:
+        return
+    with _pool_conn_lock:
+        _pool_conn.send((None, payload))
+
+
+def _worker_main(conn, initializer=None, initargs=()):
+    """Main loop of each worker process.
+
+    Jobs are received as ``(fn, args, kwargs)`` tuples from the pool
+    connection, and results are sent back as ``(success, value)``
+    tuples (progress messages as ``(None, payload)`` tuples).
+    A ``None`` job stops the worker.
+    The `initializer` (if any) is called as soon as the worker starts,
+    i.e. before any job is received.
+    The worker stops as soon as its parent process (i.e. the pool process,
+    or the forkserver process, which exits along with the pool process)
+    has gone away.
+    """
+    global _pool_conn
+    parent_pid = os.getppid()
+    # Workers are (possibly) forked by a process handling SIGTERM
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _pool_conn = conn
+    if initializer is not None:
+        try:
+            initializer(*initargs)
+        except Exception:
+            traceback.print_exc()
+    while True:
+        try:
+            # Forked workers share (copies of) the pool end of the pipes,
+            # so EOF is not reliable to detect that the server has gone away
+            while not conn.poll(PARENT_CHECK_INTERVAL):
+                if os.getppid() != parent_pid:
+                    return
+            job = conn.recv()
+        except (EOFError, OSError):  # Pool has gone away
+            break
+        if job is None:
+            break
+        fn, args, kwargs = job
+        try:
+            result = (True, fn(*args, **kwargs))
+        except BaseException as e:
+            result = (False, e)
+        with _pool_conn_lock:
+            try:
+                conn.send(result)
+            except Exception as e:  # e.g. unpicklable result or exception
+                conn.send((False, WorkerError(repr(e))))
+
+
+def preloading_context(modules):
+    """
+    Return the multiprocessing context whose processes are forked from a
+    forkserver (i.e. template) process, which imports `modules` once (see
+    `multiprocessing.set_forkserver_preload`): worker processes (replaced
+    ones included) start with those modules already imported.
+
+    Only `modules` are preloaded: the main module of the parent (e.g.
+    `ipykernel_launcher` in notebooks, or any script) is never run in the
+    forkserver process.
+
+    Parameters
+    ----------
+    modules : list
+        Names of the modules to import. Modules that cannot be imported
+        are ignored.
+
+    Returns
+    -------
+    multiprocessing context, or None if forkserver is not available
+    (e.g. on Windows).
+    """
+    if 'forkserver' not in get_all_start_methods():
+        return None
+    context = get_context('forkserver')
+    context.set_forkserver_preload(list(modules))
+    return context
+
+
+class _Worker:
+    """Parent-side handle of a single worker process.
+
+    Jobs are pickled and written on the pipe by the sender thread of the
+    worker (see `send`), so that large jobs (e.g. whole namespaces) never
+    hold up the dispatch of other jobs to other workers. `on_send_error`
+    is called (by the sender thread) with the worker, the future and the
+    exception of any job that could not be pickled.
+    """
+
+    def __init__(self, context, initializer=None, initargs=(), on_send_error=None):
+        self.conn, child_conn = context.Pipe(duplex=True)
+        self.process = context.Process(target=_worker_main,
+                                       args=(child_conn, initializer, initargs))
+        self.process.start()
+        child_conn.close()
+        self.job = None
+        # Reason of the cancellation of the job (if cancelled)
+        self.cancelled = None
+        # Key of the sticky session the worker is bound to (if any)
+        self.affinity = None
+        self._on_send_error = on_send_error
+        self._outbox = SimpleQueue()  # (future, job) to send, None to stop
+        self._sender = Thread(target=self._send_loop, daemon=True,
+                              name='WorkerSender-{}'.format(self.pid))
+        self._sender.start()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def send(self, future, job):
+        """Send the job (of the future) to the worker process"""
+        self._outbox.put((future, job))
+
+    def _send_loop(self):
+        while True:
+            entry = self._outbox.get()
+            if entry is None:
+                return
+            future, job = entry
+            try:
+                self.conn.send(job)
+            except OSError:  # the worker died (see `WorkerPool._collect`)
+                pass
+            except Exception as e:  # e.g. job arguments are not picklable
+                if self._on_send_error is not None:
+                    self._on_send_error(self, future, e)
+
+    def close(self, timeout=None):
+        """Stop the sender thread, and close the pipe"""
+        self._outbox.put(None)
+        self._sender.join(timeout)
+        self.conn.close()
+
+    def stop(self, timeout=None):
+        self._outbox.put(None)
+        self._sender.join(timeout)
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """Fixed-size pool of worker processes, created once and shared
+    among all the sessions handled by the `AsyncRunServer`.
+
+    Differently from `concurrent.futures.ProcessPoolExecutor`, submitting
+    a job never blocks the caller: jobs are queued and dispatched to
+    idle workers by a background thread, which is also in charge of
+    collecting results and resolving the returned futures.
+    Therefore, futures can be safely handed over to the Tornado IOLoop
+    (i.e. `IOLoop.add_future`).
+
+    Jobs submitted with `submit_sticky` are always executed by the same
+    worker, which stays bound to the corresponding session key (and is
+    therefore excluded from the shared rotation) until the session
+    is released. At least one worker is always kept shared, i.e. a pool
+    of a single worker runs no sticky session.
+
+    Parameters
+    ----------
+    max_workers : int (default: None)
+        The number of worker processes. If None, the number
+        of CPUs in the machine is used.
+    mp_context : multiprocessing context (default: None)
+        The context used to start worker processes. If None,
+        the default multiprocessing context is used.
+    initializer : callable (default: None)
+        Function called in each worker process as soon as it starts
+        (replaced workers included), so to warm it up before
+        any job is received.
+    initargs : tuple (default: ())
+        Arguments passed to the `initializer`.
+    """
+
+    def __init__(self, max_workers=None, mp_context=None,
+                 initializer=None, initargs=()):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        if max_workers <= 0:
+            raise ValueError("max_workers must be greater than 0")
+        if mp_context is None:
+            mp_context = get_context()
+        self._max_workers = max_workers
+        self._context = mp_context
+        self._initializer = initializer
+        self._initargs = initargs
+        self._workers = list()
+        self._pending = deque()
+        self._sticky_pending = dict()  # session key --> deque of jobs
+        self._bound = dict()  # session key --> _Worker
+        self._last_used = dict()  # session key --> time of last submission
+        self._releasing = set()
+        self._lock = Lock()
+        self._wakeup_reader, self._wakeup_writer = mp_context.Pipe(duplex=False)
+        self._collector = None
+        self._shutdown = False
+
+    @property
+    def max_workers(self):
+        return self._max_workers
+
+    @property
+    def pids(self):
+        return [w.pid for w in self._workers]
+
+    @property
+    def workers(self):
+        """List of (PID, future of the running job, key of the bound sticky
+        session) tuples of the workers (None if idle, or not bound)"""
+        with self._lock:
+            return [(w.pid, w.job, w.affinity) for w in self._workers]
+
+    @property
+    def max_sticky_sessions(self):
+        return self._max_workers - 1
+
+    @property
+    def sticky_sessions(self):
+        """Dictionary of the active sticky sessions, mapping each
+        session key to the time (`time.monotonic`) of its last job"""
+        with self._lock:
+            return dict(self._last_used)
+
+    def start(self):
+        """Spawn all the worker processes and the dispatcher thread"""
+        if self._collector is not None:
+            return
+        self._workers = [self._new_worker() for _ in range(self._max_workers)]
+        self._collector = Thread(target=self._collect_loop, daemon=True,
+                                 name='WorkerPoolCollector')
+        self._collector.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue a job for execution, and return the corresponding
+        `JobFuture` (i.e. `concurrent.futures.Future`)"""
+        if self._shutdown:
+            raise RuntimeError('Cannot submit jobs after shutdown')
+        future = JobFuture()
+        with self._lock:
+            self._pending.append((future, (fn, args, kwargs)))
+        self._wakeup()
+        return future
+
+    def submit_sticky(self, session_key, fn, *args, **kwargs):
+        """Queue a job to be executed by the worker bound to the
+        `session_key` sticky session (the session is bound to a
+        worker at its first job).
+
+        Jobs of the same session are executed in submission order.
+        """
+        if self._shutdown:
+            raise RuntimeError('Cannot submit jobs after shutdown')
+        future = JobFuture()
+        with self._lock:
+            jobs = self._sticky_pending.setdefault(session_key, deque())
+            jobs.append((future, (fn, args, kwargs)))
+            self._last_used[session_key] = monotonic()
+            self._releasing.discard(session_key)
+        self._wakeup()
+        return future
+
+    def cancel(self, future, reason='Job cancelled'):
+        """Cancel the job of the `future`, which fails with `JobCancelled`.
+        Pending jobs are simply dropped, while running jobs are stopped by
+        killing their worker, which is replaced by a brand new one (sticky
+        sessions are still bound to the new worker, although their state
+        is lost).
+
+        Returns
+        -------
+        bool : False if the job is already completed.
+        """
+        with self._lock:
+            queues = [self._pending] + list(self._sticky_pending.values())
+            for jobs in queues:
+                for entry in jobs:
+                    if entry[0] is future:
+                        jobs.remove(entry)
+                        if future.set_running_or_notify_cancel():
+                            future.set_exception(JobCancelled(reason))
+                        return True
+            for worker in self._workers:
+                if worker.job is future:
+                    break
+            else:
+                return False
+            worker.cancelled = reason
+            worker.process.kill()
+        return True
+
+    def release(self, session_key):
+        """Release the sticky session: its worker gets back to the
+        shared rotation as soon as all the session jobs are completed."""
+        with self._lock:
+            if session_key in self._last_used:
+                self._releasing.add(session_key)
+        self._wakeup()
+
+    def shutdown(self, wait=True):
+        """Stop all the workers. Pending (not yet started) jobs are cancelled."""
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            pending = list(self._pending)
+            for jobs in self._sticky_pending.values():
+                pending.extend(jobs)
+            self._pending.clear()
+            self._sticky_pending.clear()
+            for future, _ in pending:
+                future.cancel()
+        self._wakeup()
+        if self._collector is not None and wait:
+            self._collector.join()
+
+    # -----------------
+    # Dispatcher Thread
+    # -----------------
+
+    def _wakeup(self):
+        try:
+            self._wakeup_writer.send_bytes(b'')
+        except (OSError, ValueError):
+            pass
+
+    def _next_job(self, jobs):
+        """Pop the first job (not cancelled) from the `jobs` queue"""
+        while jobs:
+            future, job = jobs.popleft()
+            if future.set_running_or_notify_cancel():
+                return future, job
+        return None
+
+    def _dispatch_sticky(self, assignments):
+        """Hand pending jobs of sticky sessions over to their workers,
+        binding new sessions to idle shared workers.
+        (To be called holding the lock)"""
+        for key in list(self._sticky_pending.keys()):
+            jobs = self._sticky_pending[key]
+            worker = self._bound.get(key)
+            if worker is None:
+                if len(self._bound) >= self.max_sticky_sessions:
+                    del self._sticky_pending[key]
+                    del self._last_used[key]
+                    if self.max_sticky_sessions < 1:
+                        reason = ('Sticky sessions require a pool of at least 2 '
+                                  'workers (one is always kept shared)')
+                    else:
+                        reason = ('No worker available for a new sticky session: '
+                                  'all the {} workers available to sticky sessions are '
+                                  'bound'.format(self.max_sticky_sessions))
+                    for future, _ in jobs:
+                        if future.set_running_or_notify_cancel():
+                            future.set_exception(WorkerError(reason))
+                    continue
+                idle = [w for w in self._workers
+                        if w.job is None and w.affinity is None]
+                if not idle:
+                    continue
+                worker = idle[0]
+                worker.affinity = key
+                self._bound[key] = worker
+            if worker.job is None:
+                next_job = self._next_job(jobs)
+                if next_job is not None:
+                    self._assign(worker, *next_job)
+                    assignments.append((worker,) + next_job)
+            if not jobs:
+                del self._sticky_pending[key]
+
+        for key in list(self._releasing):
+            worker = self._bound.get(key)
+            if key in self._sticky_pending or (worker is not None and
+                                               worker.job is not None):
+                continue
+            self._releasing.discard(key)
+            self._last_used.pop(key, None)
+            if worker is not None:
+                worker.affinity = None
+                del self._bound[key]
+
+    def _assign(self, worker, future, job):
+        worker.job = future
+        future.pid = worker.pid
+        future.started_at = time()
+
+    def _dispatch(self):
+        """Hand pending jobs over to idle workers"""
+        assignments = list()
+        with self._lock:
+            self._dispatch_sticky(assignments)
+            for worker in self._workers:
+                if not self._pending:
+                    break
+                if worker.job is not None or worker.affinity is not None:
+                    continue
+                next_job = self._next_job(self._pending)
+                if next_job is not None:
+                    self._assign(worker, *next_job)
+                    assignments.append((worker,) + next_job)
+        # Jobs are pickled and written by the sender thread of each
+        # worker, so that neither `submit`, nor the dispatch to other
+        # workers, is held up by (possibly large) jobs.
+        for worker, future, job in assignments:
+            worker.send(future, job)
+
+    def _send_failed(self, worker, future, error):
+        """The job could not be sent to the worker (which is still idle)"""
+        with self._lock:
+            if worker.job is not future:  # e.g. already cancelled
+                return
+            worker.job = None
+        future.set_exception(error)
+        self._wakeup()
+
+    def _new_worker(self):
+        return _Worker(self._context, self._initializer, self._initargs,
+                       on_send_error=self._send_failed)
+
+    def _respawn(self, worker):
+        """Replace a dead worker with a brand new one"""
+        worker.process.join()
+        worker.close()
+        with self._lock:
+            index = self._workers.index(worker)
+            new_worker = self._new_worker()
+            # The new worker is still bound to the session (if any), although
+            # the state of the session is lost with the old worker.
+            new_worker.affinity = worker.affinity
+            if worker.affinity is not None:
+                self._bound[worker.affinity] = new_worker
+            self._workers[index] = new_worker
+
+    def _collect_loop(self):
+        while not self._shutdown:
+            self._dispatch()
+            busy = {w.conn: w for w in self._workers if w.job is not None}
+            idle = {w.process.sentinel: w for w in self._workers if w.job is None}
+            ready = mp_wait(list(busy.keys()) + list(idle.keys()) +
+                            [self._wakeup_reader])
+            for handle in ready:
+                if handle is self._wakeup_reader:
+                    while self._wakeup_reader.poll():
+                        self._wakeup_reader.recv_bytes()
+                elif handle in idle:  # an idle worker has died
+                    self._respawn(idle[handle])
+                else:
+                    self._collect(busy[handle])
+        self._stop_workers()
+
+    def _collect(self, worker):
+        """Resolve the future of the job completed by the worker
+        (or deliver the progress of the job)"""
+        try:
+            success, value = worker.conn.recv()
+        except (EOFError, OSError):
+            future, worker.job = worker.job, None
+            if worker.cancelled is not None:
+                future.set_exception(JobCancelled(worker.cancelled))
+            else:
+                future.set_exception(WorkerError(
+                    'Worker process (PID {}) died unexpectedly'.format(worker.pid)))
+            self._respawn(worker)
+            return
+        if success is None:
+            worker.job.set_progress(value)
+            return
+        future, worker.job = worker.job, None
+        if success:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def _stop_workers(self):
+        for worker in self._workers:
+            if worker.job is not None:
+                worker.job.set_exception(CancelledError())
+            worker.stop(timeout=1)
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
@@ -0,0 +1,102 @@
+"""Tests of the placement of jobs on worker agents, and of their state on
+the server (see `run_async.handlers.WorkerAgents`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import json
+
+import pytest
+
+from run_async.handlers import AgentState, WorkerAgents
+from run_async.namespace import PackedNamespace
+from run_async.settings import REQUEST_ID
+from run_async.workers import JobCancelled, WorkerError
+
+
+class Loop:
+    """Loop running the callbacks it is given at once"""
+
+    @staticmethod
+    def spawn_callback(callback, *args):
+        callback(*args)
+
+
+class Connection:
+    """Connection of an agent, recording the jobs and messages written"""
+
+    def __init__(self):
+        self.jobs = list()
+        self.messages = list()
+
+    def write_job(self, parts):
+        self.jobs.append(parts)
+
+    def write_message(self, message):
+        self.messages.append(json.loads(message))
+
+
+def _agents(*workers):
+    agents = WorkerAgents(Loop())
+    for index, count in enumerate(workers):
+        agents.add('agent-{}'.format(index), AgentState(Connection(), {'workers': count}))
+    return agents
+
+
+def _submit(agents, agent_id, request_id):
+    packed_ns = PackedNamespace().to_bytes()
+    return agents.submit(agent_id, request_id, packed_ns, {'code': 'a = 1'})
+
+
+def test_jobs_are_placed_on_the_least_loaded_node():
+    agents = _agents(2, 4)
+    assert agents.capacity == 6
+    # Idle local workers come first
+    assert agents.place(local_load=0.) is None
+    assert agents.place(local_load=1.) == 'agent-0'
+    _ = _submit(agents, 'agent-0', 'a')  # agent-0 is half busy
+    assert agents.place(local_load=1.) == 'agent-1'
+    assert agents.place(local_load=.6) == 'agent-1'
+    # On even load, jobs stay on the server
+    assert agents.place(local_load=0.) is None
+
+
+def test_jobs_sent_and_completed():
+    agents = _agents(1)
+    future = _submit(agents, 'agent-0', 'a')
+    connection = agents.get('agent-0').connection
+    parts, = connection.jobs
+    meta = PackedNamespace.from_buffer(b''.join(bytes(part) for part in parts)).meta
+    assert (meta[REQUEST_ID], meta['code']) == ('a', 'a = 1')
+    assert future.running() and future.agent_id == 'agent-0'
+    assert agents.status()[0]['running'] == ['a']
+    assert agents.completed('agent-0', 'a', result=b'result')
+    assert future.result() == b'result'
+    # Unknown (e.g. already completed) jobs are ignored
+    assert not agents.completed('agent-0', 'a', result=b'result')
+    assert not agents.completed('unknown', 'a')
+
+
+def test_jobs_failed_or_cancelled():
+    agents = _agents(2)
+    failed, cancelled = _submit(agents, 'agent-0', 'a'), _submit(agents, 'agent-0', 'b')
+    assert agents.cancel(cancelled, 'Timed out')
+    assert agents.get('agent-0').connection.messages == [{'cancel': 'b',
+                                                          'reason': 'Timed out'}]
+    _ = agents.completed('agent-0', 'a', error='Worker died')
+    _ = agents.completed('agent-0', 'b', error='Timed out', cancelled=True)
+    with pytest.raises(WorkerError, match='Worker died'):
+        failed.result()
+    with pytest.raises(JobCancelled, match='Timed out'):
+        cancelled.result()
+    assert not agents.cancel(cancelled)
+
+
+def test_jobs_of_disconnected_agents_fail():
+    agents = _agents(1)
+    future = _submit(agents, 'agent-0', 'a')
+    agents.remove('agent-0')
+    with pytest.raises(WorkerError, match='disconnected'):
+        future.result()
+    assert agents.capacity == 0
+    assert agents.place(local_load=1.) is None
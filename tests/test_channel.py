@@ -0,0 +1,113 @@
+"""Tests of the handling of the messages of the server by the kernel channel
+(see `run_async.channel.KernelChannel`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import json
+import socket
+
+import pytest
+
+from tornado.ioloop import IOLoop
+from tornado.gen import sleep
+
+from run_async.channel import KernelChannel
+from run_async.namespace import PackedNamespace
+from run_async.settings import REQUEST_ID
+from run_async.transport import iter_frames
+from run_async.utils import ServerAddress
+
+
+class Channel(KernelChannel):
+    """Channel never connecting to the server"""
+
+    def connect(self):
+        pass
+
+
+class Request:
+    """Records the acknowledgement, result, or error of the request"""
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.acked = False
+        self.result = None
+        self.error = None
+
+    def on_ack(self):
+        self.acked = True
+
+    def on_result(self, packed_ns):
+        self.result = packed_ns
+        return True
+
+    def on_error(self, message):
+        self.error = message
+
+
+def _result(request_id):
+    return list(iter_frames(PackedNamespace(meta={REQUEST_ID: request_id}).to_parts()))
+
+
+def test_acknowledged_request_and_result():
+    channel = Channel()
+    request = Request('a')
+    channel.submit(request)
+    channel.on_message(json.dumps({REQUEST_ID: 'a', 'ack': True}))
+    assert request.acked
+    channel.on_message(json.dumps({REQUEST_ID: 'a', 'result': True}))
+    for frame in _result('a'):
+        channel.on_message(frame)
+    assert request.result.meta[REQUEST_ID] == 'a'
+    assert request.error is None
+    assert channel.pending == 0
+
+
+def test_request_failed_on_the_server():
+    channel = Channel()
+    request, other = Request('a'), Request('b')
+    channel.submit(request)
+    channel.submit(other)
+    channel.on_message(json.dumps({REQUEST_ID: 'a', 'error': 'Namespace not received'}))
+    assert request.error == 'Namespace not received'
+    assert channel.requests == ['b']
+    assert other.error is None
+
+
+def test_result_not_received():
+    channel = Channel()
+    request, other = Request('a'), Request('b')
+    channel.submit(request)
+    channel.submit(other)
+    channel.on_message(json.dumps({REQUEST_ID: 'a', 'result': True}))
+    frame = _result('a')[0]
+    channel.on_message(frame[:-1] + bytes([frame[-1] ^ 1]))
+    assert request.error.startswith('Result not received')
+    assert channel.requests == ['b']
+    # Further results are received as usual
+    channel.on_message(json.dumps({REQUEST_ID: 'b', 'result': True}))
+    for frame in _result('b'):
+        channel.on_message(frame)
+    assert other.result is not None and channel.pending == 0
+
+
+def test_server_not_running():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    channel = KernelChannel(address=ServerAddress('127.0.0.1', port, socket_path=''))
+    request = Request('a')
+
+    async def submit():
+        channel.submit(request)
+        while request.error is None:
+            await sleep(.01)
+
+    IOLoop.current().run_sync(submit, timeout=5)
+    assert 'Use %async_run_server first' in request.error
+    assert channel.pending == 0 and not channel.connected
+    # Waiting for the handshake (e.g. maps) fails as well
+    with pytest.raises(ConnectionRefusedError):
+        IOLoop.current().run_sync(channel.handshake, timeout=5)
+    assert channel.workers is None
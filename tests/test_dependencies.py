@@ -0,0 +1,106 @@
+"""Tests of the dependency graph of pending async cells
+(see `run_async.handlers.DependencyGraph`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+from run_async.handlers import DependencyGraph
+
+
+class Job:
+    """Records whether the (held) job is released, or cancelled"""
+
+    def __init__(self):
+        self.released = False
+        self.cancelled = None
+
+    def release(self):
+        self.released = True
+
+    def cancel(self, reason):
+        self.cancelled = reason
+
+
+def _add(graph, request_id, reads, writes, key='notebook'):
+    job = Job()
+    depends_on = graph.add_job(key, request_id, reads, writes, job.release, job.cancel)
+    return job, depends_on
+
+
+def test_independent_jobs_are_not_held():
+    graph = DependencyGraph()
+    _, depends_on = _add(graph, 'a', {'x'}, {'y'})
+    assert depends_on == []
+    _, depends_on = _add(graph, 'b', {'x'}, {'z'})  # reading the same names
+    assert depends_on == []
+    assert set(graph.entries) == {'a', 'b'}
+
+
+def test_read_after_write_write_after_read_and_write_after_write():
+    graph = DependencyGraph()
+    _add(graph, 'writer', {'x'}, {'y'})
+    assert _add(graph, 'reader', {'y'}, {'r'})[1] == ['writer']
+    # Waiting for the reader of the former value too
+    assert _add(graph, 'overwriter', set(), {'y'})[1] == ['writer', 'reader']
+    assert _add(graph, 'rebinder', set(), {'x'})[1] == ['writer']
+
+
+def test_unknown_names_depend_on_everything():
+    graph = DependencyGraph()
+    _add(graph, 'a', {'x'}, {'y'})
+    assert _add(graph, 'b', None, None)[1] == ['a']
+    assert _add(graph, 'c', {'q'}, {'w'})[1] == ['b']
+
+
+def test_notebooks_are_independent():
+    graph = DependencyGraph()
+    _add(graph, 'a', {'x'}, {'y'}, key='one')
+    assert _add(graph, 'b', {'y'}, {'x'}, key='two')[1] == []
+
+
+def test_held_jobs_are_released_once_their_dependencies_are_done():
+    graph = DependencyGraph()
+    first, _ = _add(graph, 'a', set(), {'x'})
+    second, _ = _add(graph, 'b', set(), {'y'})
+    both, depends_on = _add(graph, 'c', {'x', 'y'}, {'z'})
+    assert sorted(depends_on) == ['a', 'b']
+    graph.done('a')
+    assert not both.released
+    graph.done('b')
+    assert both.released
+    assert not first.released  # never held
+    graph.done('c')
+    assert graph.entries == []
+
+
+def test_chain_of_dependent_jobs_run_in_order():
+    graph = DependencyGraph()
+    _add(graph, 'a', set(), {'x'})
+    second, _ = _add(graph, 'b', {'x'}, {'x'})
+    third, depends_on = _add(graph, 'c', {'x'}, {'x'})
+    assert sorted(depends_on) == ['a', 'b']
+    graph.done('a')
+    assert second.released and not third.released
+    graph.done('b')
+    assert third.released
+
+
+def test_cancel_held_job():
+    graph = DependencyGraph()
+    _add(graph, 'a', set(), {'x'})
+    held, _ = _add(graph, 'b', {'x'}, {'y'})
+    dependent, _ = _add(graph, 'c', {'x', 'y'}, {'z'})
+    assert graph.cancel('b', 'Cancelled')
+    assert held.cancelled == 'Cancelled' and not held.released
+    # Still waiting for 'a'
+    assert not dependent.released
+    graph.done('a')
+    assert dependent.released
+
+
+def test_cancel_released_job():
+    graph = DependencyGraph()
+    job, _ = _add(graph, 'a', set(), {'x'})
+    assert not graph.cancel('a')
+    assert job.cancelled is None
+    assert not graph.cancel('unknown')
@@ -0,0 +1,65 @@
+"""Tests of the chunks and of the reductions of mapped cells
+(see `run_async.mapping`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import pytest
+
+from run_async.mapping import chunk_bounds, concat, reduce_results, take_chunk
+
+
+def test_chunk_bounds():
+    assert chunk_bounds(10, 4) == [(0, 4), (4, 8), (8, 10)]
+    assert chunk_bounds(4, 4) == [(0, 4)]
+    assert chunk_bounds(3, 5) == [(0, 3)]
+    assert chunk_bounds(0, 5) == []
+
+
+def test_chunks_of_sequences_keep_their_type():
+    assert take_chunk([1, 2, 3, 4], 1, 3) == [2, 3]
+    assert take_chunk((1, 2, 3), 2, 5) == (3,)
+    assert take_chunk('abcd', 0, 2) == 'ab'
+    assert take_chunk(range(10), 4, 8) == range(4, 8)
+
+
+def test_chunks_of_other_iterables_are_lists():
+    assert take_chunk({'a': 1, 'b': 2, 'c': 3}, 1, 3) == ['b', 'c']
+    assert sorted(take_chunk({1, 2, 3}, 0, 3)) == [1, 2, 3]
+
+
+def test_chunks_of_arrays():
+    numpy = pytest.importorskip('numpy')
+    chunk = take_chunk(numpy.arange(10), 3, 6)
+    assert isinstance(chunk, numpy.ndarray)
+    assert chunk.tolist() == [3, 4, 5]
+
+
+def test_concat():
+    assert concat([[1], [2, 3]]) == [1, 2, 3]
+    assert concat([(1,), (2, 3)]) == (1, 2, 3)
+    assert concat(['ab', 'c']) == 'abc'
+    assert concat([b'a', b'b']) == b'ab'
+    assert concat([{'a': 1}, {'b': 2}]) == {'a': 1, 'b': 2}
+    assert concat([range(2), range(2, 4)]) == [0, 1, 2, 3]
+    with pytest.raises(TypeError):
+        concat([1, 2])
+
+
+def test_concat_arrays_and_frames():
+    numpy = pytest.importorskip('numpy')
+    assert concat([numpy.arange(2), numpy.arange(2, 4)]).tolist() == [0, 1, 2, 3]
+    pandas = pytest.importorskip('pandas')
+    frame = concat([pandas.DataFrame({'a': [1]}), pandas.DataFrame({'a': [2]}, index=[1])])
+    assert frame['a'].tolist() == [1, 2]
+
+
+def test_reducers():
+    assert reduce_results([[1], [2]], 'concat') == [1, 2]
+    assert reduce_results([1, 2, 3], 'sum') == 6
+    assert reduce_results([[1], [2]], 'list') == [[1], [2]]
+    assert reduce_results([1, 5, 3], 'largest', {'largest': max}) == 5
+    with pytest.raises(ValueError, match='Unknown reducer'):
+        reduce_results([1], 'largest')
+    with pytest.raises(ValueError, match='Unknown reducer'):
+        reduce_results([1], 'value', {'value': 1})
@@ -0,0 +1,50 @@
+"""Tests of the latency and throughput metrics (see `run_async.metrics`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+from run_async import metrics
+from run_async.metrics import Histogram, Metrics
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(.1, 1))
+    for value in (.05, .1, .5, 5):
+        histogram.observe(value)
+    assert list(histogram.cumulative_counts()) == [2, 3, 4]
+    assert (histogram.count, histogram.sum) == (4, 5.65)
+
+
+def test_observations_are_drained():
+    _ = metrics.drain()
+    metrics.record('pack', .5, 10)
+    with metrics.timed('unpack', 20):
+        pass
+    observations = metrics.drain()
+    assert [phase for phase, _, _ in observations] == ['pack', 'unpack']
+    assert observations[0] == ['pack', .5, 10]
+    assert metrics.drain() == []
+
+
+def test_merge_and_render():
+    registry = Metrics(buckets=(1,))
+    registry.merge([['run_cell', .5, None], ['pack', 2, 100], ['pack', .5, 50],
+                    ['unknown', 1, 1], 'malformed', None])
+    registry.job_finished('done')
+    registry.job_finished('done')
+    registry.job_finished('cancelled')
+    assert set(registry.latency) == {'run_cell', 'pack'}
+    lines = registry.render().splitlines()
+    for line in ['run_async_phase_seconds_bucket{phase="pack",le="1.0"} 1',
+                 'run_async_phase_seconds_bucket{phase="pack",le="+Inf"} 2',
+                 'run_async_phase_seconds_sum{phase="pack"} 2.5',
+                 'run_async_phase_seconds_count{phase="run_cell"} 1',
+                 'run_async_phase_bytes_total{phase="pack"} 150',
+                 'run_async_jobs_total{state="cancelled"} 1',
+                 'run_async_jobs_total{state="done"} 2']:
+        assert line in lines
+    # Phases are rendered in the order of the round trip
+    assert lines.index('run_async_phase_seconds_count{phase="pack"} 2') < \
+        lines.index('run_async_phase_seconds_count{phase="run_cell"} 1')
+    assert not any('phase="run_cell"' in line for line in lines
+                   if line.startswith('run_async_phase_bytes_total'))
@@ -0,0 +1,243 @@
+"""Tests of the names read and written by cells, of the changes of
+namespaces, and of the keys of memoized cells (see `run_async.namespace`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import os
+import threading
+
+from IPython.core.inputtransformer2 import TransformerManager
+
+from run_async.namespace import (PackedNamespace, cell_names, imported_names, memo_key,
+                                 namespace_delta, pack_namespace, referenced_names,
+                                 snapshot)
+
+
+class Shell:
+    """Shell transforming the IPython syntax of cells, as the kernel does"""
+    input_transformer_manager = TransformerManager()
+
+
+class Counted:
+    """Value counting the times it is pickled"""
+
+    pickled = 0
+
+    def __init__(self, value):
+        self.value = value
+
+    def __reduce__(self):
+        Counted.pickled += 1
+        return Counted, (self.value,)
+
+
+def test_pack_and_unpack_round_trip():
+    shared = [1, 2]
+    namespace = {'a': 1, 'shared': shared, 'same': shared, 'os': os, 'text': 'x',
+                 'lock': threading.Lock(), 'secret': 0}
+    packed = pack_namespace(namespace, blacklist=['secret'], meta={'id': 'cell'})
+    assert packed.aliases == {'same': 'shared'}
+    assert packed.modules == [('os', 'os')]
+    assert set(packed.skipped) == {'lock'} and 'TypeError' in packed.skipped['lock']
+    assert sorted(packed.names) == ['a', 'os', 'same', 'shared', 'text']
+    loaded = PackedNamespace.from_buffer(packed.to_bytes())
+    assert loaded.meta == {'id': 'cell'} and loaded.skipped == packed.skipped
+    assert loaded.nbytes == packed.nbytes
+    unpacked = loaded.unpack()
+    assert unpacked['import_modules'] == [('os', 'os')]
+    # Names of the same object are still bound to the same object
+    assert unpacked['same'] is unpacked['shared'] == [1, 2]
+    assert (unpacked['a'], unpacked['text']) == (1, 'x')
+    assert 'lock' not in unpacked and 'secret' not in unpacked
+
+
+def test_values_are_encoded_once():
+    Counted.pickled = 0
+    packed = pack_namespace({'value': Counted(1)})
+    loaded = PackedNamespace.from_buffer(packed.to_bytes())
+    _ = PackedNamespace.from_buffer(loaded.to_bytes()).subset(['value']).to_bytes()
+    # Messages are forwarded (and restricted) without encoding values again
+    assert Counted.pickled == 1
+    assert loaded.unpack()['value'].value == 1
+
+
+def test_pack_only_some_names():
+    packed = pack_namespace({'a': 1, 'b': 2, 'os': os}, names={'a', 'os'})
+    assert sorted(packed.names) == ['a', 'os']
+
+
+def test_subset():
+    shared = [1]
+    packed = pack_namespace({'a': 1, 'shared': shared, 'same': shared, 'os': os})
+    subset = packed.subset(['same', 'os', 'missing'])
+    assert sorted(subset.values) == ['shared'] and subset.aliases == {'same': 'shared'}
+    assert subset.modules == [('os', 'os')]
+    unpacked = subset.unpack()
+    assert unpacked['same'] == [1] and 'a' not in unpacked
+
+
+def test_update_merges_deltas():
+    shared = [1]
+    mirror = pack_namespace({'a': 1, 'b': 2, 'shared': shared, 'same': shared, 'os': os})
+    mirror = PackedNamespace.from_buffer(mirror.to_bytes())
+    delta = PackedNamespace.from_buffer(pack_namespace({'a': 10, 'c': 3}).to_bytes())
+    # The target of an alias is rebound, and a name is deleted
+    rebound = pack_namespace({'shared': [2]})
+    assert mirror.update(delta, deleted=['b']) == []
+    assert mirror.update(rebound) == []
+    unpacked = mirror.unpack()
+    assert (unpacked['a'], unpacked['c'], unpacked['shared']) == (10, 3, [2])
+    assert 'b' not in unpacked
+    # The alias keeps its own copy of the former value
+    assert unpacked['same'] == [1] and mirror.aliases == {}
+    assert mirror.modules == [('os', 'os')]
+    # Merged values do not keep the delta message alive
+    assert all(type(value) is bytes for name, value in mirror.values.items()
+               if name in ('a', 'c'))
+
+
+def test_names_read_and_written():
+    reads, writes, dynamic = cell_names(Shell(), 'import os\n'
+                                                 'c = a + len(b)\n'
+                                                 'd += 1\n'
+                                                 'def f(x):\n'
+                                                 '    global g\n'
+                                                 '    g = x + h\n'
+                                                 'for i in range(3):\n'
+                                                 '    pass\n')
+    assert reads == {'a', 'b', 'len', 'd', 'h', 'range'}
+    assert writes == {'os', 'c', 'd', 'f', 'g', 'i'}
+    assert not dynamic
+
+
+def test_names_changed_by_assigning_to_attributes_items_or_deleting():
+    reads, writes, dynamic = cell_names(Shell(), 'a.b[0] = 1\nc[1] = 2\ndel d\ne.append(3)')
+    assert {'a', 'c', 'd', 'e'} <= reads
+    # Objects changed by calling their methods are not inferred
+    assert writes == {'a', 'c', 'd'}
+    assert not dynamic
+
+
+def test_names_of_comprehensions_and_lambdas_are_local():
+    reads, writes, _ = cell_names(Shell(), 'squares = [x * x for x in values]\n'
+                                           'f = lambda y: y + offset')
+    assert reads == {'values', 'offset'}
+    assert writes == {'squares', 'f'}
+
+
+def test_names_not_inferred():
+    for source in ('exec("a = 1")', 'globals()["a"] = 1', 'from os.path import *',
+                   '%time a = 1', 'x = get_ipython()'):
+        assert cell_names(Shell(), source)[2], source
+    assert cell_names(Shell(), 'a = (') is None
+    assert referenced_names(Shell(), 'a = (') is None
+    assert imported_names(Shell(), 'a = (') == set()
+
+
+def test_referenced_and_imported_names():
+    source = 'import numpy as np\nfrom os import path\nimport sys\nsys = 1\na.b(c)'
+    assert {'np', 'path', 'sys', 'a', 'b', 'c'} <= referenced_names(Shell(), source)
+    assert imported_names(Shell(), source) == {'np', 'path'}
+
+
+def test_delta_without_touched_names_is_the_whole_namespace():
+    namespace = {'a': 1, 'b': [1]}
+    changed, deleted = namespace_delta(namespace, snapshot(namespace))
+    assert changed == {'a', 'b'}
+    assert deleted == set()
+
+
+def test_delta_of_an_unchanged_namespace():
+    namespace = {'a': 1, 'b': [1], 'c': 'text'}
+    assert namespace_delta(namespace, snapshot(namespace), touched=set()) == (set(), set())
+
+
+def test_delta_new_rebound_and_deleted_names():
+    namespace = {'a': 1, 'b': [1], 'c': 'text'}
+    synced = snapshot(namespace)
+    namespace['a'] = 2 ** 70  # rebound (not a cached small int)
+    namespace['d'] = None
+    del namespace['c']
+    changed, deleted = namespace_delta(namespace, synced, touched=set())
+    assert changed == {'a', 'd'}
+    assert deleted == {'c'}
+
+
+def test_delta_containers_changed_in_place():
+    namespace = {'grown': [1], 'same': {'k': 1}, 'mutated': [1]}
+    synced = snapshot(namespace)
+    namespace['grown'].append(2)  # size changed
+    namespace['mutated'][0] = 2  # same size: only detected if touched
+    changed, _ = namespace_delta(namespace, synced, touched=set())
+    assert changed == {'grown'}
+    changed, _ = namespace_delta(namespace, synced, touched={'mutated'})
+    assert changed == {'grown', 'mutated'}
+
+
+def test_memo_key_is_stable():
+    namespace = {'a': 1, 'b': [1, 2]}
+    key = memo_key('c = a + len(b)', namespace, ['a', 'b'], ['c'])
+    assert key == memo_key('c = a + len(b)', dict(namespace), ['b', 'a'], ['c'])
+    assert len(key) == 40  # hex digest
+
+
+def test_memo_key_depends_on_source_reads_and_writes():
+    namespace = {'a': 1, 'b': [1, 2]}
+    key = memo_key('c = a + len(b)', namespace, ['a', 'b'], ['c'])
+    assert key != memo_key('c = a - len(b)', namespace, ['a', 'b'], ['c'])
+    assert key != memo_key('c = a + len(b)', dict(namespace, a=2), ['a', 'b'], ['c'])
+    assert key != memo_key('c = a + len(b)', dict(namespace, b=[1, 3]), ['a', 'b'], ['c'])
+    assert key != memo_key('c = a + len(b)', namespace, ['a', 'b'], ['c', 'd'])
+    # Names not read do not matter
+    assert key == memo_key('c = a + len(b)', dict(namespace, z=0), ['a', 'b'], ['c'])
+
+
+def test_memo_key_skips_names_defined_by_the_cell():
+    source = 'import os\nx = 1\ny = x + 1'
+    before = memo_key(source, {}, ['os', 'x'], ['os', 'x', 'y'])
+    # Modules imported by the cell do not change its key once it has run
+    assert before == memo_key(source, {'os': os}, ['os', 'x'], ['os', 'x', 'y'])
+    # But values read, and not written, do matter
+    assert memo_key('y = x', {}, ['x'], ['y']) != memo_key('y = x', {'x': 1}, ['x'], ['y'])
+
+
+def test_memo_key_of_unpicklable_values():
+    assert memo_key('b = a', {'a': threading.Lock()}, ['a'], ['b']) is None
+
+
+def _define(source, namespace):
+    """Define the functions of the source in the namespace, as the notebook does"""
+    exec(source, namespace)
+    return namespace
+
+
+def test_memo_key_of_redefined_functions():
+    namespace = _define('def f(x):\n    return x + 1', {'__name__': '__main__'})
+    digests = dict()
+    key = memo_key('y = f(1)', namespace, ['f'], ['y'], digests=digests)
+    assert key is not None
+    _ = _define('def f(x):\n    return x + 2', namespace)
+    assert memo_key('y = f(1)', namespace, ['f'], ['y'], digests=digests) != key
+    # Functions are digested along with the globals they read
+    _ = _define('def h():\n    return 1\ndef g():\n    return h()', namespace)
+    key = memo_key('y = g()', namespace, ['g'], ['y'], digests=digests)
+    _ = _define('def h():\n    return 2', namespace)
+    assert memo_key('y = g()', namespace, ['g'], ['y'], digests=digests) != key
+
+
+def test_memo_key_reuses_digests_of_unchanged_values():
+    namespace = {'a': [1, 2]}
+    digests = dict()
+    key = memo_key('b = sum(a)', namespace, ['a'], ['b'], digests=digests)
+    assert set(digests) == {'a'}
+    assert memo_key('b = sum(a)', namespace, ['a'], ['b'], digests=digests) == key
+    # Values grown in place are digested again
+    namespace['a'].append(3)
+    grown = memo_key('b = sum(a)', namespace, ['a'], ['b'], digests=digests)
+    assert grown != key
+    # Values changed in place are digested again once forgotten
+    namespace['a'][0] = 0
+    assert memo_key('b = sum(a)', namespace, ['a'], ['b'], digests=digests) == grown
+    _ = digests.pop('a')
+    assert memo_key('b = sum(a)', namespace, ['a'], ['b'], digests=digests) != grown
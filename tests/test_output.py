@@ -0,0 +1,126 @@
+"""Tests of the streaming of the output of running cells (see
+`run_async.output`), and of the partial output sent to the JS client"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import json
+import sys
+import threading
+import time
+
+from run_async.handlers import OutputStreams, WebSocketConnectionHandler
+from run_async.output import (OutputBuffer, OutputStreamer, ThreadRedirection,
+                              TRUNCATED_OUTPUT)
+from run_async.run_server import AsyncRunHandler
+from run_async.settings import JS_ROLE
+from run_async.utils import format_ws_connection_id
+
+
+def test_buffer_keeps_the_tail_of_the_output():
+    output = OutputBuffer(max_size=10)
+    output.append('abcd')
+    assert output.getvalue() == 'abcd' and not output.truncated
+    output.append('efghijkl')
+    output.append('mn')
+    assert len(output) == 10
+    assert output.getvalue() == TRUNCATED_OUTPUT + 'efghijklmn'
+    output.append('x' * 15)
+    assert output.getvalue() == TRUNCATED_OUTPUT + 'x' * 10
+
+
+def test_writes_are_batched():
+    batches = list()
+    with OutputStreamer(batches.append, flush_interval=60, batch_size=10) as streamer:
+        sys.stdout.write('abc\n')
+        sys.stderr.write('de\n')
+        assert batches == []
+        sys.stdout.write('fghij\n')  # the batch is full
+        assert batches == ['abc\nde\nfghij\n']
+        sys.stdout.write('k\n')
+    # The last batch is sent as the cell is completed
+    assert batches == ['abc\nde\nfghij\n', 'k\n']
+    assert streamer.getvalue() == 'abc\nde\nfghij\nk\n'
+
+
+def test_batches_are_sent_periodically():
+    batches = list()
+    with OutputStreamer(batches.append, flush_interval=.05) as streamer:
+        print('started')
+        deadline = time.monotonic() + 5
+        while not batches and time.monotonic() < deadline:
+            time.sleep(.01)
+        # Sent while the cell is still running
+        assert batches == ['started\n']
+    assert streamer.getvalue() == 'started\n'
+
+
+def test_output_is_truncated_but_every_batch_is_sent():
+    batches = list()
+    with OutputStreamer(batches.append, flush_interval=60, batch_size=4,
+                        max_size=6) as streamer:
+        for index in range(5):
+            print(index * 111)
+    assert ''.join(batches) == '0\n111\n222\n333\n444\n'
+    assert streamer.getvalue() == TRUNCATED_OUTPUT + '3\n444\n'
+
+
+def test_failed_sends_are_ignored():
+    def send(text):
+        raise OSError('Pool gone')
+
+    with OutputStreamer(send, batch_size=1) as streamer:
+        print('still running')
+    assert streamer.getvalue() == 'still running\n'
+
+
+def test_threads_are_redirected_to_their_own_streamer():
+    redirection = ThreadRedirection()
+    stdout = sys.stdout
+    streamers = [OutputStreamer(lambda text: None, flush_interval=60) for _ in range(2)]
+
+    def run(index):
+        streamer = streamers[index]
+        streamer.start()
+        with redirection.redirect(streamer):
+            print('thread', index)
+        streamer.stop()
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [streamer.getvalue() for streamer in streamers] == ['thread 0\n', 'thread 1\n']
+    assert sys.stdout is stdout
+
+
+class Client:
+    """JS client of a cell, recording the messages written"""
+
+    def __init__(self):
+        self.messages = list()
+
+    def write_message(self, message):
+        self.messages.append(json.loads(message))
+
+
+class Handler(AsyncRunHandler):
+    """Handler of the kernel channel, without any connection"""
+
+    def __init__(self, connections, output_streams):
+        self._connection_handler = connections
+        self._output_streams = output_streams
+
+
+def test_partial_output_sent_to_the_client():
+    connections, output_streams = WebSocketConnectionHandler(), OutputStreams()
+    handler = Handler(connections, output_streams)
+    # Output streamed before the client connects is buffered
+    handler.stream_output('cell', 'started\n')
+    client = Client()
+    connections.add(format_ws_connection_id(JS_ROLE, 'cell'), client)
+    handler.stream_output('cell', 'running\n')
+    assert client.messages == [{'session_id': 'cell', 'output': 'running\n',
+                                'partial': True}]
+    assert output_streams.get('cell').getvalue() == 'started\nrunning\n'
@@ -0,0 +1,96 @@
+"""Tests of the profiling of async cells (see `run_async.profiling`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import pytest
+from traitlets.config import Config
+from IPython.core.interactiveshell import InteractiveShell
+
+from run_async.profiling import CellProfile, CellProfiler
+
+CELL = '''\
+import time
+
+def slow(n):
+    total = 0
+    for i in range(n):
+        total += i
+    time.sleep(.05)
+    return total
+
+def fast():
+    return 1
+
+result = slow(1000) + fast()
+'''
+
+
+@pytest.fixture
+def shell():
+    config = Config()
+    config.HistoryManager.enabled = False
+    shell = InteractiveShell(config=config)
+    yield shell
+    InteractiveShell.clear_instance()
+
+
+def _profile(shell, source, **kwargs):
+    with CellProfiler(shell, **kwargs) as profiler:
+        shell.run_cell(source, silent=True)
+    return profiler.stats()
+
+
+def test_functions_called_by_the_cell(shell):
+    profile = _profile(shell, CELL)
+    assert shell.user_ns['result'] == sum(range(1000)) + 1
+    assert profile.total_time >= .05
+    functions = [stats['function'] for stats in profile.functions]
+    slow, = [stats for stats in profile.functions if stats['function'].endswith('(slow)')]
+    assert slow['calls'] == 1 and slow['cumulative_time'] >= .05
+    assert slow['line'] == 3
+    assert any(name.endswith('(fast)') for name in functions)
+    assert '<built-in method time.sleep>' in functions
+    # The machinery of the shell is not profiled, nor the cell itself
+    assert not any('interactiveshell' in name or name.endswith('(<module>)')
+                   for name in functions)
+    # Functions are sorted by cumulative time
+    times = [stats['cumulative_time'] for stats in profile.functions]
+    assert times == sorted(times, reverse=True)
+    assert profile.lines == dict()
+
+
+def test_top_functions(shell):
+    assert len(_profile(shell, CELL, top=2).functions) == 2
+
+
+def test_line_timings(shell):
+    profile = _profile(shell, CELL, lines=['slow'])
+    (function, lines), = profile.lines.items()
+    assert function.endswith('(slow)')
+    by_line = {stats['line']: stats for stats in lines}
+    assert by_line[6]['hits'] == 1000
+    assert by_line[6]['source'].strip() == 'total += i'
+    assert by_line[7]['time'] >= .05
+    assert max(lines, key=lambda stats: stats['time'])['line'] == 7
+
+
+def test_shell_is_restored(shell):
+    run_code = shell.run_code
+    _ = _profile(shell, 'a = 1')
+    assert shell.run_code == run_code
+    assert 'run_code' not in vars(shell)
+
+
+def test_format():
+    profile = CellProfile(1.5, [{'function': 'cell.py:1(f)', 'filename': 'cell.py',
+                                 'line': 1, 'calls': 3, 'primitive_calls': 1,
+                                 'total_time': .5, 'cumulative_time': 1.25}],
+                          {'cell.py:1(f)': [{'line': 2, 'hits': 3, 'time': .75,
+                                             'source': '    g()'}]})
+    text = profile.format()
+    assert text.startswith('Profile of the cell: 1.500 s\n')
+    assert '3/1     0.5000     1.2500  cell.py:1(f)' in text
+    assert 'Line timings of cell.py:1(f)' in text
+    assert '     2          3     0.7500      g()' in text
+    assert repr(profile) == '<CellProfile: 1 functions, 1.500 s>'
@@ -0,0 +1,107 @@
+"""Tests of the eviction (and spilling) of results
+(see `run_async.handlers.ResultCache`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import os
+
+from run_async.handlers import ResultCache
+from run_async.settings import JS_ROLE
+from run_async.utils import format_ws_connection_id
+
+
+def _id(session_id):
+    return format_ws_connection_id(JS_ROLE, session_id)
+
+
+def _cache(tmp_path=None, **kwargs):
+    spill_dir = None if tmp_path is None else str(tmp_path / 'spill')
+    options = dict(max_size=10, ttl=3600, spill_dir=spill_dir,
+                   spill_min_size=100, spill_max_size=20)
+    options.update(kwargs)
+    return ResultCache(**options)
+
+
+def test_least_recently_used_results_are_evicted():
+    cache = _cache()
+    for session_id in 'abc':
+        cache.add(session_id, session_id * 4)
+    # a (4 bytes) evicted, with no spill folder: dropped
+    assert cache.entries == [_id('b'), _id('c')]
+    assert cache.nbytes == 8
+    assert cache.get(_id('b')) == 'bbbb'  # used: the last to be evicted
+    cache.add('d', 'dddd')
+    assert cache.entries == [_id('b'), _id('d')]
+    assert cache.get(_id('a')) is None
+
+
+def test_evicted_results_are_spilled(tmp_path):
+    cache = _cache(tmp_path)
+    for session_id in 'abc':
+        cache.add(session_id, session_id * 4)
+    assert cache.nbytes == 8
+    assert cache.spilled_nbytes == 4
+    assert _id('a') in cache
+    assert cache.get(_id('a')) == 'aaaa'
+    assert os.listdir(str(tmp_path / 'spill')) == [_id('a')]
+
+
+def test_spill_budget_removes_the_oldest_files(tmp_path):
+    cache = _cache(tmp_path, max_size=0, spill_max_size=8)
+    for session_id in 'abc':
+        cache.add(session_id, session_id * 4)
+    assert cache.entries == [_id('b'), _id('c')]
+    assert cache.spilled_nbytes == 8
+    assert sorted(os.listdir(str(tmp_path / 'spill'))) == [_id('b'), _id('c')]
+
+
+def test_large_results_are_spilled_at_once(tmp_path):
+    cache = _cache(tmp_path, max_size=1000, spill_min_size=5)
+    cache.add('a', 'small')
+    cache.add('b', 'tiny')
+    assert cache.nbytes == 4
+    assert cache.spilled_nbytes == 5
+    assert cache.get(_id('a')) == 'small'
+    # Larger than the whole spill budget: kept in memory
+    cache.add('c', 'x' * 21)
+    assert cache.get(_id('c')) == 'x' * 21
+    assert cache.spilled_nbytes == 5
+
+
+def test_results_not_spilled_are_kept_in_memory(tmp_path):
+    (tmp_path / 'spill').write_text('not a folder')
+    cache = _cache(tmp_path, max_size=1000, spill_min_size=5)
+    cache.add('a', 'large')
+    assert cache.get(_id('a')) == 'large'
+    assert cache.nbytes == 5 and cache.spilled_nbytes == 0
+    # Until evicted
+    cache.max_size = 10
+    for session_id in 'bc':
+        cache.add(session_id, session_id * 4)
+    assert cache.entries == [_id('b'), _id('c')]
+
+
+def test_results_replaced_and_removed(tmp_path):
+    cache = _cache(tmp_path)
+    cache.add('a', 'aaaa')
+    cache.add('a', 'aa')
+    assert cache.nbytes == 2
+    assert cache.get(_id('a')) == 'aa'
+    for session_id in 'bcd':
+        cache.add(session_id, session_id * 4)
+    cache.remove(_id('a'))
+    cache.remove(_id('b'))
+    assert _id('a') not in cache and _id('b') not in cache
+    assert cache.nbytes + cache.spilled_nbytes == 8
+
+
+def test_expired_results_are_spilled(tmp_path):
+    cache = _cache(tmp_path, ttl=-1)
+    cache.add('a', 'aaaa')
+    cache.expire()
+    assert cache.nbytes == 0
+    assert cache.get(_id('a')) == 'aaaa'
+    cache.clear()
+    assert cache.entries == []
+    assert not os.path.exists(str(tmp_path / 'spill'))
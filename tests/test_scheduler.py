@@ -0,0 +1,119 @@
+"""Tests of the scheduling of jobs (see `run_async.handlers.ExecutionHandler`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+from concurrent.futures import Future
+
+import pytest
+
+from run_async.handlers import ExecutionHandler, JobRejected
+
+
+class Loop:
+    """Loop completing jobs as soon as their futures are done"""
+
+    @staticmethod
+    def add_future(future, callback):
+        future.add_done_callback(callback)
+
+
+class Jobs:
+    """Jobs recording the order they are started in, and their futures"""
+
+    def __init__(self):
+        self.started = list()
+        self.futures = dict()
+        self.cancelled = dict()
+
+    def job(self, request_id):
+        def start():
+            self.started.append(request_id)
+            future = self.futures[request_id] = Future()
+            return future
+        return start
+
+    def on_cancel(self, request_id):
+        return lambda reason: self.cancelled.__setitem__(request_id, reason)
+
+    def done(self, request_id):
+        self.futures[request_id].set_result(None)
+
+
+def _submit(scheduler, jobs, session_id, request_id, priority='normal'):
+    scheduler.submit(session_id, request_id, jobs.job(request_id), priority,
+                     on_cancel=jobs.on_cancel(request_id))
+
+
+def test_concurrency_limit():
+    scheduler, jobs = ExecutionHandler(Loop(), max_running=2), Jobs()
+    for request_id in 'abc':
+        _submit(scheduler, jobs, 'notebook', request_id)
+    assert jobs.started == ['a', 'b']
+    assert (scheduler.running, scheduler.queued) == (2, 1)
+    jobs.done('b')
+    assert jobs.started == ['a', 'b', 'c']
+    assert scheduler.queued_jobs('notebook') == []
+
+
+def test_priorities_and_round_robin():
+    scheduler, jobs = ExecutionHandler(Loop(), max_running=1), Jobs()
+    _submit(scheduler, jobs, 'one', 'running')
+    _submit(scheduler, jobs, 'one', 'one-1')
+    _submit(scheduler, jobs, 'one', 'one-2')
+    _submit(scheduler, jobs, 'two', 'two-1')
+    _submit(scheduler, jobs, 'two', 'low', priority='low')
+    _submit(scheduler, jobs, 'two', 'high', priority='high')
+    for request_id in ['running', 'high', 'one-1', 'two-1', 'one-2']:
+        jobs.done(request_id)
+    assert jobs.started == ['running', 'high', 'one-1', 'two-1', 'one-2', 'low']
+
+
+def test_admission_control():
+    scheduler = ExecutionHandler(Loop(), max_running=1, max_queued=3,
+                                 max_queued_per_session=2)
+    jobs = Jobs()
+    for request_id in 'abc':
+        _submit(scheduler, jobs, 'one', request_id)
+    with pytest.raises(JobRejected, match='of the notebook'):
+        _submit(scheduler, jobs, 'one', 'd')
+    _submit(scheduler, jobs, 'two', 'e')
+    with pytest.raises(JobRejected, match='Too many cells waiting'):
+        _submit(scheduler, jobs, 'three', 'f')
+    assert scheduler.queued == 3
+
+
+def test_cancel_waiting_job():
+    scheduler, jobs = ExecutionHandler(Loop(), max_running=1), Jobs()
+    _submit(scheduler, jobs, 'notebook', 'a')
+    _submit(scheduler, jobs, 'notebook', 'b')
+    assert scheduler.cancel('notebook', 'b', 'Cancelled')
+    assert jobs.cancelled == {'b': 'Cancelled'}
+    assert not scheduler.cancel('notebook', 'a')  # already started
+    jobs.done('a')
+    assert jobs.started == ['a']
+    assert 'notebook' not in scheduler
+
+
+def test_job_failing_to_start():
+    scheduler, jobs = ExecutionHandler(Loop(), max_running=1), Jobs()
+    error = RuntimeError('Pool shut down')
+
+    def failing():
+        raise error
+
+    scheduler.submit('notebook', 'a', failing, on_cancel=jobs.on_cancel('a'))
+    _submit(scheduler, jobs, 'notebook', 'b')
+    assert jobs.cancelled == {'a': error}
+    assert jobs.started == ['b']
+    assert scheduler.running == 1
+
+
+def test_resize():
+    scheduler, jobs = ExecutionHandler(Loop(), max_running=1), Jobs()
+    for request_id in 'abc':
+        _submit(scheduler, jobs, 'notebook', request_id)
+    scheduler.resize(3)
+    assert jobs.started == ['a', 'b', 'c']
+    scheduler.resize(0)
+    assert scheduler.max_running == 1
@@ -0,0 +1,108 @@
+"""Tests of the registry of serializers (see `run_async.serializers`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import pytest
+
+from run_async import serializers
+from run_async.serializers import PICKLE, CLOUDPICKLE
+
+
+def _round_trip(value, **kwargs):
+    name, data = serializers.dumps(value, **kwargs)
+    return name, serializers.loads(name, data)
+
+
+def test_values_are_pickled_by_default():
+    assert _round_trip({'a': [1, 2]}) == (PICKLE, {'a': [1, 2]})
+
+
+def test_unpicklable_values_are_pickled_by_value():
+    pytest.importorskip('cloudpickle')
+    name, value = _round_trip(lambda x: x + 1)
+    assert name == CLOUDPICKLE
+    assert value(1) == 2
+    # Unless the other side cannot decode them
+    with pytest.raises(Exception):
+        serializers.dumps(lambda x: x, formats=[PICKLE])
+
+
+def test_functions_of_main_are_pickled_by_value():
+    pytest.importorskip('cloudpickle')
+    namespace = {'__name__': '__main__'}
+    exec('def f(x):\n    return x + 1', namespace)
+    name, value = _round_trip(namespace['f'])
+    assert name == CLOUDPICKLE
+    assert value(1) == 2
+    # Values referencing them (e.g. within containers) as well
+    name, value = _round_trip({'f': namespace['f']})
+    assert name == CLOUDPICKLE
+    assert value['f'](2) == 3
+    # Unlike values merely containing the name of the module
+    assert _round_trip({'__main__': '__main__'})[0] == PICKLE
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError, match='not available'):
+        serializers.loads('unknown', b'')
+    with pytest.raises(ValueError, match='Unknown serializer'):
+        serializers.select('builtins.dict', 'unknown')
+
+
+def test_numpy_arrays():
+    numpy = pytest.importorskip('numpy')
+    for array in (numpy.arange(12.).reshape(3, 4),
+                  numpy.asfortranarray(numpy.ones((3, 4), dtype='i1')),
+                  numpy.array(['2020-01-01'], dtype='datetime64[D]')):
+        name, value = _round_trip(array)
+        assert name == 'numpy'
+        assert value.dtype == array.dtype
+        assert numpy.array_equal(value, array)
+    # Objects, and formats the other side cannot decode, are pickled
+    assert _round_trip(numpy.array([[1], 'a'], dtype=object))[0] == PICKLE
+    assert _round_trip(numpy.arange(3), formats=[PICKLE])[0] == PICKLE
+
+
+def test_select_the_serializer_of_a_type():
+    numpy = pytest.importorskip('numpy')
+    try:
+        serializers.select('numpy.ndarray', None)
+        assert _round_trip(numpy.arange(3))[0] == PICKLE
+        assert 'numpy.ndarray' not in serializers.encoders()
+    finally:
+        serializers.select('numpy.ndarray', 'numpy')
+    assert _round_trip(numpy.arange(3))[0] == 'numpy'
+
+
+def test_data_frames_given_back_unchanged_are_sent_as_arrow():
+    pandas = pytest.importorskip('pandas')
+    pytest.importorskip('pyarrow')
+    frame = pandas.DataFrame({'a': [1, 2], 'b': [1.5, None],
+                              'c': pandas.Categorical(['x', 'y'])})
+    # Whatever the qualified name of DataFrames in this version of pandas
+    assert serializers.encoders()[serializers.type_name(pandas.DataFrame)] == 'arrow'
+    name, value = _round_trip(frame)
+    assert name == 'arrow'
+    pandas.testing.assert_frame_equal(value, frame)
+
+
+@pytest.mark.parametrize('case', ['lists', 'strings', 'attrs', 'index'])
+def test_data_frames_changed_by_arrow_are_pickled(case):
+    pandas = pytest.importorskip('pandas')
+    pytest.importorskip('pyarrow')
+    if case == 'lists':
+        frame = pandas.DataFrame({'a': [[1], [2, 3]]})
+    elif case == 'strings':
+        frame = pandas.DataFrame({'a': pandas.Series(['x', 'y'], dtype=object)})
+    elif case == 'attrs':
+        frame = pandas.DataFrame({'a': [1]})
+        frame.attrs['source'] = 'test'
+    else:
+        frame = pandas.DataFrame({'a': [1, 2]},
+                                 index=pandas.date_range('2020-01-01', periods=2))
+    name, value = _round_trip(frame)
+    assert name == PICKLE
+    pandas.testing.assert_frame_equal(value, frame)
+    assert value.attrs == frame.attrs
+    assert [type(item) for item in value['a']] == [type(item) for item in frame['a']]
@@ -0,0 +1,420 @@
+"""Smoke test of the server: an async cell is run by a brand-new
+`AsyncRunServer`, and its results merged into the namespace of the kernel"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import json
+import os
+import socket
+import subprocess
+import sys
+from contextlib import contextmanager
+from time import sleep
+from uuid import uuid4
+
+import pytest
+from tornado.concurrent import Future
+from tornado.gen import sleep as gen_sleep
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
+from traitlets.config import Config
+from IPython.core.interactiveshell import InteractiveShell
+
+from run_async import channel as channel_module
+from run_async.async_run_magic import CellRequest, MapJob, SessionSync, ValueDigests
+from run_async.channel import KernelChannel
+from run_async.mapping import chunk_bounds
+from run_async.run_server import AsyncRunServer
+from run_async.settings import EXEC_OUTPUT, JS_ROLE, MEMOIZED
+from run_async.transport import iter_frames
+from run_async.utils import ServerAddress, format_ws_connection_id, server_request
+
+CELL_TIMEOUT = 60
+
+
+class Request(CellRequest):
+    """Request resolving `future` once its result is merged into the
+    namespace (with None), or with the error (if failed). The output
+    of the cell is kept in `output`, and whether it was served from the
+    memoization cache in `memoized`."""
+
+    def __init__(self, *args, future=None, **kwargs):
+        super(Request, self).__init__(*args, **kwargs)
+        self.future = future
+        self.output = None
+        self.memoized = False
+
+    def on_result(self, packed_ns):
+        self.output = packed_ns.meta.get(EXEC_OUTPUT, None)
+        self.memoized = packed_ns.meta.get(MEMOIZED, False)
+        done = super(Request, self).on_result(packed_ns)
+        if done:
+            self.future.set_result(None)
+        return done
+
+    def on_error(self, message):
+        if not self.future.done():
+            self.future.set_result(message)
+
+
+def submit(channel, shell, source, request_id=None, **kwargs):
+    """Submit the cell on the channel, and return its request (whose
+    `future` is resolved once done). To be called on the IOLoop."""
+    request = Request(request_id or str(uuid4()), source, shell, future=Future(), **kwargs)
+    channel.submit(request)
+    return request
+
+
+def run_cell(channel, shell, source, **kwargs):
+    """Run the cell, and return its error (None if succeeded) along with its output"""
+    async def run():
+        request = submit(channel, shell, source, **kwargs)
+        return await request.future, request.output
+    return IOLoop.current().run_sync(run, timeout=CELL_TIMEOUT)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def running_server(pool_size=1, socket_path=''):
+    """Address of a brand-new server, listening on TCP, and on the
+    Unix domain socket `socket_path` (if any)"""
+    address = ServerAddress('127.0.0.1', _free_port(), socket_path=socket_path)
+    server = AsyncRunServer(pool_size=pool_size, address=address)
+    server.start()
+    try:
+        for _ in range(100):
+            try:
+                _ = server_request('ping', timeout=1, address=address)
+                break
+            except OSError:
+                sleep(.1)
+        else:
+            pytest.fail('Server not started')
+        yield address
+    finally:
+        server.terminate()
+        server.join(10)
+        if server.is_alive():
+            server.kill()
+
+
+@pytest.fixture(params=['tcp', 'unix'])
+def server_address(request, tmp_path):
+    """Server of a single worker, which the kernel connects to either
+    on TCP, or on the Unix domain socket of the server"""
+    socket_path = str(tmp_path / 'server.sock') if request.param == 'unix' else ''
+    with running_server(socket_path=socket_path) as address:
+        yield address
+
+
+@pytest.fixture
+def channel(server_address):
+    channel = KernelChannel(address=server_address)
+    yield channel
+    channel.close()
+
+
+def _new_shell():
+    config = Config()
+    config.HistoryManager.enabled = False
+    shell = InteractiveShell(config=config)
+    shell.display_pub.publish = lambda *args, **kwargs: None
+    return shell
+
+
+@pytest.fixture
+def shell():
+    yield _new_shell()
+    InteractiveShell.clear_instance()
+
+
+def test_run_cell(channel, shell):
+    shell.user_ns.update({'base': 40, 'values': [1, 2, 3]})
+    session = SessionSync()
+    error, _ = run_cell(channel, shell, 'import os\nresult = base + len(values) - 1\n'
+                                        'pid = os.getpid()', session=session)
+    assert error is None
+    assert shell.user_ns['result'] == 42
+    assert shell.user_ns['pid'] != shell.user_ns['os'].getpid()  # run in a worker
+    # Only the changes are sent along with further cells
+    shell.user_ns['values'].append(4)
+    error, _ = run_cell(channel, shell, 'total = sum(values)', session=session)
+    assert error is None
+    assert shell.user_ns['total'] == 10
+
+
+def test_handshake(channel, server_address):
+    assert IOLoop.current().run_sync(channel.handshake, timeout=CELL_TIMEOUT) is channel
+    assert channel.workers == 1
+    assert 'pickle' in channel.formats
+    if server_address.socket_path is not None:
+        # Connected on the Unix domain socket, whatever the TCP port
+        unix_only = ServerAddress('127.0.0.1', _free_port(),
+                                  socket_path=server_address.socket_path)
+        other = KernelChannel(address=unix_only)
+        try:
+            _ = IOLoop.current().run_sync(other.handshake, timeout=CELL_TIMEOUT)
+        finally:
+            other.close()
+
+
+def test_segments_removed_at_shutdown():
+    """The folder of the shared buffers of the server lives as long as the server"""
+    with running_server() as address:
+        segment_dir = address.segment_dir()
+        assert os.path.isdir(segment_dir)
+        open(os.path.join(segment_dir, 'left-behind'), 'wb').close()
+    assert not os.path.exists(segment_dir)
+
+
+def test_namespace_not_received(channel, shell, monkeypatch):
+    """A request whose namespace is rejected by the server fails (rather
+    than being sent again), and the next cell synchronises the namespace"""
+    shell.user_ns.update({'base': 40})
+    session = SessionSync()
+
+    async def write_corrupted(ws_conn, parts):
+        frame = next(iter_frames(parts))
+        await ws_conn.write_message(frame[:-1] + bytes([frame[-1] ^ 1]), binary=True)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(channel_module, 'write_chunked', write_corrupted)
+        error, _ = run_cell(channel, shell, 'result = base + 2', session=session)
+    assert 'CRC' in error
+    assert channel.pending == 0
+    assert 'result' not in shell.user_ns
+    error, _ = run_cell(channel, shell, 'result = base + 2', session=session)
+    assert error is None
+    assert shell.user_ns['result'] == 42
+
+
+def test_cell_timed_out(channel, shell):
+    """A cell running past its timeout is cancelled (its worker is
+    replaced), and the next cells run as usual"""
+    session = SessionSync()
+    error, output = run_cell(channel, shell, 'import time\ntime.sleep(60)\nslept = True',
+                             session=session, timeout=1)
+    assert error is None
+    assert 'cancelled: Timed out after 1' in output
+    assert 'slept' not in shell.user_ns
+    error, _ = run_cell(channel, shell, 'result = 42', session=session)
+    assert error is None
+    assert shell.user_ns['result'] == 42
+
+
+def test_cell_cancelled(channel, shell):
+    async def cancel_cell():
+        request = submit(channel, shell, 'import time\ntime.sleep(60)')
+        await gen_sleep(.5)  # (most likely) started by the worker
+        assert channel.cancel(request.request_id)
+        return await request.future, request.output
+
+    error, output = IOLoop.current().run_sync(cancel_cell, timeout=CELL_TIMEOUT)
+    assert error is None
+    assert 'Async execution cancelled' in output
+    assert not channel.cancel('unknown')
+
+
+def test_output_streamed_before_completion(channel, shell, server_address):
+    """The (JS) client of the cell receives the output of the cell
+    while it is running, then the whole output"""
+    source = 'import time\nprint("started")\ntime.sleep(2)\nprint("done")'
+
+    async def read_client():
+        request = submit(channel, shell, source)
+        client_id = format_ws_connection_id(JS_ROLE, request.request_id)
+        client = await websocket_connect(server_address.connection_string(
+            web_socket=True, extra='ws/{}'.format(client_id)))
+        client.write_message(json.dumps({'connection_id': client_id}))
+        messages = list()
+        while not messages or messages[-1].get('partial', False):
+            messages.append(json.loads(await client.read_message()))
+        client.close()
+        return await request.future, messages
+
+    error, messages = IOLoop.current().run_sync(read_client, timeout=CELL_TIMEOUT)
+    assert error is None
+    *partial, last = messages
+    streamed = [message['output'] for message in partial if message['output']]
+    # Output printed before the sleep arrives on its own
+    assert streamed[0] == 'started\n'
+    assert ''.join(streamed) == 'started\ndone\n'
+    assert last['output'] == 'started\ndone\n' and 'partial' not in last
+
+
+def test_memoized_cells(channel, shell):
+    """Memoized cells are served from the cache, until the values
+    they read change (e.g. functions redefined in the notebook)"""
+    digests, session = ValueDigests(), SessionSync()
+
+    def run_memoized():
+        async def run():
+            request = submit(channel, shell, 'result = f()', session=session, memoize=True,
+                             digests=digests.current(shell))
+            return await request.future, request.memoized
+        return IOLoop.current().run_sync(run, timeout=CELL_TIMEOUT)
+
+    _ = shell.run_cell('def f():\n    return 1')
+    assert run_memoized() == (None, False)
+    assert run_memoized() == (None, True)
+    assert shell.user_ns['result'] == 1
+    _ = shell.run_cell('def f():\n    return 2')
+    assert run_memoized() == (None, False)
+    assert shell.user_ns['result'] == 2
+
+
+def test_status(channel, shell, server_address):
+    request_id = str(uuid4())
+    error, _ = run_cell(channel, shell, 'result = 42', request_id=request_id)
+    assert error is None
+    status = json.loads(server_request('status', address=server_address))
+    job, = [job for job in status['jobs'] if job['request_id'] == request_id]
+    assert job['state'] == 'done'
+    assert job['notebook'] == channel.channel_id
+    assert job['run_time'] is not None and job['run_time'] >= 0
+    assert status['notebooks'][channel.channel_id]['kernel_pid'] == os.getpid()
+    assert status['scheduler'] == {'max_running': 1, 'running': 0, 'queued': 0}
+    worker, = status['workers']
+    assert worker['request_id'] is None and worker['rss'] > 0
+    assert status['server']['pid'] != os.getpid()
+
+
+def test_metrics(channel, shell, server_address):
+    shell.user_ns['values'] = list(range(10))
+    error, _ = run_cell(channel, shell, 'total = sum(values)')
+    assert error is None
+    lines = server_request('metrics', address=server_address).decode().splitlines()
+    assert 'run_async_jobs_total{state="done"} 1' in lines
+    # Phases timed by the server, and by the worker (those of the
+    # kernel are sent along with the next request)
+    for phase in ('transfer', 'queue', 'run_cell', 'repickle'):
+        assert 'run_async_phase_seconds_count{{phase="{}"}} 1'.format(phase) in lines
+
+
+def test_map(channel, shell):
+    """Each chunk of the iterable is run by a worker, and the values
+    the chunks set are reduced into the target name"""
+    shell.user_ns.update({'values': list(range(10)), 'scale': 2})
+    session = SessionSync()
+
+    async def run_map(chunk_size, reducer):
+        future = Future()
+        map_job = MapJob(str(uuid4()), 'squares = [scale * x * x for x in values]',
+                         shell, session, 'values', 'squares', reducer,
+                         on_completed=lambda *names: future.set_result(names))
+        for request in map_job.chunk_requests(chunk_bounds(10, chunk_size),
+                                              inputs=['values'], outputs=['squares']):
+            channel.submit(request)
+        await future
+        return map_job
+
+    map_job = IOLoop.current().run_sync(lambda: run_map(3, 'concat'), timeout=CELL_TIMEOUT)
+    assert len(map_job.requests) == 4 and not map_job.errors
+    assert shell.user_ns['squares'] == [2 * x * x for x in range(10)]
+    # The namespace of the notebook is left unchanged
+    assert shell.user_ns['values'] == list(range(10))
+    _ = IOLoop.current().run_sync(lambda: run_map(5, 'list'), timeout=CELL_TIMEOUT)
+    assert shell.user_ns['squares'] == [[0, 2, 8, 18, 32], [50, 72, 98, 128, 162]]
+
+
+@pytest.fixture
+def sticky_server_address():
+    """Server of 3 workers, i.e. 2 of them for sticky sessions"""
+    with running_server(pool_size=3) as address:
+        yield address
+
+
+def test_sticky_sessions_keep_their_worker(sticky_server_address, shell):
+    """Each sticky session keeps its namespace resident in its own worker,
+    including values that are never sent back (e.g. generators)"""
+    notebooks = [(shell, SessionSync(sticky=True)), (_new_shell(), SessionSync(sticky=True))]
+    channels = [KernelChannel(address=sticky_server_address) for _ in notebooks]
+    try:
+        for start, (channel, (notebook, session)) in zip((0, 10), zip(channels, notebooks)):
+            error, _ = run_cell(channel, notebook, 'import os\npid = os.getpid()\n'
+                                                   'items = (i for i in range({}, {}))'.format(
+                                                       start, start + 3), session=session)
+            assert error is None and 'items' not in notebook.user_ns
+        for _ in range(2):
+            for channel, (notebook, session) in zip(channels, notebooks):
+                error, _ = run_cell(channel, notebook, 'import os\nsame = os.getpid() == pid\n'
+                                                       'item = next(items)', session=session)
+                assert error is None and notebook.user_ns['same']
+        assert [notebook.user_ns['item'] for notebook, _ in notebooks] == [1, 11]
+        assert shell.user_ns['pid'] != notebooks[1][0].user_ns['pid']
+        status = json.loads(server_request('status', address=sticky_server_address))
+        bound = {worker['pid']: worker['sticky_session'] for worker in status['workers']}
+        assert bound[shell.user_ns['pid']] == notebooks[0][1].key
+        assert bound[notebooks[1][0].user_ns['pid']] == notebooks[1][1].key
+        # One worker is always kept shared
+        error, output = run_cell(channels[0], shell, 'a = 1', session=SessionSync(sticky=True))
+        assert error is None and 'No worker available' in output
+    finally:
+        for channel in channels:
+            channel.close()
+
+
+@pytest.fixture
+def agent(server_address):
+    """Worker agent (of one worker) joined to the server, whose workers
+    see RUN_ASYNC_TEST_AGENT set in their environment"""
+    server_url = server_address.connection_string(web_socket=True)
+    process = subprocess.Popen([sys.executable, '-m', 'run_async.agents',
+                                '--server', server_url, '--workers', '1'],
+                               env=dict(os.environ, RUN_ASYNC_TEST_AGENT='1'),
+                               stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            status = json.loads(server_request('status', address=server_address))
+            if status['agents']:
+                break
+            sleep(.1)
+        else:
+            pytest.fail('Worker agent not joined')
+        yield status['agents'][0]
+    finally:
+        process.terminate()
+        process.wait(10)
+
+
+def test_cells_placed_on_agents(channel, shell, agent):
+    assert agent['workers'] == 1
+    source = 'import os, time\ntime.sleep({})\nagent = os.environ.get("RUN_ASYNC_TEST_AGENT")'
+
+    async def run_cells():
+        requests = list()
+        # The first cell keeps the worker of the server busy,
+        # and the second one is placed on the agent
+        for index in range(2):
+            requests.append(submit(channel, shell, source.format(1 - index),
+                                   session=SessionSync()))
+            await gen_sleep(.2)
+        second = await requests[1].future
+        placed = shell.user_ns['agent']
+        return await requests[0].future, second, placed
+
+    first, second, placed = IOLoop.current().run_sync(run_cells, timeout=CELL_TIMEOUT)
+    assert first is None and second is None
+    assert placed == '1'  # by the agent
+    assert shell.user_ns['agent'] is None  # by the server
+
+
+def test_profiled_cell(channel, shell):
+    source = 'def square(x):\n    return x * x\n\nresult = sum(square(x) for x in range(100))'
+    error, output = run_cell(channel, shell, source, session=SessionSync(),
+                             profile={'name': 'stats', 'lines': ['square']})
+    assert error is None
+    assert shell.user_ns['result'] == sum(x * x for x in range(100))
+    stats = shell.user_ns['stats']
+    square, = [function for function in stats.functions
+               if function['function'].endswith('(square)')]
+    assert square['calls'] == 100
+    (_, lines), = stats.lines.items()
+    assert [(line['line'], line['hits']) for line in lines] == [(2, 100)]
+    assert 'Profile of the cell' in output
@@ -0,0 +1,114 @@
+"""Tests of the out-of-band transfer of large buffers through shared
+segments (see `run_async.shared_buffers`), along with packed namespaces"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import os
+import threading
+from time import time
+
+import pytest
+
+from run_async import shared_buffers
+from run_async.namespace import PackedNamespace, pack_namespace
+from run_async.settings import SHM_MIN_BUFFER_SIZE
+
+
+@pytest.fixture
+def segment_dir(tmp_path):
+    """Folder of the segments, as created by the server"""
+    former = shared_buffers.segment_dir()
+    shared_buffers.set_segment_dir(str(tmp_path / 'segments'))
+    shared_buffers.create_segment_dir()
+    assert shared_buffers.available()
+    yield shared_buffers.segment_dir()
+    shared_buffers.remove_segment_dir()
+    shared_buffers.set_segment_dir(former)
+
+
+def test_segments_are_mapped_copy_on_write(segment_dir):
+    handle = shared_buffers.write_segment(b'abc' * 10)
+    assert handle.startswith('{}-'.format(os.getpid()))
+    mapping = shared_buffers.map_segment(handle)
+    assert mapping[:3] == b'abc'
+    mapping[:3] = b'xyz'  # writable, but never written back
+    assert shared_buffers.map_segment(handle)[:3] == b'abc'
+    shared_buffers.release_segments([handle, handle])
+    assert os.listdir(segment_dir) == []
+    # Mappings outlive their segments
+    assert mapping[:6] == b'xyzabc'
+    with pytest.raises(OSError):
+        shared_buffers.map_segment(handle)
+
+
+def test_segments_of_a_process_are_released(segment_dir):
+    since = time() - 1
+    handles = [shared_buffers.write_segment(b'a') for _ in range(2)]
+    other = os.path.join(segment_dir, '1-other')
+    open(other, 'wb').close()
+    shared_buffers.release_process_segments(os.getpid(), since)
+    assert os.listdir(segment_dir) == ['1-other']
+    shared_buffers.release_segments(handles)  # already released
+
+
+def test_segments_are_removed_along_with_their_folder(segment_dir):
+    _ = shared_buffers.write_segment(b'a')
+    shared_buffers.remove_segment_dir()
+    assert not os.path.exists(segment_dir)
+    assert not shared_buffers.available()
+
+
+def test_small_buffers_are_in_band(segment_dir):
+    numpy = pytest.importorskip('numpy')
+    packed = pack_namespace({'a': numpy.arange(10)}, out_of_band=True)
+    assert packed.buffers == {} and os.listdir(segment_dir) == []
+
+
+def test_arrays_are_passed_out_of_band(segment_dir):
+    numpy = pytest.importorskip('numpy')
+    array = numpy.arange(SHM_MIN_BUFFER_SIZE // 8 + 1, dtype='f8')
+    data = bytes(SHM_MIN_BUFFER_SIZE)
+    packed = pack_namespace({'array': array, 'data': data, 'same': array},
+                            out_of_band=True)
+    assert set(packed.buffers) == {'array', 'data'} and packed.aliases == {'same': 'array'}
+    assert sorted(os.listdir(segment_dir)) == sorted(packed.segments)
+    message = packed.to_bytes()
+    assert len(message) < SHM_MIN_BUFFER_SIZE  # only the handles travel
+    namespace = PackedNamespace.from_buffer(message).unpack(release=True)
+    # Segments are released, and values arrive intact (and writable)
+    assert os.listdir(segment_dir) == []
+    assert numpy.array_equal(namespace['array'], array)
+    assert namespace['same'] is namespace['array']
+    namespace['array'][0] = -1
+    assert array[0] == 0
+    assert namespace['data'] == data and type(namespace['data']) is bytes
+
+
+def test_segments_of_discarded_encodings_are_released(segment_dir):
+    numpy = pytest.importorskip('numpy')
+    array = numpy.zeros(SHM_MIN_BUFFER_SIZE, dtype='u1')
+    # Values that cannot be encoded at all (after the array)
+    packed = pack_namespace({'value': [array, threading.Lock()]}, out_of_band=True)
+    assert 'value' in packed.skipped and packed.buffers == {}
+    assert os.listdir(segment_dir) == []
+    # Values pickled again by value (after the array), e.g. functions of `__main__`
+    pytest.importorskip('cloudpickle')
+    namespace = {'__name__': '__main__'}
+    exec('def f():\n    return 1', namespace)
+    packed = pack_namespace({'value': [array, namespace['f']]}, out_of_band=True)
+    handle, = packed.buffers['value']
+    assert os.listdir(segment_dir) == [handle]
+    value = packed.unpack(release=True)['value']
+    assert numpy.array_equal(value[0], array) and value[1]() == 1
+
+
+def test_segments_not_available():
+    former = shared_buffers.segment_dir()
+    shared_buffers.set_segment_dir(os.path.join(former, 'missing'))
+    try:
+        assert not shared_buffers.available()
+        packed = pack_namespace({'data': bytes(SHM_MIN_BUFFER_SIZE)}, out_of_band=True)
+        assert packed.buffers == {} and len(packed.values['data']) >= SHM_MIN_BUFFER_SIZE
+    finally:
+        shared_buffers.set_segment_dir(former)
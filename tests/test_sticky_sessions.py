@@ -0,0 +1,65 @@
+"""Tests of the sticky sessions of the worker pool
+(see `run_async.workers.WorkerPool.submit_sticky`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import os
+from multiprocessing import get_context
+
+import pytest
+
+from run_async.workers import WorkerPool, WorkerError
+
+TIMEOUT = 30
+
+# State of the worker process (kept across the jobs of a session)
+_state = list()
+
+
+def remember(value):
+    _state.append(value)
+    return os.getpid(), list(_state)
+
+
+@pytest.fixture
+def pool(request):
+    pool = WorkerPool(max_workers=request.param, mp_context=get_context('fork'))
+    pool.start()
+    yield pool
+    pool.shutdown()
+
+
+@pytest.mark.parametrize('pool', [2], indirect=True)
+def test_session_state_is_resident_in_its_worker(pool):
+    first_pid, _ = pool.submit_sticky('session', remember, 1).result(TIMEOUT)
+    pid, state = pool.submit_sticky('session', remember, 2).result(TIMEOUT)
+    assert pid == first_pid
+    assert state[-2:] == [1, 2]
+    # Bound to the session: shared jobs run on the other worker
+    for value in range(4):
+        pid, _ = pool.submit(remember, value).result(TIMEOUT)
+        assert pid != first_pid
+    assert (first_pid, None, 'session') in pool.workers
+    assert list(pool.sticky_sessions) == ['session']
+
+
+@pytest.mark.parametrize('pool', [2], indirect=True)
+def test_one_worker_is_kept_shared(pool):
+    assert pool.max_sticky_sessions == 1
+    _ = pool.submit_sticky('one', remember, 1).result(TIMEOUT)
+    with pytest.raises(WorkerError, match='all the 1 workers'):
+        pool.submit_sticky('two', remember, 1).result(TIMEOUT)
+    # Released sessions free their worker
+    pool.release('one')
+    _ = pool.submit(remember, 0).result(TIMEOUT)  # the release is dispatched
+    _ = pool.submit_sticky('two', remember, 1).result(TIMEOUT)
+    assert list(pool.sticky_sessions) == ['two']
+
+
+@pytest.mark.parametrize('pool', [1], indirect=True)
+def test_no_sticky_session_with_a_single_worker(pool):
+    assert pool.max_sticky_sessions == 0
+    with pytest.raises(WorkerError, match='at least 2 workers'):
+        pool.submit_sticky('session', remember, 1).result(TIMEOUT)
+    assert pool.submit(remember, 1).result(TIMEOUT)[0] in pool.pids
@@ -0,0 +1,129 @@
+"""Tests of the execution of async cells in threads of the kernel
+(see `run_async.threads.ThreadRunner`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import threading
+from uuid import uuid4
+
+import pytest
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from traitlets.config import Config
+from IPython.core.interactiveshell import InteractiveShell
+
+from run_async import threads
+from run_async.async_run_magic import CellRequest
+from run_async.threads import ThreadRunner
+
+CELL_TIMEOUT = 10
+
+
+@pytest.fixture
+def shell():
+    config = Config()
+    config.HistoryManager.enabled = False
+    shell = InteractiveShell(config=config)
+    yield shell
+    InteractiveShell.clear_instance()
+
+
+@pytest.fixture
+def displayed(monkeypatch):
+    """Outputs shown in the placeholders of the cells (by request ID)"""
+    displayed = dict()
+    monkeypatch.setattr(threads, 'update_output_cell', displayed.__setitem__)
+    return displayed
+
+
+@pytest.fixture
+def runner():
+    runner = ThreadRunner(pool_size=1)
+    yield runner
+    runner.shutdown()
+
+
+def _run(runner, request):
+    """Run the cell of the request, and return the names it changed
+    and deleted (once merged into the namespace)"""
+    async def run():
+        future = Future()
+        runner.submit(request, on_merged=lambda *names: future.set_result(names))
+        return await future
+    return IOLoop.current().run_sync(run, timeout=CELL_TIMEOUT)
+
+
+def test_names_changed_by_the_cell_are_merged(shell, runner, displayed):
+    shell.user_ns.update({'base': 40, 'gone': 1, 'values': [1], 'threading': threading})
+    request = CellRequest(str(uuid4()), 'import json\n'
+                                        'result = base + 2\n'
+                                        'del gone\n'
+                                        'values.append(2)\n'
+                                        'print("thread", threading.current_thread().name)',
+                          shell)
+    changed, deleted = _run(runner, request)
+    assert {'json', 'result', 'values'} <= changed
+    assert deleted == {'gone'}
+    assert shell.user_ns['result'] == 42
+    assert 'gone' not in shell.user_ns
+    assert shell.user_ns['json'].dumps(1) == '1'
+    # Values are shared with the notebook (i.e. not copied)
+    assert shell.user_ns['values'] == [1, 2]
+    output = displayed[request.request_id]
+    assert 'thread AsyncCell' in output
+    assert threading.current_thread().name not in output
+
+
+def test_top_level_await(shell, runner, displayed):
+    request = CellRequest(str(uuid4()), 'import asyncio\n'
+                                        'await asyncio.sleep(0)\n'
+                                        'done = True', shell)
+    changed, _ = _run(runner, request)
+    assert 'done' in changed and shell.user_ns['done']
+
+
+def test_errors_are_part_of_the_output(shell, runner, displayed):
+    request = CellRequest(str(uuid4()), 'before = 1\n1 / 0\nafter = 2', shell)
+    changed, _ = _run(runner, request)
+    assert changed == {'before'}
+    assert 'ZeroDivisionError' in displayed[request.request_id]
+    assert 'after' not in shell.user_ns
+
+
+def test_waiting_cells_can_be_cancelled(shell, runner, displayed):
+    release = threading.Event()
+    shell.user_ns['release'] = release
+    running = CellRequest(str(uuid4()), 'release.wait(10)', shell)
+    waiting = CellRequest(str(uuid4()), 'cancelled = False', shell)
+
+    async def run():
+        future = Future()
+        runner.submit(running, on_merged=lambda *names: future.set_result(names))
+        runner.submit(waiting)
+        assert runner.requests == [running.request_id, waiting.request_id]
+        assert runner.cancel(waiting.request_id)
+        assert not runner.cancel('unknown')
+        release.set()
+        return await future
+
+    _ = IOLoop.current().run_sync(run, timeout=CELL_TIMEOUT)
+    assert 'cancelled' not in shell.user_ns
+    assert 'Cancelled' in displayed[waiting.request_id]
+    assert runner.requests == []
+
+
+def test_value_of_the_last_expression_is_displayed(shell, runner, displayed):
+    shell.user_ns['base'] = 40
+    request = CellRequest(str(uuid4()), 'import asyncio\n'
+                                        'await asyncio.sleep(0)\n'
+                                        'print("before")\n'
+                                        '{"answer": base + 2}', shell)
+    changed, _ = _run(runner, request)
+    assert displayed[request.request_id] == "before\n{'answer': 42}\n"
+    assert '_async_cell_result' not in shell.user_ns and 'asyncio' in changed
+    # Unless followed by a semicolon, or None
+    for source in ('base + 2;', 'None', 'print("done")'):
+        request = CellRequest(str(uuid4()), source, shell)
+        _ = _run(runner, request)
+        assert '42' not in displayed[request.request_id]
@@ -0,0 +1,123 @@
+"""Tests of the framed, chunked transfer of messages (see `run_async.transport`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import struct
+from zlib import crc32
+
+import pytest
+
+from run_async.transport import MessageReader, TransferError, iter_frames
+
+HEADER_SIZE = struct.calcsize('!IQQI')
+
+
+def _frame(total, payload, checksum=None, message_id=0, offset=0):
+    if checksum is None:
+        checksum = crc32(payload)
+    return struct.pack('!IQQI', message_id, total, offset, checksum) + payload
+
+
+def _reassemble(frames, reader=None):
+    reader = reader or MessageReader()
+    messages = [reader.feed(frame) for frame in frames]
+    assert all(message is None for message in messages[:-1])
+    return messages[-1]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 64])
+def test_round_trip_across_parts(chunk_size):
+    parts = [b'header', bytearray(b'-' * 10), memoryview(b'payload')]
+    frames = list(iter_frames(parts, chunk_size))
+    assert all(len(frame) - HEADER_SIZE <= chunk_size for frame in frames)
+    assert _reassemble(frames) == b''.join(bytes(part) for part in parts)
+
+
+def test_empty_message():
+    frames = list(iter_frames([b''], 4))
+    assert len(frames) == 1
+    assert _reassemble(frames) == b''
+
+
+def test_frames_carry_id_size_offset_and_checksum():
+    frames = list(iter_frames([b'abcdef'], 4, message_id=7))
+    assert [struct.unpack_from('!IQQI', frame) for frame in frames] == [
+        (7, 6, 0, crc32(b'abcd')), (7, 6, 4, crc32(b'ef'))]
+    # Each message has its own ID
+    first, second = (struct.unpack_from('!I', next(iter_frames([b'x'])))[0]
+                     for _ in range(2))
+    assert first != second
+
+
+def test_reader_is_reusable():
+    reader = MessageReader()
+    for message in (b'first message', b'second', b'x' * 100):
+        assert _reassemble(list(iter_frames([message], 8)), reader) == message
+
+
+def test_corrupted_frame():
+    reader = MessageReader()
+    frames = list(iter_frames([b'abcdefgh'], 4))
+    assert reader.feed(frames[0]) is None
+    corrupted = frames[1][:-1] + b'X'
+    with pytest.raises(TransferError, match='CRC'):
+        reader.feed(corrupted)
+    # The message being reassembled is discarded
+    assert _reassemble(list(iter_frames([b'next'], 4)), reader) == b'next'
+
+
+def test_frames_of_a_rejected_message_are_dropped():
+    reader = MessageReader()
+    frames = list(iter_frames([b'abcdefghijkl'], 4))
+    assert reader.feed(frames[0]) is None
+    with pytest.raises(TransferError, match='CRC'):
+        reader.feed(frames[1][:-1] + b'X')
+    # Never taken as the start of a message
+    assert reader.feed(frames[2]) is None
+    assert _reassemble(list(iter_frames([b'next'], 4)), reader) == b'next'
+
+
+def test_truncated_frame():
+    with pytest.raises(TransferError, match='Truncated'):
+        MessageReader().feed(b'\x00' * 5)
+
+
+def test_frame_of_a_different_message():
+    reader = MessageReader()
+    assert reader.feed(_frame(8, b'abcd')) is None
+    with pytest.raises(TransferError, match='different message'):
+        reader.feed(_frame(9, b'efgh', offset=4))
+    assert reader.feed(_frame(8, b'abcd', message_id=1)) is None
+    with pytest.raises(TransferError, match='different message'):
+        reader.feed(_frame(8, b'efgh', message_id=2, offset=4))
+    # Frames out of order
+    assert reader.feed(_frame(12, b'abcd', message_id=3)) is None
+    with pytest.raises(TransferError, match='different message'):
+        reader.feed(_frame(12, b'ijkl', message_id=3, offset=8))
+
+
+def test_frame_exceeding_the_message_size():
+    reader = MessageReader()
+    assert reader.feed(_frame(6, b'abcd')) is None
+    with pytest.raises(TransferError, match='exceeding the message size'):
+        reader.feed(_frame(6, b'efgh', offset=4))
+    # Checked before allocating the message, too
+    with pytest.raises(TransferError, match='exceeding the message size'):
+        MessageReader().feed(_frame(2, b'abcd'))
+
+
+def test_message_exceeding_the_maximum_size():
+    reader = MessageReader(max_size=16)
+    assert _reassemble(list(iter_frames([b'x' * 16], 8)), reader) == b'x' * 16
+    with pytest.raises(TransferError, match='maximum size'):
+        reader.feed(_frame(17, b'x'))
+    # Never allocated, whatever the announced size
+    with pytest.raises(TransferError, match='maximum size'):
+        reader.feed(_frame(1 << 62, b'x'))
+    # Its further frames are dropped
+    frames = list(iter_frames([b'x' * 24], 8))
+    with pytest.raises(TransferError, match='maximum size'):
+        reader.feed(frames[0])
+    assert [reader.feed(frame) for frame in frames[1:]] == [None, None]
+    assert _reassemble(list(iter_frames([b'y' * 16], 8)), reader) == b'y' * 16
@@ -0,0 +1,64 @@
+"""Tests of the InteractiveShell kept warm in each worker process
+(see `run_async.run_server.warm_up_worker` and `execute_cell`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import os
+from multiprocessing import get_context
+
+import pytest
+
+from run_async import run_server
+from run_async.namespace import PackedNamespace, pack_namespace
+from run_async.run_server import execute_cell, get_worker_shell, warm_up_worker
+from run_async.settings import EXEC_OUTPUT
+from run_async.workers import WorkerPool
+
+TIMEOUT = 30
+
+
+def worker_shell():
+    """ID of the shell of the worker, and whether it was warm already"""
+    warm = run_server._worker_shell is not None
+    return os.getpid(), id(get_worker_shell()), warm
+
+
+def _run(pool, source, namespace):
+    packed_ns = pack_namespace(namespace).to_bytes()
+    result = pool.submit(execute_cell, source, packed_ns).result(TIMEOUT)
+    packed_result = PackedNamespace.from_buffer(result)
+    return packed_result.meta[EXEC_OUTPUT], packed_result.unpack()
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool(max_workers=1, mp_context=get_context('fork'),
+                      initializer=warm_up_worker)
+    pool.start()
+    yield pool
+    pool.shutdown()
+
+
+def test_shell_is_created_once_as_the_worker_starts(pool):
+    pid, shell_id, warm = pool.submit(worker_shell).result(TIMEOUT)
+    assert warm
+    assert pool.submit(worker_shell).result(TIMEOUT) == (pid, shell_id, True)
+
+
+def test_namespace_is_reset_between_cells(pool):
+    output, namespace = _run(pool, 'b = a + 1\nprint(b)', {'a': 1})
+    assert output == '2\n'
+    assert namespace['b'] == 2
+    # Names of the former cell are gone
+    output, _ = _run(pool, "print('a' in dir(), 'b' in dir())", {})
+    assert output == 'False False\n'
+
+
+def test_errors_are_part_of_the_output(pool):
+    output, namespace = _run(pool, 'before = 1\n1 / 0', {})
+    assert 'ZeroDivisionError' in output
+    assert namespace['before'] == 1
+    # The shell keeps running cells
+    output, _ = _run(pool, 'print(40 + 2)', {})
+    assert output == '42\n'
@@ -0,0 +1,201 @@
+"""Tests of the persistent pool of worker processes
+(see `run_async.workers.WorkerPool`)"""
+# Author: Valerio Maggio <valeriomaggio@gmail.com>
+# Copyright (c) 2015 Valerio Maggio <valeriomaggio@gmail.com>
+# License: BSD 3 clause
+
+import os
+import signal
+import sys
+import threading
+import time
+from multiprocessing import get_context
+
+import pytest
+
+from run_async import workers
+from run_async.workers import (WorkerPool, WorkerError, JobCancelled, preloading_context,
+                               send_progress)
+
+TIMEOUT = 30
+
+# Number of times the initializer ran in the worker process
+_initialized = list()
+
+
+def initialize():
+    _initialized.append(os.getpid())
+
+
+def state():
+    return os.getpid(), len(_initialized)
+
+
+def fail():
+    raise ValueError('Failed in the worker')
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def die():
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def loaded(*modules):
+    return [module in sys.modules for module in modules]
+
+
+def identity(value):
+    return value
+
+
+class SlowToPickle:
+    """Argument whose pickling (by the pool) lasts until released"""
+
+    def __init__(self, release):
+        self.release = release
+
+    def __reduce__(self):
+        self.release.wait(TIMEOUT)
+        return int, (0,)
+
+
+def report(count):
+    for index in range(count):
+        send_progress(index)
+    return count
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool(max_workers=2, mp_context=get_context('fork'),
+                      initializer=initialize)
+    pool.start()
+    yield pool
+    pool.shutdown()
+
+
+def test_workers_are_reused(pool):
+    pids = set(pool.pids)
+    assert len(pids) == 2
+    for _ in range(6):
+        pid, initialized = pool.submit(state).result(TIMEOUT)
+        assert pid in pids
+        # The initializer ran once, as the worker started
+        assert initialized == 1
+    assert set(pool.pids) == pids
+
+
+def test_jobs_run_in_parallel(pool):
+    start = time.monotonic()
+    futures = [pool.submit(sleep, .5) for _ in range(2)]
+    pids = {future.result(TIMEOUT) for future in futures}
+    assert pids == set(pool.pids)
+    assert time.monotonic() - start < 1
+
+
+def test_exceptions_are_raised_on_the_future(pool):
+    with pytest.raises(ValueError, match='Failed in the worker'):
+        pool.submit(fail).result(TIMEOUT)
+    assert pool.submit(state).result(TIMEOUT)[0] in pool.pids
+
+
+def test_large_jobs_do_not_hold_up_other_workers(pool):
+    release = threading.Event()
+    try:
+        slow = pool.submit(identity, SlowToPickle(release))
+        # Dispatched (and run) while the former job is still being sent
+        assert pool.submit(state).result(TIMEOUT)[0] in pool.pids
+        assert not slow.done()
+    finally:
+        release.set()
+    assert slow.result(TIMEOUT) == 0
+
+
+def test_jobs_that_cannot_be_sent_fail(pool):
+    with pytest.raises(TypeError):
+        pool.submit(identity, threading.Lock()).result(TIMEOUT)
+    # The worker is still idle, and running jobs
+    for _ in range(4):
+        assert pool.submit(identity, 1).result(TIMEOUT) == 1
+
+
+def test_dead_workers_are_replaced(pool):
+    pids = set(pool.pids)
+    with pytest.raises(WorkerError, match='died unexpectedly'):
+        pool.submit(die).result(TIMEOUT)
+    pid, initialized = pool.submit(state).result(TIMEOUT)
+    assert initialized == 1
+    new_pids = set(pool.pids)
+    assert len(new_pids) == 2 and len(new_pids - pids) == 1
+
+
+def test_cancel_running_and_pending_jobs():
+    pool = WorkerPool(max_workers=1, mp_context=get_context('fork'))
+    pool.start()
+    try:
+        pid, = pool.pids
+        running, pending = pool.submit(sleep, 30), pool.submit(sleep, 0)
+        time.sleep(.5)
+        assert running.running() and running.pid == pid
+        assert pool.cancel(pending, 'Not needed')
+        assert pool.cancel(running, 'Too slow')
+        with pytest.raises(JobCancelled, match='Not needed'):
+            pending.result(TIMEOUT)
+        with pytest.raises(JobCancelled, match='Too slow'):
+            running.result(TIMEOUT)
+        assert not pool.cancel(running)
+        # The killed worker is replaced
+        assert pool.submit(sleep, 0).result(TIMEOUT) != pid
+    finally:
+        pool.shutdown()
+
+
+def test_progress_of_jobs(pool):
+    received = list()
+    future = pool.submit(report, 3)
+    future.add_progress_callback(received.append)
+    assert future.result(TIMEOUT) == 3
+    # Progress is delivered (in order) before the result
+    assert received == [0, 1, 2]
+
+
+def test_preloaded_modules():
+    context = preloading_context(['colorsys', 'run_async_missing_module'])
+    if context is None:
+        pytest.skip('forkserver not available')
+    pool = WorkerPool(max_workers=1, mp_context=context)
+    pool.start()
+    try:
+        # Modules that cannot be imported are ignored
+        assert pool.submit(loaded, 'colorsys', 'wave',
+                           'run_async_missing_module').result(TIMEOUT) == [True, False, False]
+        # Replaced workers start with the modules already imported
+        with pytest.raises(WorkerError):
+            pool.submit(die).result(TIMEOUT)
+        assert pool.submit(loaded, 'colorsys').result(TIMEOUT) == [True]
+    finally:
+        pool.shutdown()
+
+
+def test_no_preloading_without_forkserver(monkeypatch):
+    monkeypatch.setattr(workers, 'get_all_start_methods', lambda: ['spawn'])
+    # i.e. the pool falls back on the default context
+    assert preloading_context(['colorsys']) is None
+
+
+def test_shutdown():
+    pool = WorkerPool(max_workers=1, mp_context=get_context('fork'))
+    pool.start()
+    running, pending = pool.submit(sleep, 1), pool.submit(sleep, 0)
+    time.sleep(.2)
+    pool.shutdown()
+    assert pending.cancelled()
+    assert running.done()
+    with pytest.raises(RuntimeError, match='after shutdown'):
+        pool.submit(sleep, 0)
+    with pytest.raises(ValueError):
+        WorkerPool(max_workers=0)